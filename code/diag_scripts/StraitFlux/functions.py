@@ -4,13 +4,14 @@ try:
     import matplotlib.pyplot as plt
 except ImportError:
     print('skipping matplotlib')
-from tqdm import tqdm
 import sys
+import hashlib
 try:
     from dask.diagnostics import ProgressBar
 except ImportError:
     print('skipping dask import')
 from StraitFlux.indices import check_availability_indices, prepare_indices
+import StraitFlux.preprocessing as prepro
 
 def check_Arakawa(u_data,v_data,T_data,model):
 
@@ -48,7 +49,18 @@ def check_Arakawa(u_data,v_data,T_data,model):
     return grid
 
 def transform_Arakawa(grid,mu,mv,deltaz,dzu3,dzv3,udata,vdata):
-
+    '''
+    This function transforms u and v from an Arakawa-A or -B grid to the cell faces of an Arakawa-C grid.
+    args:
+        grid: Arakawa-A, Arakawa-B or Arakawa-C
+        mu, mv: xa.Dataset with dyu and dxv on the subdomain
+        deltaz: xa.Dataset with thkcello on the subdomain
+        dzu3, dzv3: dz at the cell faces (calc_dz_faces)
+        udata, vdata: xa.DataArray of u and v on the subdomain
+    returns:
+        udata, vdata, dzu3, dzv3, mu2, mv2 on the Arakawa-C grid; u and v stay lazy if udata, vdata and thkcello are dask backed
+        (thkcello is read anyway in calc_dz_faces)
+    '''
     deltaz2=deltaz.thkcello###.mean(dim='time')
     dzs=deltaz2.sum(dim='lev').where(deltaz2.sum(dim='lev')!=0) #axis=0
 
@@ -60,15 +72,17 @@ def transform_Arakawa(grid,mu,mv,deltaz,dzu3,dzv3,udata,vdata):
         dzuv=deltaz2.rolling(x=2,min_periods=1).mean().rolling(y=2,min_periods=1).mean()
         dzuv2=dzuv.cumsum('lev').where(dzuv.cumsum('lev')<=dzs) #dzuvs
         dzuv2=dzuv2.fillna(dzs)#dzuvs
-        dzuv3=dzuv2.copy(data=np.diff(dzuv2, axis=dzuv2.get_axis_num("lev"), prepend=0))
+        dzuv3=dzuv2-dzuv2.shift(lev=1,fill_value=0)
         mu2=mu.rolling(x=2,min_periods=1).mean().rolling(y=2,min_periods=1).mean()
         mv2=mv.rolling(y=2,min_periods=1).mean().rolling(x=2,min_periods=1).mean()
-        udata2=(udata*mu2.dyu.values*dzuv3.values).rolling(y=2,min_periods=1).mean()/(mu.dyu.values*dzu3.values)#.fillna(0)
-        vdata2=(vdata*mv2.dxv.values*dzuv3.values).rolling(x=2,min_periods=1).mean()/(mv.dxv.values*dzv3.values)
+        udata2=(udata*mu2.dyu.values*dzuv3.data).rolling(y=2,min_periods=1).mean()/(mu.dyu.values*dzu3.values)#.fillna(0)
+        vdata2=(vdata*mv2.dxv.values*dzuv3.data).rolling(x=2,min_periods=1).mean()/(mv.dxv.values*dzv3.values)
         udata2=udata2.where(udata2>-2).where(udata2<2).fillna(0)
         vdata2=vdata2.where(vdata2>-2).where(vdata2<2).fillna(0)
-        udata=udata2*(udata/udata).values
-        vdata=vdata2*(udata/udata).values
+        # ocean points of u (not NaN and not 0), kept lazy
+        wet=(udata.notnull()&(udata!=0)).data
+        udata=udata2.where(wet)
+        vdata=vdata2.where(wet)
 
 
     if grid == 'Arakawa-A':
@@ -76,8 +90,8 @@ def transform_Arakawa(grid,mu,mv,deltaz,dzu3,dzv3,udata,vdata):
         mu2=mu.rolling(x=2,min_periods=1).mean()#.rolling(y=2,min_periods=1).mean()
         mv2=mv.rolling(y=2,min_periods=1).mean()#.rolling(x=2,min_periods=1).mean()
         print('equation to get u/v at T faces')
-        udata2=(udata*mu.dyu.values*deltaz2.values).rolling(x=2,min_periods=1).mean()/(mu2.dyu.values*dzu3.values)#.fillna(0)
-        vdata2=(vdata*mv.dxv.values*deltaz2.values).rolling(y=2,min_periods=1).mean()/(mv2.dxv.values*dzv3.values)
+        udata2=(udata*mu.dyu.values*deltaz2.data).rolling(x=2,min_periods=1).mean()/(mu2.dyu.values*dzu3.values)#.fillna(0)
+        vdata2=(vdata*mv.dxv.values*deltaz2.data).rolling(y=2,min_periods=1).mean()/(mv2.dxv.values*dzv3.values)
         udata=udata2.where(udata2>-1000).where(udata2<1000).fillna(0)
         vdata=vdata2.where(vdata2>-1000).where(vdata2<1000).fillna(0)
 
@@ -156,7 +170,81 @@ def check_indices(indices,out_u,out_v,t,u,v,strait,model,path_save):
 def interp_TS(ds,d):
     return ds.rolling({d:2},min_periods=1).mean()
 
-def calc_dz_faces(deltaz,grid,model,path_mesh):
+def dz_faces_C(zv,partial_cells=False):
+    '''
+    This function selects dz at the eastern cell faces on an Arakawa-C grid, taking the shallower of the two adjoining columns.
+    args:
+        zv: np.array of cell thicknesses with (lev,y,x) as the last three dimensions
+        partial_cells: if True the deeper column is only used down to the last wet level of the shallower one (time varying thkcello)
+    returns:
+        z0: np.array of dz at the cell faces, same shape as zv (last row and column are taken from zv)
+    '''
+    zs=np.nansum(zv,axis=-3)
+    p=(zs[...,:,1:]<zs[...,:,:-1])[...,np.newaxis,:,:]
+    own=zv[...,:,:-1]
+    nb=zv[...,:,1:]
+    if partial_cells:
+        # last wet level of the neighbour (-1 if the neighbour has no dry levels)
+        l=(np.isnan(nb).argmax(axis=-3)-1)%zv.shape[-3]
+        lev=np.arange(zv.shape[-3]).reshape((-1,1,1))
+        l=l[...,np.newaxis,:,:]
+        nb=np.where(lev<l,own,np.where(lev==l,nb,np.nan))
+    z0=zv.copy()
+    z0[...,:-1,:-1]=np.where(p,nb,own)[...,:-1,:]
+    return z0
+
+def dz_faces_B(zv):
+    '''
+    This function selects dz at the cell corners on an Arakawa-A or -B grid, taking the shallowest of the four adjoining columns.
+    args:
+        zv: np.array of cell thicknesses with (lev,y,x) as the last three dimensions
+    returns:
+        z0: np.array of dz at the cell corners, same shape as zv (last row and column are taken from zv)
+    '''
+    zs=np.nansum(zv,axis=-3)
+    # order of candidates matches the first minimum found by np.argwhere on the 2x2 box
+    p=np.stack((zs[...,:-1,:-1],zs[...,:-1,1:],zs[...,1:,:-1],zs[...,1:,1:])).argmin(axis=0)[...,np.newaxis,:,:]
+    z0=zv.copy()
+    z0[...,:-1,:-1]=np.where(p==0,zv[...,:-1,:-1],np.where(p==1,zv[...,:-1,1:],np.where(p==2,zv[...,1:,:-1],zv[...,1:,1:])))
+    return z0
+
+def dz_faces_file(deltaz,zv,grid,model,path_mesh):
+    '''
+    This function provides the file name of the cached dz at cell faces for a subdomain.
+    args:
+        deltaz: xa.Dataset of the cell thicknesses on the subdomain
+        zv: np.array of the cell thickness values
+        grid: Arakawa-A, Arakawa-B or Arakawa-C
+        model: model name
+        path_mesh: path to save mesh data
+    returns:
+        file name keyed by model, grid, subdomain bounds and a hash of the thkcello input
+    '''
+    bounds='x'+str(int(deltaz.x.min()))+'-'+str(int(deltaz.x.max()))+'_y'+str(int(deltaz.y.min()))+'-'+str(int(deltaz.y.max()))
+    zhash=hashlib.sha1(np.ascontiguousarray(zv))
+    if 'time' in deltaz.dims:
+        zhash.update(np.asarray(deltaz.time.values).astype(str))
+    return path_mesh+'dz_faces_'+model+'_'+grid+'_'+bounds+'_'+zhash.hexdigest()[:16]+'.nc'
+
+def weights_file(ds_in,ds_out,strait,point,path_mesh,options=''):
+    '''
+    This function provides the file name of the regridding weights from ds_in to the section points ds_out.
+    args:
+        ds_in: xa.Dataset on the model grid (with lon, lat and optionally mask)
+        ds_out: xa.Dataset of the target points (with lon and lat)
+        strait: strait name
+        point: grid point type, e.g. T, u or v
+        path_mesh: path to save mesh data
+        options: str of further regridding options that change the weights
+    returns:
+        file name keyed by strait, point type and a hash of both grids, the mask and the options (so models on the same grid share the weights)
+    '''
+    whash=hashlib.sha1(options.encode())
+    for coord in [ds_in.lon,ds_in.lat,ds_out.lon,ds_out.lat]+([ds_in['mask']] if 'mask' in ds_in else []):
+        whash.update(np.ascontiguousarray(coord.values))
+    return path_mesh+'weights_'+strait+'_'+point+'_'+whash.hexdigest()[:16]+'.nc'
+
+def calc_dz_faces(deltaz,grid,model,path_mesh,saving=True):
 
     if model in ['MPI-ESM1-2-LR','MPI-ESM1-2-HR']:
         print('swap')
@@ -167,128 +255,35 @@ def calc_dz_faces(deltaz,grid,model,path_mesh):
             zv=deltaz.thkcello.values
     except NameError:
         zv=deltaz.thkcello.values
-    z0u=np.zeros(np.shape(zv))
-    z0v=np.zeros(np.shape(zv))
-    print('calc dz at cell faces')
-    if 'time' in deltaz.dims:
-        deltazu=xa.Dataset({'thkcello':(('time','lev','y','x'),np.zeros(np.shape(zv)))},coords=({'time':('time',deltaz.time.data),'lev':('lev',deltaz.lev.data),'x':('x',deltaz.x.data),'y':('y',deltaz.y.data)}))
-        deltazv=xa.Dataset({'thkcello':(('time','lev','y','x'),np.zeros(np.shape(zv)))},coords=({'time':('time',deltaz.time.data),'lev':('lev',deltaz.lev.data),'x':('x',deltaz.x.data),'y':('y',deltaz.y.data)}))
-    else:
-        deltazu=xa.Dataset({'thkcello':(('lev','y','x'),np.zeros(np.shape(zv)))},coords=({'lev':('lev',deltaz.lev.data),'x':('x',deltaz.x.data),'y':('y',deltaz.y.data)}))
-        deltazv=xa.Dataset({'thkcello':(('lev','y','x'),np.zeros(np.shape(zv)))},coords=({'lev':('lev',deltaz.lev.data),'x':('x',deltaz.x.data),'y':('y',deltaz.y.data)}))
-
-
-    if grid == 'Arakawa-C':
-        if 'time' in deltaz.dims:
-            for i in tqdm(range(len(deltaz.y)-1)):
-                #print(i)
-                for j in range(len(deltaz.x)-1):
-                    p=np.nansum(zv[:,:,i,j:j+2],axis=1).argmin(axis=1)
-                    for k in range(len(p)):
-                        if p[k] == 0:
-                            z0u[k,:,i,j]=zv[k,:,i,j]
-                        if p[k] ==1:
-                            l=np.isnan(zv[k,:,i,j+1]).argmax(axis=0)-1
-                            z0u[k,:l,i,j]=zv[k,:l,i,j]
-                            z0u[k,l,i,j]=zv[k,l,i,j+1]
-                            if l >= 0:
-                                z0u[k,l+1:,i,j]=np.nan
-            deltazu['thkcello'][:,:,:,:]=z0u
-            deltazu['thkcello'][:,:,:,-1]=zv[:,:,:,-1]
-            deltazu['thkcello'][:,:,-1,:]=zv[:,:,-1,:]
+    zv=zv.astype(float)
 
-            for j in tqdm(range(len(deltaz.x)-1)):
-                #print(j)
-                for i in range(len(deltaz.y)-1):
-                    p=np.nansum(zv[:,:,i:i+2,j],axis=1).argmin(axis=1)
-                    for k in range(len(p)):
-                        if p[k] == 0:
-                            z0v[k,:,i,j]=zv[k,:,i,j]
-                        if p[k] ==1:
-                            l=np.isnan(zv[k,:,i+1,j]).argmax(axis=0)-1
-                            z0v[k,:l,i,j]=zv[k,:l,i,j]
-                            z0v[k,l,i,j]=zv[k,l,i+1,j]
-                            if l >= 0:
-                                z0v[k,l+1:,i,j]=np.nan
-
-            deltazv['thkcello'][:,:,:,:]=z0v
-            deltazv['thkcello'][:,:,:,-1]=zv[:,:,:,-1]
-            deltazv['thkcello'][:,:,-1,:]=zv[:,:,-1,:]
-
-        else:
-            for i in tqdm(range(len(deltaz.y)-1)):
-                #print(i)
-                for j in range(len(deltaz.x)-1):
-                    p=np.nansum(zv[:,i,j:j+2],axis=0).argmin()
-                    if p == 0:
-                        z0u[:,i,j]=zv[:,i,j]
-                    if p ==1:
-                        z0u[:,i,j]=zv[:,i,j+1]
-            deltazu['thkcello'][:,:,:]=z0u
-            deltazu['thkcello'][:,:,-1]=zv[:,:,-1]
-            deltazu['thkcello'][:,-1,:]=zv[:,-1,:]
+    file_dz=dz_faces_file(deltaz,zv,grid,model,path_mesh)
+    try:
+        with xa.open_dataset(file_dz) as ds:
+            dz=ds.load()
+        print('read dz at cell faces')
+        return dz.dzu.rename('thkcello'),dz.dzv.rename('thkcello')
+    except FileNotFoundError:
+        pass
 
-            for j in tqdm(range(len(deltaz.x)-1)):
-                for i in range(len(deltaz.y)-1):
-                    p=np.nansum(zv[:,i:i+2,j],axis=0).argmin()
-                    if p == 0:
-                        z0v[:,i,j]=zv[:,i,j]
-                    if p ==1:
-                        z0v[:,i,j]=zv[:,i+1,j]
-            deltazv['thkcello'][:,:,:]=z0v
-            deltazv['thkcello'][:,:,-1]=zv[:,:,-1]
-            deltazv['thkcello'][:,-1,:]=zv[:,-1,:]
+    print('calc dz at cell faces')
 
+    if grid == 'Arakawa-C':
+        z0u=dz_faces_C(zv,partial_cells=('time' in deltaz.dims))
+        z0v=np.swapaxes(dz_faces_C(np.swapaxes(zv,-1,-2),partial_cells=('time' in deltaz.dims)),-1,-2)
     elif grid in ['Arakawa-B','Arakawa-A']:
-        if 'time' in deltaz.dims:
-            for k in tqdm(range(len(deltaz.time))):
-                #print(k)
-                zv=deltaz.thkcello[k].values
-                z0u=np.zeros(np.shape(zv))
-                z0v=np.zeros(np.shape(zv))
-                for i in range(len(deltaz.y)-1):
-                    #print(i)
-                    for j in range(len(deltaz.x)-1):
-                        p=np.argwhere(np.nansum(zv[:,i:i+2,j:j+2],axis=0) == np.min(np.nansum(zv[:,i:i+2,j:j+2],axis=0)))[0]
-                        if p[0] == 0:
-                            if p[1] == 0:
-                                z0u[:,i,j]=zv[:,i,j]
-                            elif p[1] == 1:
-                                z0u[:,i,j]=zv[:,i,j+1]
-                        elif p[0] == 1:
-                            if  p[1] == 0:
-                                z0u[:,i,j]=zv[:,i+1,j]
-                            elif p[1] == 1:
-                                z0u[:,i,j]=zv[:,i+1,j+1]
-                deltazu['thkcello'][k,:,:,:]=z0u
-                deltazu['thkcello'][k,:,:,-1]=zv[:,:,-1]
-                deltazu['thkcello'][k,:,-1,:]=zv[:,-1,:]
-                deltazv['thkcello'][k,:,:,:]=z0u
-                deltazv['thkcello'][k,:,:,-1]=zv[:,:,-1]
-                deltazv['thkcello'][k,:,-1,:]=zv[:,-1,:]
-
+        z0u=dz_faces_B(zv)
+        z0v=z0u
+    else:
+        z0u=np.zeros(np.shape(zv))
+        z0v=np.zeros(np.shape(zv))
 
-        else:
-            for i in tqdm(range(len(deltaz.y)-1)):
-                #print(i)
-                for j in range(len(deltaz.x)-1):
-                    p=np.argwhere(np.nansum(zv[:,i:i+2,j:j+2],axis=0) == np.min(np.nansum(zv[:,i:i+2,j:j+2],axis=0)))[0]
-                    if p[0] == 0:
-                        if p[1] == 0:
-                            z0u[:,i,j]=zv[:,i,j]
-                        elif p[1] == 1:
-                            z0u[:,i,j]=zv[:,i,j+1]
-                    elif p[0] == 1:
-                        if  p[1] == 0:
-                            z0u[:,i,j]=zv[:,i+1,j]
-                        elif p[1] == 1:
-                            z0u[:,i,j]=zv[:,i+1,j+1]
-            deltazu['thkcello'][:,:,:]=z0u
-            deltazu['thkcello'][:,:,-1]=zv[:,:,-1]
-            deltazu['thkcello'][:,-1,:]=zv[:,-1,:]
-            deltazv['thkcello'][:,:,:]=z0u
-            deltazv['thkcello'][:,:,-1]=zv[:,:,-1]
-            deltazv['thkcello'][:,-1,:]=zv[:,-1,:]
+    if 'time' in deltaz.dims:
+        deltazu=xa.Dataset({'thkcello':(('time','lev','y','x'),z0u)},coords=({'time':('time',deltaz.time.data),'lev':('lev',deltaz.lev.data),'x':('x',deltaz.x.data),'y':('y',deltaz.y.data)}))
+        deltazv=xa.Dataset({'thkcello':(('time','lev','y','x'),z0v.copy())},coords=({'time':('time',deltaz.time.data),'lev':('lev',deltaz.lev.data),'x':('x',deltaz.x.data),'y':('y',deltaz.y.data)}))
+    else:
+        deltazu=xa.Dataset({'thkcello':(('lev','y','x'),z0u)},coords=({'lev':('lev',deltaz.lev.data),'x':('x',deltaz.x.data),'y':('y',deltaz.y.data)}))
+        deltazv=xa.Dataset({'thkcello':(('lev','y','x'),z0v.copy())},coords=({'lev':('lev',deltaz.lev.data),'x':('x',deltaz.x.data),'y':('y',deltaz.y.data)}))
 
     if model in ['MPI-ESM1-2-LR','MPI-ESM1-2-HR']:
         print('swap')
@@ -297,4 +292,37 @@ def calc_dz_faces(deltaz,grid,model,path_mesh):
         deltazv['y']=np.arange(len(deltazv.y)-1,-1,-1)
         deltazv=deltazv.sortby('y')
 
+    if saving == True:
+        prepro.save_atomic(xa.Dataset({'dzu':deltazu.thkcello,'dzv':deltazv.thkcello}),file_dz)
+
     return deltazu.thkcello,deltazv.thkcello
+
+def compute(ds,scheduler=None):
+    '''
+    Compute a (lazy) xarray object with dask
+
+    args:
+    ds: xa.Dataset or xa.DataArray
+    scheduler (str): dask scheduler, threads, processes, synchronous or distributed (uses the running dask.distributed client or starts a local cluster); default None uses the dask default
+
+    returns:
+    computed ds
+    '''
+    if scheduler == 'distributed':
+        try:
+            from dask.distributed import Client, get_client
+        except ImportError:
+            print('dask.distributed not available, using threads')
+            scheduler = 'threads'
+        else:
+            try:
+                get_client()
+            except ValueError:
+                print('starting local dask cluster')
+                Client()
+            scheduler = None
+    try:
+        with ProgressBar():
+            return ds.compute(scheduler=scheduler)
+    except NameError:
+        return ds.compute(scheduler=scheduler)
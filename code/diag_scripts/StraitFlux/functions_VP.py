@@ -4,7 +4,6 @@ try:
     import matplotlib.pyplot as plt
 except ImportError:
     print('skipping matplotlib')
-from tqdm import tqdm
 import sys
 from dask.diagnostics import ProgressBar
 from StraitFlux.indices import check_availability_indices, prepare_indices
@@ -134,45 +133,25 @@ def select_indices(indices,u_data,v_data,T_data):
 
     return uniques_new,u_line,v_line,T_line,u_line2,v_line2
 
+def nearest_ref_points(ref_line,lat,lon):
+    '''
+    This function finds the nearest point on the reference line (first column) and its neighbour (second column) for each point lat,lon,
+    using the KD-tree of the reference line (preprocessing.nearest_points)
+    '''
+    nearest = prepro.nearest_points(ref_line.lat.values,ref_line.lon.values,lat,lon)
+    neighbour = np.where(nearest==len(ref_line)-1,nearest-1,nearest+1)  # right neighbouring point, left one for the last point
+    return np.stack([nearest,neighbour],axis=1)
+
 def get_nearest_r(ref_line,u_line,v_line,T_line):
     '''
     This function calculates the nearest point on the reference line and it's neighbour for each T-point on the native grid
     '''
 
-    mini = np.zeros((len(T_line),2)) # two columns, first for nearest point and second for neighbour
-    i=0
-    
-    for i in tqdm(range(len(T_line))):
-    #calc distance for every point of line to every point of ref line
-        dist_list_single_point = []
-        j=0
-        for j in range(len(ref_line)):
-            dist = prepro.distance(ref_line.lat[j].values,ref_line.lon[j].values,T_line.lat[i].values,T_line.lon[i].values)
-            dist_list_single_point = np.append(dist_list_single_point,dist)
-
-        minimum = dist_list_single_point.tolist().index(min(dist_list_single_point))
-        #print(len(ref_line))
-        #sys.exit()
-        mini[i,0] = minimum     # nearest point
-        if mini[i,0] == len(ref_line)-1:
-            mini[i,1] = minimum-1  # left neighbouring point
-        else:
-            mini[i,1] = minimum+1  # right neighbouring point
-
-    r_1_lat=[]
-    r_1_lon=[]
-    r_2_lat=[]
-    r_2_lon=[]
-    ##### select points on T-line
-    for i in range(len(T_line)):
-        r1lat=ref_line[int(mini[i,0]),int(mini[i,0])].lat
-        r1lon=ref_line[int(mini[i,0]),int(mini[i,0])].lon
-        r2lat=ref_line[int(mini[i,1]),int(mini[i,1])].lat
-        r2lon=ref_line[int(mini[i,1]),int(mini[i,1])].lon
-        r_1_lat=np.append(r_1_lat,r1lat)
-        r_1_lon=np.append(r_1_lon,r1lon)
-        r_2_lat=np.append(r_2_lat,r2lat)
-        r_2_lon=np.append(r_2_lon,r2lon)
+    mini = nearest_ref_points(ref_line,T_line.lat.values,T_line.lon.values)
+    r_1_lat=ref_line.lat.values[mini[:,0]]
+    r_1_lon=ref_line.lon.values[mini[:,0]]
+    r_2_lat=ref_line.lat.values[mini[:,1]]
+    r_2_lon=ref_line.lon.values[mini[:,1]]
         
     return r_1_lat,r_1_lon,r_2_lat,r_2_lon
 
@@ -183,113 +162,60 @@ def normalize(v):
     return v / norm
 
 
-def calc_normvec(ref_line,u_line,v_line,T_line):
+def project_to_line(points,r_1,r_2):
     '''
-    This function calculates the vectors normal to the reference line at each u,v and T point using 3 cross products
+    This function projects points onto the great circles through r_1 and r_2 using 3 cross products
+    args:
+        points, r_1, r_2: np.arrays (N,3) in cartesian coordinates (kugel_2_kart)
+    returns:
+        np.array (N,3) of the projected points on the reference line
     '''
     a = 6378388
-    normu_x, normu_y, normu_z = [], [], []
-    normv_x, normv_y, normv_z = [], [], []
-    normT_x, normT_y, normT_z = [], [], []
-    
+    n=np.cross(r_1,r_2)  ## cross product 1
+    p=np.cross(points,n)  ## cross product 2
+    proj=np.cross(n,p)  ## cross product 3
+    norm=np.sqrt(proj[:,None,:]@proj[:,:,None])[:,0]  ## same as np.linalg.norm of each point
+    return proj/np.where(norm==0,1,norm)*a  ## normalize and multiply by Earth radius to obtain point on ref line
+
+
+def calc_normvec(ref_line,u_line,v_line,T_line):
+    '''
+    This function calculates the vectors normal to the reference line at each T point and the projections of the T,u and v points onto the reference line
+    '''
     r_1_lat,r_1_lon,r_2_lat,r_2_lon=get_nearest_r(ref_line,u_line,v_line,T_line)
-    ref_x,ref_y,ref_z=prepro.kugel_2_kart(ref_line.lat.values,ref_line.lon.values)
-    u_x,u_y,u_z=prepro.kugel_2_kart(u_line.lat.values,u_line.lon.values)
-    v_x,v_y,v_z=prepro.kugel_2_kart(v_line.lat.values,v_line.lon.values)
-    T_x,T_y,T_z=prepro.kugel_2_kart(T_line.lat.values,T_line.lon.values)
-    r1_x,r1_y,r1_z=prepro.kugel_2_kart(r_1_lat,r_1_lon)
-    r2_x,r2_y,r2_z=prepro.kugel_2_kart(r_2_lat,r_2_lon)
-    
-    Tprojx, Tprojy, Tprojz= [], [], []
-    uprojx, uprojy, uprojz= [], [], []
-    vprojx, vprojy, vprojz= [], [], []
-    
-    for i in range(len(T_x)):
-        r_1=[r1_x[i],r1_y[i],r1_z[i]]
-        r_2=[r2_x[i],r2_y[i],r2_z[i]]
-        n=np.cross(np.array(r_1),np.array(r_2))  ## cross product 1
-        #calc normvec T
-        T=[T_x[i],T_y[i],T_z[i]]
-        pT=np.cross(np.array(T),n)  ## cross product 2
-        T_proj=np.cross(n,pT)  ## cross product 3
-        T_proj=normalize(T_proj)*a  ## normalize and multiply by Earth radius to obtain point on ref line
-        Tprojx=np.append(T_proj[0],Tprojx)
-        Tprojy=np.append(T_proj[1],Tprojy)
-        Tprojz=np.append(T_proj[2],Tprojz)
-        T_t_x=T_proj[0]-T[0]   ### difference between T point and projected point on ref-line = normal vector
-        T_t_y=T_proj[1]-T[1]
-        T_t_z=T_proj[2]-T[2]
-        normT_x=np.append(normT_x,T_t_x)
-        normT_y=np.append(normT_y,T_t_y)
-        normT_z=np.append(normT_z,T_t_z)
-        #calc normvec u
-        u=[u_x[i],u_y[i],u_z[i]]
-        pu=np.cross(np.array(u),n)
-        u_proj=np.cross(n,pu)
-        u_proj=normalize(u_proj)*a
-        uprojx=np.append(u_proj[0],uprojx)
-        uprojy=np.append(u_proj[1],uprojy)
-        uprojz=np.append(u_proj[2],uprojz)
-        u_t_x=u_proj[0]-u[0]
-        u_t_y=u_proj[1]-u[1]
-        u_t_z=u_proj[2]-u[2]
-        normu_x=np.append(normu_x,u_t_x)
-        normu_y=np.append(normu_y,u_t_y)
-        normu_z=np.append(normu_z,u_t_z)
-        #calc normvec v
-        v=[v_x[i],v_y[i],v_z[i]]
-        pv=np.cross(np.array(v),n)
-        v_proj=np.cross(n,pv)
-        v_proj=normalize(v_proj)*a
-        vprojx=np.append(v_proj[0],vprojx)
-        vprojy=np.append(v_proj[1],vprojy)
-        vprojz=np.append(v_proj[2],vprojz)
-        v_t_x=v_proj[0]-v[0]
-        v_t_y=v_proj[1]-v[1]
-        v_t_z=v_proj[2]-v[2]
-        normv_x=np.append(normv_x,v_t_x)
-        normv_y=np.append(normv_y,v_t_y)
-        normv_z=np.append(normv_z,v_t_z)
-        
-    Tproj_lat,Tproj_lon=prepro.kart_2_kugel(Tprojx,Tprojy,Tprojz)
-    T_proj = xa.DataArray(np.full((len(Tproj_lat), len(Tproj_lon)),1),dims=['lat','lon'],coords=[np.flip(Tproj_lat),np.flip(Tproj_lon)])
+    r_1=np.stack(prepro.kugel_2_kart(r_1_lat,r_1_lon),axis=1)
+    r_2=np.stack(prepro.kugel_2_kart(r_2_lat,r_2_lon),axis=1)
+    T=np.stack(prepro.kugel_2_kart(T_line.lat.values,T_line.lon.values),axis=1)
+    u=np.stack(prepro.kugel_2_kart(u_line.lat.values,u_line.lon.values),axis=1)
+    v=np.stack(prepro.kugel_2_kart(v_line.lat.values,v_line.lon.values),axis=1)
+
+    Tproj=project_to_line(T,r_1,r_2)
+    uproj=project_to_line(u,r_1,r_2)
+    vproj=project_to_line(v,r_1,r_2)
+    normT=Tproj-T   ### difference between T point and projected point on ref-line = normal vector
+
+    Tproj_lat,Tproj_lon=prepro.kart_2_kugel(Tproj[:,0],Tproj[:,1],Tproj[:,2])
+    T_proj = xa.DataArray(np.full((len(Tproj_lat), len(Tproj_lon)),1),dims=['lat','lon'],coords=[Tproj_lat,Tproj_lon])
     T_proj = T_proj.to_dataset(name='T')
-    uproj_lat,uproj_lon=prepro.kart_2_kugel(uprojx,uprojy,uprojz)
-    u_proj = xa.DataArray(np.full((len(uproj_lat), len(uproj_lon)),1),dims=['lat','lon'],coords=[np.flip(uproj_lat),np.flip(uproj_lon)])
+    uproj_lat,uproj_lon=prepro.kart_2_kugel(uproj[:,0],uproj[:,1],uproj[:,2])
+    u_proj = xa.DataArray(np.full((len(uproj_lat), len(uproj_lon)),1),dims=['lat','lon'],coords=[uproj_lat,uproj_lon])
     u_proj = u_proj.to_dataset(name='u')
-    vproj_lat,vproj_lon=prepro.kart_2_kugel(vprojx,vprojy,vprojz)
-    v_proj = xa.DataArray(np.full((len(vproj_lat), len(vproj_lon)),1),dims=['lat','lon'],coords=[np.flip(vproj_lat),np.flip(vproj_lon)])
+    vproj_lat,vproj_lon=prepro.kart_2_kugel(vproj[:,0],vproj[:,1],vproj[:,2])
+    v_proj = xa.DataArray(np.full((len(vproj_lat), len(vproj_lon)),1),dims=['lat','lon'],coords=[vproj_lat,vproj_lon])
     v_proj = v_proj.to_dataset(name='v')
-    return normT_x,normT_y,normT_z, T_proj, u_proj, v_proj
+    return normT[:,0],normT[:,1],normT[:,2], T_proj, u_proj, v_proj
 
 def calc_dir_vector(u_line,v_line,u_line2,v_line2):
     '''
     This function calculates the direct u and v vectors
     '''
+    u = np.stack(prepro.kugel_2_kart(u_line.lat.values,u_line.lon.values),axis=1)
+    v = np.stack(prepro.kugel_2_kart(v_line.lat.values,v_line.lon.values),axis=1)
+    u2 = np.stack(prepro.kugel_2_kart(u_line2.lat.values,u_line2.lon.values),axis=1)
+    v2 = np.stack(prepro.kugel_2_kart(v_line2.lat.values,v_line2.lon.values),axis=1)
 
-    ux,uy,uz = prepro.kugel_2_kart(u_line.lat.values,u_line.lon.values) #koordinaten uPunkt -Koordinaten TPunkt
-    vx,vy,vz = prepro.kugel_2_kart(v_line.lat.values,v_line.lon.values) #koordinaten vPunkt -Koordinaten T PUnkt
-    ux2,uy2,uz2 = prepro.kugel_2_kart(u_line2.lat.values,u_line2.lon.values) #koordinaten uPunkt -Koordinaten TPunkt
-    vx2,vy2,vz2 = prepro.kugel_2_kart(v_line2.lat.values,v_line2.lon.values) #koordinaten vPunkt -Koordinaten T PUnkt
-
-    rv_u = np.zeros((len(u_line),3))
-    rv_v = np.zeros((len(v_line),3))
-    i=0
-    for i in tqdm(range(len(u_line))):
-        vec_ux = ux2[i]-ux[i]#ux[i] - tx[i]#
-        vec_uy = uy2[i]-uy[i]#uy[i] - ty[i]#
-        vec_uz = uz2[i]-uz[i]#uz[i] - tz[i]#
-        rv_u[i,0] = vec_ux
-        rv_u[i,1] = vec_uy
-        rv_u[i,2] = vec_uz
-        
-        vec_vx = vx2[i]-vx[i]#vx[j] - tx[j]#
-        vec_vy = vy2[i]-vy[i]#vy[j] - ty[j]#
-        vec_vz = vz2[i]-vz[i]#vz[j] - tz[j]#
-        rv_v[i,0] = vec_vx
-        rv_v[i,1] = vec_vy
-        rv_v[i,2] = vec_vz
-        
+    rv_u = u2-u
+    rv_v = v2-v
     return rv_u, rv_v
 
 def proj_vec(ref_line,u_line,v_line,T_line,u_line2,v_line2):
@@ -298,59 +224,40 @@ def proj_vec(ref_line,u_line,v_line,T_line,u_line2,v_line2):
     '''
     
     print('.. calculating normal vectors')
-    normT_x,normT_y,normT_z,T_proj, u_proj, v_proj = calc_normvec(ref_line,u_line,v_line,T_line) #normu_x,normu_y,normu_z,normv_x,normv_y,normv_z
+    normT_x,normT_y,normT_z,T_proj, u_proj, v_proj = calc_normvec(ref_line,u_line,v_line,T_line)
     print('.. calculating direct vectors')
     u_dirvec, v_dirvec = calc_dir_vector(u_line,v_line,u_line2,v_line2)
-    u_dir = np.zeros((len(u_dirvec),3))
-    v_dir = np.zeros((len(v_dirvec),3))
-    k=0
-    for k in range(len(u_dirvec)):
-        u_dir[k,0] = (1/np.sqrt((u_dirvec[k,0]**2 + u_dirvec[k,1]**2 + u_dirvec[k,2]**2))) * u_dirvec[k,0]
-        u_dir[k,1] = (1/np.sqrt((u_dirvec[k,0]**2 + u_dirvec[k,1]**2 + u_dirvec[k,2]**2))) * u_dirvec[k,1]
-        u_dir[k,2] = (1/np.sqrt((u_dirvec[k,0]**2 + u_dirvec[k,1]**2 + u_dirvec[k,2]**2))) * u_dirvec[k,2]
-        v_dir[k,0] = (1/np.sqrt((v_dirvec[k,0]**2 + v_dirvec[k,1]**2 + v_dirvec[k,2]**2))) * v_dirvec[k,0]
-        v_dir[k,1] = (1/np.sqrt((v_dirvec[k,0]**2 + v_dirvec[k,1]**2 + v_dirvec[k,2]**2))) * v_dirvec[k,1]
-        v_dir[k,2] = (1/np.sqrt((v_dirvec[k,0]**2 + v_dirvec[k,1]**2 + v_dirvec[k,2]**2))) * v_dirvec[k,2]
+    u_dir = (1/np.sqrt((u_dirvec[:,0]**2 + u_dirvec[:,1]**2 + u_dirvec[:,2]**2)))[:,None] * u_dirvec
+    v_dir = (1/np.sqrt((v_dirvec[:,0]**2 + v_dirvec[:,1]**2 + v_dirvec[:,2]**2)))[:,None] * v_dirvec
 
     norm_betragT = np.sqrt((normT_x**2 + normT_y**2 +normT_z**2))
     zaehler_u = (u_dir[:,0] * normT_x) + (u_dir[:,1] * normT_y) + (u_dir[:,2] * normT_z)
     zaehler_v = (v_dir[:,0] * normT_x) + (v_dir[:,1] * normT_y) + (v_dir[:,2] * normT_z)
     term1_u = zaehler_u/norm_betragT**2 
     term1_v = zaehler_v/norm_betragT**2
-    proj_u = np.zeros((len(normT_x),3))
-    proj_v = np.zeros((len(normT_x),3))
-    for i in range(len(normT_x)):
-        proj_u[i,0] = term1_u[i] *normT_x[i]
-        proj_u[i,1] = term1_u[i] *normT_y[i]
-        proj_u[i,2] = term1_u[i] *normT_z[i]
-        proj_v[i,0] = term1_v[i] *normT_x[i]
-        proj_v[i,1] = term1_v[i] *normT_y[i]
-        proj_v[i,2] = term1_v[i] *normT_z[i]
+    normT = np.stack([normT_x,normT_y,normT_z],axis=1)
+    proj_u = term1_u[:,None] * normT
+    proj_v = term1_v[:,None] * normT
 
     return proj_u,proj_v,T_proj, u_proj, v_proj
 
 def calc_dx(T_proj_points):
-    
-    dist_listT = []
-    for k in range(len(T_line)-1):
-        distsT = prepro.distance(T_proj_points.lat[k],T_proj_points.lon[k],T_proj_points.lat[k+1],T_proj_points.lon[k+1])
-        dist_listT = np.append(dist_listT,distsT)
-    dist_lastT = prepro.distance(T_proj_points.lat[-2],T_proj_points.lon[-2],T_proj_points.lat[-1],T_proj_points.lon[-1])
-    dist_listT = np.append(dist_listT,dist_lastT)
+    '''
+    This function calculates the distances between neighbouring points on the reference line (last one repeated) and
+    the width of each point (half the distances to both neighbours, full distance at the ends) in km, leaving out duplicate points
+    '''
+    lat,lon = T_proj_points.lat.values,T_proj_points.lon.values
+    distsT = prepro.distance(lat[:-1],lon[:-1],lat[1:],lon[1:])
+    dist_listT = np.append(distsT,distsT[-1])
 
     T_proj_lat=T_proj_points.lat*dist_listT/dist_listT
     T_proj_lat=T_proj_lat[~np.isnan(T_proj_lat)]
     T_proj_lon=T_proj_points.lon*dist_listT/dist_listT
     T_proj_lon=T_proj_lon[~np.isnan(T_proj_lon)]
     
-    dist_listT_kurz2 = []
-    dist_firstT_kurz2 = prepro.distance(T_proj_lat[0],T_proj_lon[0],T_proj_lat[1],T_proj_lon[1])
-    dist_listT_kurz2 = np.append(dist_listT_kurz2,dist_firstT_kurz2)
-    for k in range(1,len(T_proj_lon)-1):      
-        distsT_kurz2 = prepro.distance(T_proj_lat[k-1],T_proj_lon[k-1],T_proj_lat[k],T_proj_lon[k])/2 + prepro.distance(T_proj_lat[k],T_proj_lon[k],T_proj_lat[k+1],T_proj_lon[k+1])/2
-        dist_listT_kurz2 = np.append(dist_listT_kurz2,distsT_kurz2)
-    dist_lastT_kurz2 = prepro.distance(T_proj_lat[-2],T_proj_lon[-2],T_proj_lat[-1],T_proj_lon[-1])
-    dist_listT_kurz2 = np.append(dist_listT_kurz2,dist_lastT_kurz2)
+    lat,lon = T_proj_lat.values,T_proj_lon.values
+    distsT_kurz = prepro.distance(lat[:-1],lon[:-1],lat[1:],lon[1:])
+    dist_listT_kurz2 = np.concatenate([distsT_kurz[:1],distsT_kurz[:-1]/2 + distsT_kurz[1:]/2,distsT_kurz[-1:]])
 
     return dist_listT,dist_listT_kurz2,T_proj_lat, T_proj_lon
 
@@ -383,91 +290,29 @@ def calc_interpolation_points(indices,T_data, ref_line):
         reana: ORAS5,FOAM,CGLORS,GLORYS2V4
     '''
     selection = indices.indices.values
-    sels = np.zeros((len(selection),2))
-    i=0
-    for i in range(len(selection)):
-        if selection[i,0] == 0:
-            sels[i,0] = selection[i,2]
-            sels[i,1] = selection[i,3]
-        else:
-            sels[i,0] = selection[i,0]
-            sels[i,1] = selection[i,1]
-
+    sels = np.where((selection[:,0] == 0)[:,None],selection[:,2:4],selection[:,0:2])
 
-    # prepate for coordinates
-    T_points_lons = []
-    T_points_lats = []
     # coordinates of T_points:
-    k=0
-    for k in range(len(sels)):
-        T_points_lon = T_data.isel(x=int(sels[k,0]),y=int(sels[k,1])).lon.values
-        T_points_lons = np.append(T_points_lons,T_points_lon)
-        T_points_lat = T_data.isel(x=int(sels[k,0]),y=int(sels[k,1])).lat.values
-        T_points_lats = np.append(T_points_lats,T_points_lat)
-    T_line = xa.DataArray(np.full((len(sels), len(sels)),1),dims=['lat','lon'],coords=[T_points_lats,T_points_lons])
-
-    mini = np.zeros((len(T_line),2)) # two columns, first for nearest point and second for neighbour
-    i=0
-    for i in range(len(T_line)):
-    #calc distance for every point of line to every point of ref line
-        dist_list_single_point = []
-        j=0
-        for j in range(len(ref_line)):
-            dist = prepro.distance(ref_line.lat[j].values,ref_line.lon[j].values,T_line.lat[i].values,T_line.lon[i].values)
-            dist_list_single_point = np.append(dist_list_single_point,dist)
-        minimum = dist_list_single_point.tolist().index(min(dist_list_single_point))
-
-        mini[i,0] = minimum     # nearest point
-        if mini[i,0] == len(ref_line)-1:
-            mini[i,1] = minimum-1  # left neighbouring point
-        else:
-            mini[i,1] = minimum+1  # right neighbouring point
-
-
-    r_1_lat=[]
-    r_1_lon=[]
-    r_2_lat=[]
-    r_2_lon=[]
-    ##### select points on T-line
-    for i in range(len(T_line)):
-        r1lat=ref_line[int(mini[i,0]),int(mini[i,0])].lat
-        r1lon=ref_line[int(mini[i,0]),int(mini[i,0])].lon
-        r2lat=ref_line[int(mini[i,1]),int(mini[i,1])].lat
-        r2lon=ref_line[int(mini[i,1]),int(mini[i,1])].lon
-        r_1_lat=np.append(r_1_lat,r1lat)
-        r_1_lon=np.append(r_1_lon,r1lon)
-        r_2_lat=np.append(r_2_lat,r2lat)
-        r_2_lon=np.append(r_2_lon,r2lon)
-
-    a = 6378388
-    normT_x=[]
-    normT_y=[]
-    normT_z=[]
-    ref_x,ref_y,ref_z=prepro.kugel_2_kart(ref_line.lat.values,ref_line.lon.values)
-    T_x,T_y,T_z=prepro.kugel_2_kart(T_line.lat.values,T_line.lon.values)
-    r1_x,r1_y,r1_z=prepro.kugel_2_kart(r_1_lat,r_1_lon)
-    r2_x,r2_y,r2_z=prepro.kugel_2_kart(r_2_lat,r_2_lon)
-    Tprojx=[]
-    Tprojy=[]
-    Tprojz=[]
-    for i in range(len(T_x)):
-        r_1=[r1_x[i],r1_y[i],r1_z[i]]
-        r_2=[r2_x[i],r2_y[i],r2_z[i]]
-        n=np.cross(np.array(r_1),np.array(r_2))  ## cross product 1
-        #calc normvec T
-        T=[T_x[i],T_y[i],T_z[i]]
-        pT=np.cross(np.array(T),n)  ## cross product 2
-        T_proj=np.cross(n,pT)  ## cross product 3
-        T_proj=normalize(T_proj)*a  ## normalize and multiply by Earth radius to obtain point on ref line
-        Tprojx=np.append(T_proj[0],Tprojx)
-        Tprojy=np.append(T_proj[1],Tprojy)
-        Tprojz=np.append(T_proj[2],Tprojz)
-
-    res,ind = np.unique(Tprojx, return_index=True)
+    T_points = T_data.isel(x=xa.DataArray(sels[:,0].astype(int)),y=xa.DataArray(sels[:,1].astype(int)))
+    T_line = xa.DataArray(np.full((len(sels), len(sels)),1),dims=['lat','lon'],coords=[T_points.lat.values,T_points.lon.values])
+
+    mini = nearest_ref_points(ref_line,T_line.lat.values,T_line.lon.values)
+    r_1_lat=ref_line.lat.values[mini[:,0]]
+    r_1_lon=ref_line.lon.values[mini[:,0]]
+    r_2_lat=ref_line.lat.values[mini[:,1]]
+    r_2_lon=ref_line.lon.values[mini[:,1]]
+
+    r_1=np.stack(prepro.kugel_2_kart(r_1_lat,r_1_lon),axis=1)
+    r_2=np.stack(prepro.kugel_2_kart(r_2_lat,r_2_lon),axis=1)
+    T=np.stack(prepro.kugel_2_kart(T_line.lat.values,T_line.lon.values),axis=1)
+    # projected points in reverse order, duplicates are removed keeping the last one along the line
+    Tproj=project_to_line(T,r_1,r_2)[::-1]
+
+    res,ind = np.unique(Tproj[:,0], return_index=True)
     Tprojx = res[np.argsort(ind)]
-    res,ind = np.unique(Tprojy, return_index=True)
+    res,ind = np.unique(Tproj[:,1], return_index=True)
     Tprojy = res[np.argsort(ind)]
-    res,ind = np.unique(Tprojz, return_index=True)
+    res,ind = np.unique(Tproj[:,2], return_index=True)
     Tprojz = res[np.argsort(ind)]
     
     
@@ -475,26 +320,7 @@ def calc_interpolation_points(indices,T_data, ref_line):
     T_proj = xa.DataArray(np.full((len(Tproj_lat), len(Tproj_lon)),1),dims=['lat','lon'],coords=[np.flip(Tproj_lat),np.flip(Tproj_lon)])
     T_proj = T_proj.to_dataset(name='T')
 
-    dist_listT = []
-    for k in range(len(Tprojx)-1):
-        distsT = prepro.distance(T_proj.lat[k],T_proj.lon[k],T_proj.lat[k+1],T_proj.lon[k+1])
-        dist_listT = np.append(dist_listT,distsT)
-    dist_lastT = prepro.distance(T_proj.lat[-2],T_proj.lon[-2],T_proj.lat[-1],T_proj.lon[-1])
-    dist_listT = np.append(dist_listT,dist_lastT)
-
-    T_proj_lat=T_proj.lat*dist_listT/dist_listT
-    T_proj_lat=T_proj_lat[~np.isnan(T_proj_lat)]
-    T_proj_lon=T_proj.lon*dist_listT/dist_listT
-    T_proj_lon=T_proj_lon[~np.isnan(T_proj_lon)]
-    
-    dist_listT_kurz2 = []
-    dist_firstT_kurz2 = prepro.distance(T_proj_lat[0],T_proj_lon[0],T_proj_lat[1],T_proj_lon[1])
-    dist_listT_kurz2 = np.append(dist_listT_kurz2,dist_firstT_kurz2)
-    for k in range(1,len(T_proj_lon)-1):      
-        distsT_kurz2 = prepro.distance(T_proj_lat[k-1],T_proj_lon[k-1],T_proj_lat[k],T_proj_lon[k])/2 + prepro.distance(T_proj_lat[k],T_proj_lon[k],T_proj_lat[k+1],T_proj_lon[k+1])/2
-        dist_listT_kurz2 = np.append(dist_listT_kurz2,distsT_kurz2)
-    dist_lastT_kurz2 = prepro.distance(T_proj_lat[-2],T_proj_lon[-2],T_proj_lat[-1],T_proj_lon[-1])
-    dist_listT_kurz2 = np.append(dist_listT_kurz2,dist_lastT_kurz2)
+    dist_listT,dist_listT_kurz2,T_proj_lat,T_proj_lon = calc_dx(T_proj)
 
     return T_proj,dist_listT*1000,dist_listT_kurz2*1000
 
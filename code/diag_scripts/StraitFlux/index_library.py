@@ -0,0 +1,99 @@
+'''
+Library of precomputed indices of the pre-defined straits (indices.def_indices) for the grids we run.
+
+Layout of the library:
+    manifest.json: {'version': version, 'grids': {fingerprint: {'name', 'models', 'shape', 'straits'}}}
+    <fingerprint>/<strait>_indices.nc: indices as returned by check_availability_indices
+
+The fingerprint is preprocessing.grid_fingerprint of the T grid (see preprocessing.file_fingerprint), indices are only taken for the
+exact grid they were calculated on; the models in the manifest are for information. The library is not shipped with entries, they are
+added with build on the grid files of the models we run, e.g. for HadGEM3-GC31-LL (ORCA1):
+    build(file_thetao,'ORCA1',['HadGEM3-GC31-LL'])
+arctic_eval does this for the straits and models of the transport recipe before the transports are calculated, so only the first
+run on a grid calculates the indices.
+'''
+
+import os
+import json
+import xarray as xa
+
+import StraitFlux.preprocessing as prepro
+from StraitFlux.indices import check_availability_indices, predefined_straits
+
+
+version = 1
+path_library = os.path.join(os.path.dirname(os.path.abspath(__file__)),'index_library')
+
+
+def read_manifest(path=path_library):
+    '''Read the manifest of the library at path, an empty one if there is none yet'''
+    try:
+        with open(os.path.join(path,'manifest.json'),'r') as f:
+            manifest = json.load(f)
+    except FileNotFoundError:
+        manifest = {'version':version,'grids':{}}
+    return manifest
+
+
+def lookup(strait,fingerprint,path=path_library):
+    '''
+    Indices of a pre-defined strait from the library
+
+    args:
+    strait (str): pre-defined strait (indices.predefined_straits)
+    fingerprint (str): fingerprint of the T grid (preprocessing.grid_fingerprint)
+
+    returns:
+    indices (xa.Dataset as returned by check_availability_indices), None if the strait is not in the library for this grid
+    '''
+    manifest = read_manifest(path)
+    if manifest['version'] != version:
+        print('index library has version '+str(manifest['version'])+', expected '+str(version)+'; skipping library')
+        return None
+    grid = manifest['grids'].get(fingerprint)
+    if grid is None or strait not in grid['straits']:
+        return None
+    with xa.open_dataset(os.path.join(path,fingerprint,strait+'_indices.nc')) as ds:
+        indices = ds.load()
+    print('indices of '+strait+' from library ('+grid['name']+')')
+    return indices
+
+
+def build(file_t,name,models,straits=predefined_straits,path=path_library,overwrite=False):
+    '''
+    Calculate the indices of straits on the grid of file_t and add them to the library. Straits already in the library for this grid
+    are kept (unless overwrite), so calling build on every run only reads the grid if a strait is missing; a library of another version
+    is replaced. The files are written with preprocessing.save_atomic, as several diagnostics may build at the same time.
+
+    args:
+    file_t (str): path + filename(s) of a temperature field on the grid; only the grid is read (preprocessing.probe_grid)
+    name (str): name of the grid, e.g. ORCA1
+    models (list): models on this grid, e.g. ['HadGEM3-GC31-LL']
+    straits (list): straits to add, default all pre-defined straits
+    overwrite (bool): recalculate straits already in the library
+
+    returns:
+    fingerprint (str) of the grid
+    '''
+    fingerprint = prepro.file_fingerprint(file_t)
+    manifest = read_manifest(path)
+    if manifest['version'] != version:
+        manifest = {'version':version,'grids':{}}
+    grid = manifest['grids'].get(fingerprint,{'name':name,'models':[],'shape':None,'straits':[]})
+    missing = [strait for strait in straits if overwrite or strait not in grid['straits']]
+    if not missing and set(models) <= set(grid['models']):
+        return fingerprint
+
+    if missing:
+        ti = prepro.probe_grid(file_t)
+        grid['shape'] = list(ti.lat.transpose('y','x').shape)
+        os.makedirs(os.path.join(path,fingerprint),exist_ok=True)
+        for strait in missing:
+            indices,line = check_availability_indices(ti,strait,name,0,0,0,False)
+            prepro.save_atomic(indices,os.path.join(path,fingerprint,strait+'_indices.nc'))
+
+    grid['models'] = sorted(set(grid['models'])|set(models))
+    grid['straits'] = sorted(set(grid['straits'])|set(straits))
+    manifest['grids'][fingerprint] = grid
+    prepro.save_atomic(json.dumps(manifest,indent=2,ensure_ascii=False),os.path.join(path,'manifest.json'))
+    return fingerprint
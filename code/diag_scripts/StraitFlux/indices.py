@@ -2,6 +2,7 @@ import os
 import xarray as xa
 import numpy as np
 import sys
+import StraitFlux.preprocessing as prepro
 
 def check_res(Tdataset):
     if np.abs(Tdataset.lon.min()-Tdataset.lon.max()) >= 358:
@@ -12,6 +13,9 @@ def check_res(Tdataset):
     return res
 
 
+# straits pre-defined in def_indices
+predefined_straits = ['Bering','Fram','Davis','Barents','RAPID','OSNAP','GSR','Makassar','Hudson','Hudson_NW','Färöer','Gibraltar','NIIC','IF','FS']
+
 def def_indices(strait,coords,lon_p,lat_p,set_latlon,res):
     if set_latlon == True:
         lon = lon_p
@@ -127,7 +131,7 @@ def distance(lat1,lon1,lat2,lon2):
 
 def selection_window(lat1,lon1,lat2,lon2,Tdataset):
     '''
-    This funtion selects the nearest point on Tgrid within a selection window with a size of +- 0.5 degrees around the first point on the reference curve.
+    This funtion selects the nearest point on Tgrid to the first point on the reference curve, using the KD-tree of the grid (preprocessing.nearest_points).
     args:
          Tdataset: xa.Dataset of Tdata on Tgrid 
          lat1,lon1 = pair of values on reference line
@@ -136,68 +140,46 @@ def selection_window(lat1,lon1,lat2,lon2,Tdataset):
          xloc: index of nearest x on Tgrid
          yloc: index of nearest y on Tgrid
     '''
-    delta=2
-    x1_x2 = np.where((lat2>(lat1-delta))&(lat2<(lat1+delta)),1,0)
-    y1_y2 = np.where((lon2>(lon1-delta))&(lon2<(lon1+delta)),1,0)
-    fenster = x1_x2 + y1_y2
-    fenster = np.where(fenster==2,1,0)
-    lat2 = (lat2 * fenster)
-    lon2 = (lon2 * fenster)
-    dist1 = distance(lat1,lon1,lat2,lon2)
+    loc = np.unravel_index(prepro.nearest_points(lat2,lon2,lat1,lon1),np.shape(lat2))
 
     if Tdataset.lat.dims[0] == 'x':
-        xloc,yloc = np.where(dist1==np.nanmin(dist1))
+        xloc,yloc = loc
     else:
-        yloc,xloc = np.where(dist1==np.nanmin(dist1))
+        yloc,xloc = loc
 
-    yloc=yloc[0]
-    xloc=xloc[0]
-    return xloc, yloc
+    return int(xloc), int(yloc)
 
-def select_points(Tdataset,xstart,ystart,lat_line_point,lon_line_point):
+def grid_walk(lat,lon,lat_line,lon_line,xstart,ystart):
     '''
-    This function test the neighboring grid boxes which index is the next one.
+    This function follows the reference line on the grid: for every point of the line the neighboring grid boxes (mid, above, under, left, right)
+    are tested and the one with the minimal distance to the line point is the next one.
     args:
-        Tdataset: xa.Dataset of Tdata on Tgrid
-        xstart: x index of point from where the neighboring boxes have to be checked
-        ystart: y index of point from where the neighhoring boxes have to be checked
-        lat_line_point: latitude of point at reference curve
-        lon_line_point: longitude of point at reference curve
+        lat, lon: np.arrays (y,x) of latitudes and longitudes on Tgrid
+        lat_line, lon_line: np.arrays of latitudes and longitudes of the reference line
+        xstart, ystart: x and y index of the grid point nearest to the first point of the reference line (see selection_window)
     returns:
-        xstart: x index of new next point
-        ystart: y index of new next point
+        indices: np.array (points,3) with x and y index of the selected grid point for every point of the reference line
     '''
-    # select adjoining points/gridboxes
-    mid = Tdataset.isel(x=xstart,y=ystart)
-    if ystart >= len(Tdataset.y)-1:
-        above = Tdataset.isel(x=xstart,y=ystart)
-    else:
-        above = Tdataset.isel(x=xstart,y=ystart+1)
-    under = Tdataset.isel(x=xstart,y=ystart-1)
-    left = Tdataset.isel(x=xstart-1,y=ystart)
-    right = Tdataset.isel(x=xstart+1,y=ystart)
-    # calculate distance:
-    mid_dist = distance(lat_line_point,lon_line_point,mid.lat.values,mid.lon.values)
-    abo_dist =  distance(lat_line_point,lon_line_point,above.lat.values,above.lon.values)
-    und_dist =  distance(lat_line_point,lon_line_point,under.lat.values,under.lon.values)
-    lef_dist =  distance(lat_line_point,lon_line_point,left.lat.values,left.lon.values)
-    rig_dist =  distance(lat_line_point,lon_line_point,right.lat.values,right.lon.values)
-    # select point with minmal distance:
-    testlist = list([mid_dist,abo_dist,und_dist,lef_dist,rig_dist])
-
-    min_pos = testlist.index(min(testlist))
-    
-    if min_pos == 0:
-        xstart,ystart = xstart,ystart
-    elif min_pos ==1:
-        xstart,ystart = xstart,ystart+1
-    elif min_pos ==2:
-        xstart,ystart = xstart,ystart-1
-    elif min_pos ==3:
-        xstart,ystart = xstart-1,ystart
-    elif min_pos ==4:
-        xstart,ystart = xstart+1,ystart
-    return xstart,ystart
+    ny,nx = np.shape(lat)
+    indices = np.zeros((len(lat_line),3))
+    indices[0,0],indices[0,1] = xstart,ystart
+    for i in range(1,len(lat_line)):
+        # adjoining points/gridboxes: mid, above (kept at the northern boundary), under, left, right
+        ys = np.array([ystart,min(ystart+1,ny-1),ystart-1,ystart,ystart])
+        xs = np.array([xstart,xstart,xstart,xstart-1,xstart+1])
+        dist = distance(lat_line[i],lon_line[i],lat[ys,xs%nx],lon[ys,xs%nx])
+        # select point with minimal distance (first one if equal):
+        min_pos = np.argmin(dist)
+        xstart,ystart = int(xs[min_pos]),int(ys[min_pos])
+        # to provide circle:
+        if xstart == nx-1:
+            xstart = 0
+        elif ystart == ny-1 and indices[i-1,1] == ny-1:
+            print('Attention: Strait crossing the northern boundary – make sure correct indices are chosen!')
+            xstart = nx-1-xstart
+        indices[i,0] = xstart
+        indices[i,1] = ystart
+    return indices
 
 
 def check_availability_indices(Tdataset,strait,model,coords,lon_p,lat_p,set_latlon):
@@ -210,24 +192,8 @@ def check_availability_indices(Tdataset,strait,model,coords,lon_p,lat_p,set_latl
 
 
     # first point of line:
-    start_lat, start_lon = line.isel(lat=0,lon=0).lat.values, line.isel(lat=0,lon=0).lon.values
-    indices = np.zeros((len(line.lon.values),3))######
-    for i in range(len(line.lon.values)):#####
-        if i == 0:
-            xstart,ystart =selection_window(start_lat,start_lon,Tdataset.lat.values,Tdataset.lon.values,Tdataset)
-            indices[i,0] = xstart
-            indices[i,1] = ystart
-        else:
-            xstart,ystart = select_points(Tdataset,xstart,ystart,line.lat[i].values,line.lon[i].values)
-            # to provide circle: 
-            if xstart == len(Tdataset.x)-1:
-                xstart = 0
-            elif ystart == len(Tdataset.y)-1 and indices[i-1,1] == len(Tdataset.y)-1:
-                print('Attention: Strait crossing the northern boundary – make sure correct indices are chosen!')
-                ystart = len(Tdataset.y)-1
-                xstart = len(Tdataset.x)-1-xstart
-            indices[i,0] = xstart
-            indices[i,1] = ystart
+    xstart,ystart = selection_window(lat[0],lon[0],Tdataset.lat.values,Tdataset.lon.values,Tdataset)
+    indices = grid_walk(Tdataset.lat.transpose('y','x').values,Tdataset.lon.transpose('y','x').values,line.lat.values,line.lon.values,xstart,ystart)
 
     # remove duplicates:
     row_mask = np.append([True],np.any(np.diff(indices,axis=0),1))
@@ -7,6 +7,7 @@ try:
 except ImportError:
     print('skipping matplotlib')
 import sys
+import os
 from functools import partial
 import time
 import xesmf as xe
@@ -20,8 +21,31 @@ import StraitFlux.preprocessing as prepro
 import StraitFlux.functions as func
 import StraitFlux.functions_VP as func2
 from StraitFlux.indices import check_availability_indices, prepare_indices
+import StraitFlux.index_library as index_library
 
-def vel_projection(strait,model,time_start,time_end,file_u,file_v,file_t,file_z,coords=0,set_latlon=False,lat_p=0,lon_p=0,path_save='',path_indices='',path_mesh='',Arakawa='',saving=True):
+_regridders = {}
+
+def get_regridder(ds_in,ds_out,strait,point,path_mesh='',saving=True,**kwargs):
+    '''
+    Bilinear xe.Regridder from ds_in to ds_out (kwargs are passed on to xe.Regridder). The weights are read from the weight file
+    under path_mesh (see functions.weights_file) or saved there, and the regridder is kept for later calls, so the weights are
+    calculated only once per grid, strait, grid point type and mask (levels with the same mask share their weights)
+    '''
+    file_w = func.weights_file(ds_in,ds_out,strait,point,path_mesh,options=str(sorted(kwargs.items())))
+    if file_w not in _regridders:
+        if os.path.exists(file_w):
+            _regridders[file_w] = xe.Regridder(ds_in,ds_out,'bilinear',reuse_weights=True,filename=file_w,**kwargs)
+        else:
+            _regridders[file_w] = xe.Regridder(ds_in,ds_out,'bilinear',**kwargs)
+            if saving == True:
+                prepro.save_atomic(_regridders[file_w],file_w)
+    return _regridders[file_w]
+
+def section_locstream(T_proj_points):
+    '''The section points (lat[m],lon[m]) of T_proj_points as a list of locations, to regrid onto with locstream_out=True'''
+    return xa.Dataset(coords={'lon':('locations',T_proj_points.lon.values),'lat':('locations',T_proj_points.lat.values)})
+
+def vel_projection(strait,model,time_start,time_end,file_u,file_v,file_t,file_z,coords=0,set_latlon=False,lat_p=0,lon_p=0,path_save='',path_indices='',path_mesh='',Arakawa='',saving=True,scheduler=None):
     '''
     This function calculates the u/v crossection by projecting the vectors onto the strait 
     by multiplying with the amount of the vector going through the strait and
@@ -46,26 +70,29 @@ def vel_projection(strait,model,time_start,time_end,file_u,file_v,file_t,file_z,
     path_save (str): path to save transport data
     path_indices (str): path to save indices data
     path_mesh (str): path to save mesh data
+    scheduler (str): if given, the fields are not loaded but a lazy dask graph is built and computed on this scheduler (threads, processes, synchronous or distributed for a local cluster)
 
     RETURNS:
     crosssection of currents at given section
 
     '''
     
-    partial_func = partial(prepro._preprocess1)
+    fingerprint = prepro.file_fingerprint(file_t)
 
     try:
-        indices=xa.open_dataset(path_indices+model+'_'+strait+'_indices.nc')
+        indices=xa.open_dataset(path_indices+fingerprint+'_'+strait+'_indices.nc')
     except OSError:
+        indices=None
+        if coords==0 and set_latlon==False:
+            indices=index_library.lookup(strait,fingerprint)
+            if indices is not None and saving == True:
+                prepro.save_atomic(indices,path_indices+fingerprint+'_'+strait+'_indices.nc')
+    if indices is None:
         print('calc indices')
         print('read and load files for indices')
-        ti = xa.open_mfdataset(file_t, preprocess=partial_func).isel(time=0)
-        ui = xa.open_mfdataset(file_u, preprocess=partial_func).isel(time=0)
-        vi = xa.open_mfdataset(file_v, preprocess=partial_func).isel(time=0)
-        with ProgressBar():
-            ti=ti.load()
-            ui=ui.load()
-            vi=vi.load()
+        ti = prepro.probe_grid(file_t)
+        ui = prepro.probe_grid(file_u)
+        vi = prepro.probe_grid(file_v)
         indices,line = check_availability_indices(ti,strait,model,coords,lon_p,lat_p,set_latlon)
         i2=indices.indices.where(indices.indices!=0) 
         try:
@@ -79,32 +106,21 @@ def vel_projection(strait,model,time_start,time_end,file_u,file_v,file_t,file_z,
             plt.close()
         except NameError:
             print('skipping Plot')
-        indices.to_netcdf(path_indices+model+'_'+strait+'_indices.nc')
+        prepro.save_atomic(indices,path_indices+fingerprint+'_'+strait+'_indices.nc')
 
     #######
     if Arakawa in ['Arakawa-A','Arakawa-B','Arakawa-C']:
         grid=Arakawa
     elif Arakawa == '':
         try:
-            file = open(path_mesh+model+'grid.txt', 'r')
+            file = open(path_mesh+fingerprint+'grid.txt', 'r')
             grid= file.read()
         except OSError:
-            partial_func = partial(prepro._preprocess1)
-            ti = xa.open_mfdataset(file_t, preprocess=partial_func).isel(time=0)
-            ui = xa.open_mfdataset(file_u, preprocess=partial_func).isel(time=0)
-            vi = xa.open_mfdataset(file_v, preprocess=partial_func).isel(time=0)
-            try:
-                with ProgressBar():
-                    ti=ti.load()
-                    ui=ui.load()
-                    vi=vi.load()
-            except NameError:
-                ti=ti.load()
-                ui=ui.load()
-                vi=vi.load()
+            ti = prepro.probe_grid(file_t)
+            ui = prepro.probe_grid(file_u)
+            vi = prepro.probe_grid(file_v)
             grid = func.check_Arakawa(ui,vi,ti,model)
-            with open(path_mesh+model+'grid.txt', 'w') as f:
-                f.write(grid)
+            prepro.save_atomic(grid,path_mesh+fingerprint+'grid.txt')
     else:
         print('grid not known')
         sys.exit()
@@ -127,13 +143,9 @@ def vel_projection(strait,model,time_start,time_end,file_u,file_v,file_t,file_z,
             u_data=ui
             v_data=vi
         except NameError:      
-            T_data = xa.open_mfdataset(file_t, preprocess=partial_func).isel(time=0)
-            u_data = xa.open_mfdataset(file_u, preprocess=partial_func).isel(time=0)
-            v_data = xa.open_mfdataset(file_v, preprocess=partial_func).isel(time=0)
-            with ProgressBar():
-                T_data=T_data.load()
-                u_data=u_data.load()
-                v_data=v_data.load()
+            T_data = prepro.probe_grid(file_t)
+            u_data = prepro.probe_grid(file_u)
+            v_data = prepro.probe_grid(file_v)
         start = time.time()
         indices,ref_line=check_availability_indices(T_data,strait,model,coords,lon_p,lat_p,set_latlon)
         end = time.time()
@@ -180,52 +192,49 @@ def vel_projection(strait,model,time_start,time_end,file_u,file_v,file_t,file_z,
     if 'time' in deltaz.dims:
         deltaz=deltaz.sel(time=slice(str(time_start),str(time_end)))
 
-    print('load t, u and v fields')
-    with ProgressBar():
-        t=t.load()
-        u=u.load()
-        v=v.load()
-        deltaz=deltaz.load()
+    if scheduler is None:
+        print('load t, u and v fields')
+        with ProgressBar():
+            t=t.load()
+            u=u.load()
+            v=v.load()
+            deltaz=deltaz.load()
         
         
-    dzu3,dzv3 = func.calc_dz_faces(deltaz,grid,model,path_mesh)
+    dzu3,dzv3 = func.calc_dz_faces(deltaz,grid,model,path_mesh,saving=saving)
     
     start = time.time()
     print('calculating regridder')
-    regridder_u=xe.Regridder(u,T_proj_points,'bilinear',ignore_degenerate=True)
-    regridder_v=xe.Regridder(v,T_proj_points,'bilinear',ignore_degenerate=True)
+    locs=section_locstream(T_proj_points)
+    regridder_u=get_regridder(u,locs,strait,'u',path_mesh,saving=saving,locstream_out=True,ignore_degenerate=True)
+    regridder_v=get_regridder(v,locs,strait,'v',path_mesh,saving=saving,locstream_out=True,ignore_degenerate=True)
     end = time.time()
     print(end - start)    
-    u_beitrag = np.zeros((len(u.time),len(u.lev),len(T_proj_points.lat))) # time,z=75,x=coords of strait
-    v_beitrag = np.zeros((len(u.time),len(u.lev),len(T_proj_points.lat)))
-
-    u_trans = np.zeros((len(u.time),len(u.lev),len(u.y),len(u.x)))
-    v_trans = np.zeros((len(u.time),len(u.lev),len(u.y),len(u.x)))
     start = time.time()
-    for i in range(len(un)):
-        if 'time' in deltaz.dims:
-            u_trans[:,:,int(un[i,1]-min_y+2),int(un[i,0]-min_x+2)]=u.uo[:,:,int(un[i,1]-min_y+2),int(un[i,0]-min_x+2)]*dzu3[:,:,int(un[i,1]-min_y+2),int(un[i,0]-min_x+2)].values*betrag_u[i]*tu[i]#
-            v_trans[:,:,int(un[i,1]-min_y+2),int(un[i,0]-min_x+2)]=v.vo[:,:,int(un[i,1]-min_y+2),int(un[i,0]-min_x+2)]*dzv3[:,:,int(un[i,1]-min_y+2),int(un[i,0]-min_x+2)].values*betrag_v[i]*tv[i]        
-        else:
-            u_trans[:,:,int(un[i,1]-min_y+2),int(un[i,0]-min_x+2)]=u.uo[:,:,int(un[i,1]-min_y+2),int(un[i,0]-min_x+2)]*dzu3[:,int(un[i,1]-min_y+2),int(un[i,0]-min_x+2)].values*betrag_u[i]*tu[i]#
-            v_trans[:,:,int(un[i,1]-min_y+2),int(un[i,0]-min_x+2)]=v.vo[:,:,int(un[i,1]-min_y+2),int(un[i,0]-min_x+2)]*dzv3[:,int(un[i,1]-min_y+2),int(un[i,0]-min_x+2)].values*betrag_v[i]*tv[i]#
+    #projection factors at the section points, zero elsewhere
+    ju=(un[:,1]-min_y+2).astype(int)
+    iu=(un[:,0]-min_x+2).astype(int)
+    points=np.zeros((len(u.y),len(u.x)),dtype=bool)
+    fac_u=np.zeros((2,len(u.y),len(u.x)))
+    fac_v=np.zeros((2,len(u.y),len(u.x)))
+    points[ju,iu]=True
+    fac_u[0,ju,iu],fac_u[1,ju,iu]=betrag_u[:len(un)],tu[:len(un)]
+    fac_v[0,ju,iu],fac_v[1,ju,iu]=betrag_v[:len(un)],tv[:len(un)]
+    points=xa.DataArray(points,dims=('y','x'))
 
-    
-    
-    u['uo'][:,:,:,:]=u_trans[:,:,:,:]#
-    v['vo'][:,:,:,:]=v_trans[:,:,:,:]#
+    u_trans=(u.uo*dzu3.values*fac_u[0]*fac_u[1]).where(points,0.).astype(u.uo.dtype)
+    v_trans=(v.vo*dzv3.values*fac_v[0]*fac_v[1]).where(points,0.).astype(v.vo.dtype)
     end = time.time()
     print(end - start) 
     print('regridding')
     start = time.time()
-    u_l=regridder_u(u.uo.fillna(0))#
-    v_l=regridder_v(v.vo.fillna(0))#
+    u_l=regridder_u(u_trans.fillna(0))#
+    v_l=regridder_v(v_trans.fillna(0))#
+    beitrag=func.compute(xa.Dataset({'u':u_l,'v':v_l}),scheduler)
+    u_beitrag=np.asarray(beitrag.u.transpose('time','lev','locations').values,dtype=float)
+    v_beitrag=np.asarray(beitrag.v.transpose('time','lev','locations').values,dtype=float)
     end = time.time()
     print(end - start) 
-    for m in range(len(u_l.lat)):
-        for k in range(len(u.lev)):
-            u_beitrag[:,k,m] = u_l[:,k].isel(lat=m,lon=m).values
-            v_beitrag[:,k,m] = v_l[:,k].isel(lat=m,lon=m).values
             
     gesamt=np.where(np.isnan(u_beitrag),0,u_beitrag)+np.where(np.isnan(v_beitrag),0,v_beitrag)
     dz2=np.gradient(u.lev)
@@ -266,15 +275,19 @@ def TS_interp(product,strait,model,time_start,time_end,file_u,file_t,file_s='',c
 
     '''
     
-    partial_func = partial(prepro._preprocess1)
+    fingerprint = prepro.file_fingerprint(file_t)
     try:
-        indices=xa.open_dataset(path_indices+model+'_'+strait+'_indices.nc')
+        indices=xa.open_dataset(path_indices+fingerprint+'_'+strait+'_indices.nc')
     except OSError:
+        indices=None
+        if coords==0 and set_latlon==False:
+            indices=index_library.lookup(strait,fingerprint)
+            if indices is not None and saving == True:
+                prepro.save_atomic(indices,path_indices+fingerprint+'_'+strait+'_indices.nc')
+    if indices is None:
         print('calc indices')
         print('read and load files for indices')
-        ti = xa.open_mfdataset(file_t, preprocess=partial_func).isel(time=0)
-        with ProgressBar():
-            ti=ti.load()
+        ti = prepro.probe_grid(file_t)
         indices,line = check_availability_indices(ti,strait,model,coords,lon_p,lat_p,set_latlon)
         i2=indices.indices.where(indices.indices!=0) 
         try:
@@ -288,7 +301,7 @@ def TS_interp(product,strait,model,time_start,time_end,file_u,file_t,file_s='',c
             plt.close()
         except NameError:
             print('skipping Plot')
-        indices.to_netcdf(path_indices+model+'_'+strait+'_indices.nc')
+        prepro.save_atomic(indices,path_indices+fingerprint+'_'+strait+'_indices.nc')
         
     out_u,out_v,out_u_vz = prepare_indices(indices)
     min_x=np.nanmin((min(out_u[:,0],default=np.nan),min(out_v[:,0],default=np.nan)))
@@ -309,9 +322,7 @@ def TS_interp(product,strait,model,time_start,time_end,file_u,file_t,file_s='',c
         try:
             T_data=ti
         except NameError:      
-            T_data = xa.open_mfdataset(file_t, preprocess=partial_func).isel(time=0)
-            with ProgressBar():
-                T_data=T_data.load()
+            T_data = prepro.probe_grid(file_t)
         start = time.time()
         indices,ref_line=check_availability_indices(T_data,strait,model,coords,lon_p,lat_p,set_latlon)
         T_proj_points,dist_listT,dist_listT_kurz2=func2.calc_interpolation_points(indices,T_data, ref_line)
@@ -339,36 +350,27 @@ def TS_interp(product,strait,model,time_start,time_end,file_u,file_t,file_s='',c
         t['mask'] = t.so[0]/t.so[0]
         t['mask'] = xa.where(~np.isnan(t['mask']),1,0)
     
+    locs=section_locstream(T_proj_points)
     regridder=[]
     print('calculating regridder')
     for s in tqdm(range(len(t.lev))):
-        regridder_T=xe.Regridder(t.isel(lev=s),T_proj_points,'bilinear',ignore_degenerate=True,extrap_method='nearest_s2d')
+        regridder_T=get_regridder(t.isel(lev=s),locs,strait,'T',path_mesh,saving=saving,locstream_out=True,ignore_degenerate=True,extrap_method='nearest_s2d')
         regridder=np.append(regridder,regridder_T)
     
-    T_beitrag2 = np.zeros((len(t.time),len(t.lev),len(T_proj_points.lat),len(T_proj_points.lat)))
+    T_beitrag = np.zeros((len(t.time),len(t.lev),len(T_proj_points.lat)))
     
     print('regridding')
     if product == 'T':
         for s in range(len(t.lev)):
-            T_beitrag2[:,s,:,:] = regridder[s](t['thetao'].isel(lev=s))
+            T_beitrag[:,s,:] = regridder[s](t['thetao'].isel(lev=s)).transpose('time','locations')
     elif product == 'S':
         for s in range(len(t.lev)):
-            T_beitrag2[:,s,:,:] = regridder[s](t['so'].isel(lev=s))
-        
-    T_beitrag = np.zeros((len(t.time),len(t.lev),len(T_proj_points.lat)))
-    
-    for j in range(len(T_proj_points.lat)):
-        for k in range(len(t.lev)): ##75
-            T_beitrag[:,k,j] = T_beitrag2[:,k,j,j]
+            T_beitrag[:,s,:] = regridder[s](t['so'].isel(lev=s)).transpose('time','locations')
 
             
     ## Mask same as for uv profiles:
-    M_beitrag = np.zeros((len(t.lev),len(T_proj_points.lat)))
-    regridder_M=xe.Regridder(u,T_proj_points,'bilinear',ignore_degenerate=True)
-    M=regridder_M(u.uo.fillna(0))
-    for m in range(len(M.lat)):
-        for k in range(len(M.lev)):
-            M_beitrag[k,m] = M[k].isel(lat=m,lon=m).values
+    regridder_M=get_regridder(u,locs,strait,'u',path_mesh,saving=saving,locstream_out=True,ignore_degenerate=True)
+    M_beitrag=regridder_M(u.uo.fillna(0)).transpose('lev','locations').values
     if product == 'T':            
         T_tot = xa.Dataset({'T':(('time','depth','x'),T_beitrag*(M_beitrag/M_beitrag))},coords=dict(time=t.time,depth=t.lev.data,x=np.cumsum(dist_listT_kurz2)))
         T_tot.to_netcdf(path_save+strait+'_crosssection_T_'+model+'_'+str(time_start)+'-'+str(time_end)+'.nc')
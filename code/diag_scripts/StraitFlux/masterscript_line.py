@@ -7,6 +7,7 @@ try:
 except ImportError:
     print('skipping matplotlib')
 import sys
+import hashlib
 from functools import partial
 import time
 try:
@@ -18,11 +19,13 @@ from xmip.preprocessing import rename_cmip6, promote_empty_dims, broadcast_lonla
 import StraitFlux.preprocessing as prepro
 import StraitFlux.functions as func
 from StraitFlux.indices import check_availability_indices, prepare_indices
+from StraitFlux.section_operator import SectionOperator, face_widths
+import StraitFlux.index_library as index_library
 
 
 
 
-def transports(product,strait,model,time_start,time_end,file_u,file_v,file_t,file_z,mesh_dxv=0, mesh_dyu=0,coords=0,set_latlon=False,lon_p=0,lat_p=0,file_s='',file_sic='',file_sit='',Arakawa='',rho=1026,cp=3996, Tref=0,path_save='',path_indices='',path_mesh='',saving=True):
+def transports(product,strait,model,time_start,time_end,file_u,file_v,file_t,file_z,mesh_dxv=0, mesh_dyu=0,coords=0,set_latlon=False,lon_p=0,lat_p=0,file_s='',file_sic='',file_sit='',Arakawa='',rho=1026,cp=3996, Tref=0,path_save='',path_indices='',path_mesh='',saving=True,time_chunk=None,scheduler=None,mesh_subdomain=False,mesh_dtype=None):
 
     '''Calculation of Transports using line integration
 
@@ -53,6 +56,10 @@ def transports(product,strait,model,time_start,time_end,file_u,file_v,file_t,fil
     path_save (str): path to save transport data
     path_indices (str): path to save indices data
     path_mesh (str): path to save mesh data
+    time_chunk (int): number of time steps loaded and processed at once; default None loads the whole period
+    scheduler (str): if given, the fields are not loaded but a lazy dask graph is built and computed on this scheduler (threads, processes, synchronous or distributed for a local cluster); only thkcello is read beforehand on the subdomain, to calculate dz at the cell faces (functions.calc_dz_faces)
+    mesh_subdomain (bool): calculate the horizontal meshes only on the subdomain of the strait instead of the whole grid
+    mesh_dtype (str): dtype of calculated horizontal meshes, e.g. 'float32' for very large grids
 
 
     RETURNS:
@@ -60,27 +67,278 @@ def transports(product,strait,model,time_start,time_end,file_u,file_v,file_t,fil
 
     '''
 
+    trans = transports_multi([product],strait,model,time_start,time_end,file_u,file_v,file_t,file_z,mesh_dxv=mesh_dxv,mesh_dyu=mesh_dyu,coords=coords,set_latlon=set_latlon,lon_p=lon_p,lat_p=lat_p,file_s=file_s,file_sic=file_sic,file_sit=file_sit,Arakawa=Arakawa,rho=rho,cp=cp,Tref=Tref,path_save=path_save,path_indices=path_indices,path_mesh=path_mesh,saving=saving,time_chunk=time_chunk,scheduler=scheduler,mesh_subdomain=mesh_subdomain,mesh_dtype=mesh_dtype)
 
-    partial_func = partial(prepro._preprocess1)
+    return trans[[product]].rename({product:model})
 
 
+def transports_multi(products,strait,model,time_start,time_end,file_u,file_v,file_t,file_z,mesh_dxv=0, mesh_dyu=0,coords=0,set_latlon=False,lon_p=0,lat_p=0,file_s='',file_sic='',file_sit='',Arakawa='',rho=1026,cp=3996, Tref=0,path_save='',path_indices='',path_mesh='',saving=True,time_chunk=None,scheduler=None,mesh_subdomain=False,mesh_dtype=None):
+
+    '''Calculation of several transports using line integration, reading the strait subdomain only once
+
+    INPUT Parameters:
+    products (list): any of volume, heat, salt or ice, e.g. ['volume','heat','salt']
+    all other parameters as in transports
+
+    RETURNS:
+    xa.Dataset with one variable per product containing the transports through specified strait for specified model
+    each product is also saved to the same file as written by transports
+
+    '''
+
+    indices,grid,mu,mv = prepare_section(strait,model,file_u,file_v,file_t,mesh_dxv=mesh_dxv,mesh_dyu=mesh_dyu,coords=coords,set_latlon=set_latlon,lon_p=lon_p,lat_p=lat_p,Arakawa=Arakawa,path_save=path_save,path_indices=path_indices,path_mesh=path_mesh,saving=saving,mesh_subdomain=mesh_subdomain,mesh_dtype=mesh_dtype)
+    out_u,out_v,out_u_vz = prepare_indices(indices)
+    min_x,max_x,min_y,max_y = section_bounds(out_u,out_v)
+
+    fields = open_subdomain(products,file_u,file_v,file_t,file_z,file_s,mu,mv,(min_x,max_x,min_y,max_y),time_start,time_end)
+    trans = []
+    for chunk in time_chunks(fields,time_chunk):
+        if scheduler is None:
+            chunk = load_fields(chunk)
+        chunk = transform_subdomain(products,chunk,grid,model,path_mesh,saving=saving and (time_chunk is None or 'time' not in chunk['deltaz'].dims))
+        trans.append(func.compute(integrate_products(products,strait,prepro.file_fingerprint(file_t),indices,chunk,min_x,min_y,rho=rho,cp=cp,Tref=Tref,path_indices=path_indices,saving=saving),scheduler))
+    trans = xa.concat(trans,dim='time')
+    save_transports(trans,strait,model,time_start,time_end,path_save)
+
+    return trans
+
+
+def transports_straits(products,straits,model,time_start,time_end,file_u,file_v,file_t,file_z,mesh_dxv=0, mesh_dyu=0,file_s='',file_sic='',file_sit='',Arakawa='',rho=1026,cp=3996, Tref=0,path_save='',path_indices='',path_mesh='',saving=True,merge_factor=4,time_chunk=None,scheduler=None,mesh_dtype=None):
+
+    '''Calculation of transports through several pre-defined straits, sharing the data reads between straits
+
+    The indices of all straits are calculated first. Straits whose bounding boxes lie close together are merged
+    into one subdomain (see group_sections), which is then read, loaded and transformed only once.
+
+    INPUT Parameters:
+    products (list): any of volume, heat, salt or ice, e.g. ['volume','heat','salt']
+    straits (list): pre-defined straits from indices file, e.g. ['Fram','Barents','Bering']
+    merge_factor (int or float): two boxes are merged if their union is at most merge_factor times their summed area
+    time_chunk (int): number of time steps loaded and processed at once; default None loads the whole period
+    scheduler (str): dask scheduler for a lazy calculation, see transports
+    mesh_dtype (str): dtype of calculated horizontal meshes, see transports; the meshes are always calculated on the whole grid, as the merged subdomains share them
+    all other parameters as in transports
+
+    RETURNS:
+    dict with one xa.Dataset per strait as returned by transports_multi
+
+    '''
+
+    sections = {}
+    for strait in straits:
+        indices,grid,mu,mv = prepare_section(strait,model,file_u,file_v,file_t,mesh_dxv=mesh_dxv,mesh_dyu=mesh_dyu,Arakawa=Arakawa,path_save=path_save,path_indices=path_indices,path_mesh=path_mesh,saving=saving,mesh_dtype=mesh_dtype)
+        out_u,out_v,out_u_vz = prepare_indices(indices)
+        sections[strait] = {'indices':indices,'bounds':section_bounds(out_u,out_v),'grid':grid,'mu':mu,'mv':mv}
+
+    trans = {}
+    for box,members in group_sections({strait:sections[strait]['bounds'] for strait in straits},merge_factor=merge_factor):
+        print('reading subdomain for '+', '.join(members))
+        grid,mu,mv = [sections[members[0]][key] for key in ['grid','mu','mv']]
+        fields = open_subdomain(products,file_u,file_v,file_t,file_z,file_s,mu,mv,box,time_start,time_end)
+        chunks = {strait:[] for strait in members}
+        for chunk in time_chunks(fields,time_chunk):
+            if scheduler is None:
+                chunk = load_fields(chunk)
+            chunk = transform_subdomain(products,chunk,grid,model,path_mesh,saving=saving and (time_chunk is None or 'time' not in chunk['deltaz'].dims))
+            for strait in members:
+                chunks[strait].append(func.compute(integrate_products(products,strait,prepro.file_fingerprint(file_t),sections[strait]['indices'],chunk,box[0],box[2],rho=rho,cp=cp,Tref=Tref,path_indices=path_indices,saving=saving),scheduler))
+        for strait in members:
+            trans[strait] = xa.concat(chunks[strait],dim='time')
+            save_transports(trans[strait],strait,model,time_start,time_end,path_save)
+
+    return trans
+
+
+def group_sections(bounds,merge_factor=4):
+    '''
+    This function merges the bounding boxes of several sections into as few subdomains as sensible.
+    args:
+        bounds: dict of strait: (min_x,max_x,min_y,max_y)
+        merge_factor: two boxes are merged if their union is at most merge_factor times their summed area
+    returns:
+        list of ((min_x,max_x,min_y,max_y), [straits]) with one entry per subdomain to read
+    '''
+    def area(b):
+        return (b[1]-b[0]+3)*(b[3]-b[2]+3)
+
+    boxes = [[tuple(bounds[strait]),[strait]] for strait in bounds]
+    merged = True
+    while merged:
+        merged = False
+        for i in range(len(boxes)):
+            for j in range(i+1,len(boxes)):
+                bi,bj = boxes[i][0],boxes[j][0]
+                union = (min(bi[0],bj[0]),max(bi[1],bj[1]),min(bi[2],bj[2]),max(bi[3],bj[3]))
+                if area(union) <= merge_factor*(area(bi)+area(bj)):
+                    boxes[i] = [union,boxes[i][1]+boxes[j][1]]
+                    del boxes[j]
+                    merged = True
+                    break
+            if merged:
+                break
+    return [(box,members) for box,members in boxes]
+
+
+def open_subdomain(products,file_u,file_v,file_t,file_z,file_s,mu,mv,bounds,time_start,time_end):
+    '''Open t, u, v, thkcello (and so if salt is requested) lazily and the meshes on the subdomain bounds=(min_x,max_x,min_y,max_y)'''
+    min_x,max_x,min_y,max_y = bounds
+
+    print('read t, u and v fields')
+    partial_func = partial(prepro._preprocess2,lon_bnds=(int(min_x)-1,int(max_x)+1),lat_bnds=(int(min_y)-1,int(max_y)+1))
+    t = xa.open_mfdataset(file_t, preprocess=partial_func,chunks={'time':1})
+    u = xa.open_mfdataset(file_u, preprocess=partial_func,chunks={'time':1})
+    v = xa.open_mfdataset(file_v, preprocess=partial_func,chunks={'time':1})
+    if 'time' in t.dims and t.dims['time'] > 1:
+        t=t.sel(time=slice(str(time_start),str(time_end)))
+        u=u.sel(time=slice(str(time_start),str(time_end)))
+        v=v.sel(time=slice(str(time_start),str(time_end)))
+    elif 'time' not in t.dims:
+        t=t.expand_dims(dim={"time": 1})
+        u=u.expand_dims(dim={"time": 1})
+        v=v.expand_dims(dim={"time": 1})
+    deltaz = xa.open_mfdataset(file_z, preprocess=partial_func,chunks={'time':1})[['thkcello']]
+    if 'time' in deltaz.dims:
+        deltaz=deltaz.sel(time=slice(str(time_start),str(time_end)))
+    mu=mu.sel(x=slice(int(min_x)-1,int(max_x)+1),y=slice(int(min_y)-1,int(max_y)+1)).load()
+    mv=mv.sel(x=slice(int(min_x)-1,int(max_x)+1),y=slice(int(min_y)-1,int(max_y)+1)).load()
+
+    fields = {'t':t,'u':u,'v':v,'deltaz':deltaz,'mu':mu,'mv':mv}
+    if 'salt' in products:
+        fields['S'] = xa.open_mfdataset(file_s, preprocess=partial_func,chunks={'time':1}).sel(time=slice(str(time_start),str(time_end)))
+    return fields
+
+
+def time_chunks(fields,time_chunk=None):
+    '''Split the (lazy) fields of open_subdomain into pieces of time_chunk time steps, fields without time (meshes, constant thkcello) are shared by all pieces'''
+    ntime = fields['t'].sizes['time']
+    if time_chunk is None or time_chunk >= ntime:
+        yield fields
+        return
+    for start in range(0,ntime,int(time_chunk)):
+        yield {key:(field.isel(time=slice(start,start+int(time_chunk))) if 'time' in field.dims else field) for key,field in fields.items()}
+
+
+def load_fields(fields):
+    '''Load the fields of open_subdomain (or one piece of time_chunks) into memory'''
+    print('load t, u and v fields')
+    try:
+        with ProgressBar():
+            fields = {key:field.load() for key,field in fields.items()}
+    except NameError:
+        fields = {key:field.load() for key,field in fields.items()}
+    return fields
+
+
+def transform_subdomain(products,fields,grid,model,path_mesh,saving=True):
+    '''Calculate dz at the cell faces and transform u to the Arakawa-C grid on a loaded subdomain, results are added to fields'''
+    dzu3,dzv3 = func.calc_dz_faces(fields['deltaz'],grid,model,path_mesh,saving=saving)
+    fields['dzu3'],fields['dzv3'] = dzu3,dzv3
+
+    if any(product in ['volume','heat','salt'] for product in products):
+        udata_C,vdata2,dzu3,dzv3,mu2,mv2 = func.transform_Arakawa(grid,fields['mu'],fields['mv'],fields['deltaz'],dzu3,dzv3,fields['u'].uo,fields['v'].vo)
+        fields['udata_C'],fields['dzu3'],fields['dzv3'],fields['mu2'],fields['mv2'] = udata_C,dzu3,dzv3,mu2,mv2
+    return fields
+
+
+def integrate_products(products,strait,fingerprint,indices,fields,min_x,min_y,rho=1026,cp=3996,Tref=0,path_indices='',saving=True):
+    '''Line integration of the requested products through one strait, min_x and min_y give the origin of the loaded subdomain and
+    fingerprint the grid (preprocessing.file_fingerprint of file_t) the section operator is saved for'''
+    out_u,out_v,out_u_vz = prepare_indices(indices)
+    sign_v = calc_sign_v(indices)
+    gather = line_gather(indices,out_u,out_u_vz,sign_v,min_x,min_y)
+
+    print(' ...calculating transport')
+    vdata = fields['v'].vo
+    Tdata = fields['t']
+    if any(product in ['volume','heat','salt'] for product in products):
+        operator = section_operator(strait,fingerprint,gather,fields,min_x,min_y,path_indices=path_indices,saving=saving)
+        udata = fields['udata_C']
+
+    trans = xa.Dataset(coords=dict(time=Tdata.time))
+    for product in products:
+        print('calc line')
+        if product == 'volume':
+            summ = operator.apply(udata,vdata,min_x=min_x,min_y=min_y)
+
+        if product == 'heat':
+            summ = operator.apply(udata,vdata,tracer=Tdata.thetao-Tref,min_x=min_x,min_y=min_y) * rho * cp
+
+        if product == 'salt':
+            summ = operator.apply(udata,vdata,tracer=fields['S'].so,min_x=min_x,min_y=min_y) * rho
+
+        if product == 'ice':
+            mu,mv = fields['mu'],fields['mv']
+            print('calc u')
+            udata_p=fields['u'].uo*mu.dyu.values*sit.sithick.values*sic.siconc.values
+            print('calc v')
+            vdata_p=vdata*mv.dxv.values*sit.sithick.values*sic.siconc.values
+            summ = (['time'],line_integration(udata_p.fillna(0.),vdata_p.fillna(0.),gather,product=product,rho=rho,cp=cp))
+
+        trans[product] = summ
+
+    return trans
+
+
+def save_transports(trans,strait,model,time_start,time_end,path_save=''):
+    '''Save each product of trans (as returned by integrate_products) to its own file, with the variable named after the model'''
+    for product in trans.data_vars:
+        trans[[product]].rename({product:model}).to_netcdf(path_save+strait+'_'+product+'_'+model+'_'+str(time_start)+'-'+str(time_end)+'.nc')
+
+
+def section_operator(strait,fingerprint,gather,fields,min_x,min_y,path_indices='',saving=True):
+    '''
+    Read the SectionOperator of a strait saved next to its indices, or build it from the loaded subdomain if it is missing or does not fit.
+    The file is keyed by the grid fingerprint and a hash of the cell widths at the section points and of the cell thicknesses at the
+    faces; operators of a time varying thkcello only hold the times of the current time chunk and are therefore not saved.
+    '''
+    if 'time' in fields['dzu3'].dims:
+        print('calc section operator')
+        return SectionOperator.from_fields(gather,fields['mu2'],fields['mv2'],fields['dzu3'],fields['dzv3'],min_x,min_y)
+    zhash = hashlib.sha1()
+    for values in face_widths(gather,fields['mu2'],fields['mv2'])+(fields['dzu3'].values,fields['dzv3'].values):
+        zhash.update(np.ascontiguousarray(values))
+    file_op = path_indices+fingerprint+'_'+strait+'_'+zhash.hexdigest()[:16]+'_operator.nc'
     try:
-        indices=xa.open_dataset(path_indices+model+'_'+strait+'_indices.nc')
+        operator = SectionOperator.from_file(file_op)
+        if operator.matches(gather,min_x,min_y):
+            return operator
+    except FileNotFoundError:
+        pass
+    print('calc section operator')
+    operator = SectionOperator.from_fields(gather,fields['mu2'],fields['mv2'],fields['dzu3'],fields['dzv3'],min_x,min_y)
+    if saving == True:
+        prepro.save_atomic(operator,file_op)
+    return operator
+
+
+def prepare_section(strait,model,file_u,file_v,file_t,mesh_dxv=0, mesh_dyu=0,coords=0,set_latlon=False,lon_p=0,lat_p=0,Arakawa='',path_save='',path_indices='',path_mesh='',saving=True,mesh_subdomain=False,mesh_dtype=None):
+
+    '''Read or calculate the indices of a strait, the Arakawa grid type and the horizontal meshes
+
+    INPUT Parameters as in transports
+
+    RETURNS:
+    indices (xa.Dataset), grid (str), mu and mv (xa.Dataset with dyu and dxv on the full grid)
+
+    '''
+
+    fingerprint = prepro.file_fingerprint(file_t)
+
+
+    try:
+        indices=xa.open_dataset(path_indices+fingerprint+'_'+strait+'_indices.nc')
     except OSError:
+        indices=None
+        if coords==0 and set_latlon==False:
+            indices=index_library.lookup(strait,fingerprint)
+            if indices is not None and saving == True:
+                prepro.save_atomic(indices,path_indices+fingerprint+'_'+strait+'_indices.nc')
+    if indices is None:
         print('calc indices')
         print('read and load files for indices')
-        ti = xa.open_mfdataset(file_t, preprocess=partial_func).isel(time=0)
-        ui = xa.open_mfdataset(file_u, preprocess=partial_func).isel(time=0)
-        vi = xa.open_mfdataset(file_v, preprocess=partial_func).isel(time=0)
-        try:
-            with ProgressBar():
-                ti=ti.load()
-                ui=ui.load()
-                vi=vi.load()
-        except NameError:
-            ti=ti.load()
-            ui=ui.load()
-            vi=vi.load()
+        ti = prepro.probe_grid(file_t)
+        ui = prepro.probe_grid(file_u)
+        vi = prepro.probe_grid(file_v)
         indices,line = check_availability_indices(ti,strait,model,coords,lon_p,lat_p,set_latlon)
         i2=indices.indices.where(indices.indices!=0)
         try:
@@ -95,120 +353,74 @@ def transports(product,strait,model,time_start,time_end,file_u,file_v,file_t,fil
         except NameError:
             print('skipping Plot')
         out_u,out_v,out_u_vz = prepare_indices(indices)
-        if product == 'ice':
-            func.check_indices(indices,out_u,out_v,ti,ui,vi,strait,model,path_save)
-        else:
-            func.check_indices(indices,out_u,out_v,ti,ui,vi,strait,model,path_save)
+        func.check_indices(indices,out_u,out_v,ti,ui,vi,strait,model,path_save)
         if saving == True:
-            indices.to_netcdf(path_indices+model+'_'+strait+'_indices.nc')
+            prepro.save_atomic(indices,path_indices+fingerprint+'_'+strait+'_indices.nc')
 
-    out_u,out_v,out_u_vz = prepare_indices(indices)
     if Arakawa in ['Arakawa-A','Arakawa-B','Arakawa-C']:
         grid=Arakawa
     elif Arakawa == '':
         try:
-            file = open(path_mesh+model+'grid.txt', 'r')
+            file = open(path_mesh+fingerprint+'grid.txt', 'r')
             grid= file.read()
         except OSError:
             try:
                 grid = func.check_Arakawa(ui,vi,ti,model)
                 if saving == True:
-                    with open(path_mesh+model+'grid.txt', 'w') as f:
-                        f.write(grid)
+                    prepro.save_atomic(grid,path_mesh+fingerprint+'grid.txt')
             except NameError:
                 print('read and load files for grid check')
-                ti = xa.open_mfdataset(file_t, preprocess=partial_func).isel(time=0)
-                ui = xa.open_mfdataset(file_u, preprocess=partial_func).isel(time=0)
-                vi = xa.open_mfdataset(file_v, preprocess=partial_func).isel(time=0)
-                try:
-                    with ProgressBar():
-                        ti=ti.load()
-                        ui=ui.load()
-                        vi=vi.load()
-                except NameError:
-                    ti=ti.load()
-                    ui=ui.load()
-                    vi=vi.load()
+                ti = prepro.probe_grid(file_t)
+                ui = prepro.probe_grid(file_u)
+                vi = prepro.probe_grid(file_v)
                 grid = func.check_Arakawa(ui,vi,ti,model)
                 if saving == True:
-                    with open(path_mesh+model+'grid.txt', 'w') as f:
-                        f.write(grid)
+                    prepro.save_atomic(grid,path_mesh+fingerprint+'grid.txt')
     else:
         print('grid not known')
         sys.exit()
 
 
-    min_x=np.nanmin((min(out_u[:,0],default=np.nan),min(out_v[:,0],default=np.nan)))
-    max_x=np.nanmax((max(out_u[:,0],default=np.nan),max(out_v[:,0],default=np.nan)))
-    min_y=np.nanmin((min(out_u[:,1],default=np.nan),min(out_v[:,1],default=np.nan)))
-    max_y=np.nanmax((max(out_u[:,1],default=np.nan),max(out_v[:,1],default=np.nan)))
-
-    if min_x == -1:
-        min_x = 0
-        max_x = max_x + 1
-
+    bounds = section_bounds(*prepare_indices(indices)[:2]) if mesh_subdomain == True else None
+    file_dyu,file_dxv = prepro.mesh_files(fingerprint,path_mesh,bounds)
     try:
-        mu=xa.open_dataset(path_mesh+'mesh_dyu_'+model+'.nc')
-        mv=xa.open_dataset(path_mesh+'mesh_dxv_'+model+'.nc')
+        mu=xa.open_dataset(file_dyu)
+        mv=xa.open_dataset(file_dxv)
     except FileNotFoundError:
         if mesh_dxv!=0:
-            mesh_dxv.to_dataset(name='dxv').to_netcdf(path_mesh+'mesh_dxv_'+model+'.nc')
-            mesh_dyu.to_dataset(name='dyu').to_netcdf(path_mesh+'mesh_dyu_'+model+'.nc')
-            mu=xa.open_dataset(path_mesh+'mesh_dyu_'+model+'.nc')
-            mv=xa.open_dataset(path_mesh+'mesh_dxv_'+model+'.nc')
+            file_dyu,file_dxv = prepro.mesh_files(fingerprint,path_mesh)
+            prepro.save_atomic(mesh_dxv.to_dataset(name='dxv'),file_dxv)
+            prepro.save_atomic(mesh_dyu.to_dataset(name='dyu'),file_dyu)
+            mu=xa.open_dataset(file_dyu)
+            mv=xa.open_dataset(file_dxv)
         else:       
             print('calc horizontal meshes')
             try:
-                mu,mv = prepro.calc_dxdy(model,ui,vi,path_mesh)
+                mu,mv = prepro.calc_dxdy(fingerprint,ui,vi,path_mesh,bounds=bounds,dtype=mesh_dtype)
             except NameError:
                 print('read and load files for mesh')
-                ui = xa.open_mfdataset(file_u, preprocess=partial_func).isel(time=0)
-                vi = xa.open_mfdataset(file_v, preprocess=partial_func).isel(time=0)
-                try:
-                    with ProgressBar():
-                        ui=ui.load()
-                        vi=vi.load()
-                except NameError:
-                    ui=ui.load()
-                    vi=vi.load()
-                mu,mv = prepro.calc_dxdy(model,ui,vi,path_mesh)
+                ui = prepro.probe_grid(file_u)
+                vi = prepro.probe_grid(file_v)
+                mu,mv = prepro.calc_dxdy(fingerprint,ui,vi,path_mesh,bounds=bounds,dtype=mesh_dtype)
 
+    return indices,grid,mu,mv
 
-    print('read t, u and v fields')
-    partial_func = partial(prepro._preprocess2,lon_bnds=(int(min_x)-1,int(max_x)+1),lat_bnds=(int(min_y)-1,int(max_y)+1))
-    t = xa.open_mfdataset(file_t, preprocess=partial_func,chunks={'time':1})
-    u = xa.open_mfdataset(file_u, preprocess=partial_func,chunks={'time':1})
-    v = xa.open_mfdataset(file_v, preprocess=partial_func,chunks={'time':1})
-    if 'time' in t.dims and t.dims['time'] > 1:
-        t=t.sel(time=slice(str(time_start),str(time_end)))
-        u=u.sel(time=slice(str(time_start),str(time_end)))
-        v=v.sel(time=slice(str(time_start),str(time_end)))
-    elif 'time' not in t.dims:
-        t=t.expand_dims(dim={"time": 1})
-        u=u.expand_dims(dim={"time": 1})
-        v=v.expand_dims(dim={"time": 1})
-    deltaz = xa.open_mfdataset(file_z, preprocess=partial_func,chunks={'time':1})[['thkcello']]
-    if 'time' in deltaz.dims:
-        deltaz=deltaz.sel(time=slice(str(time_start),str(time_end)))
-    mu=mu.sel(x=slice(int(min_x)-1,int(max_x)+1),y=slice(int(min_y)-1,int(max_y)+1)).load()
-    mv=mv.sel(x=slice(int(min_x)-1,int(max_x)+1),y=slice(int(min_y)-1,int(max_y)+1)).load()
 
-    print('load t, u and v fields')
-    try:
-        with ProgressBar():
-            t=t.load()
-            u=u.load()
-            v=v.load()
-            deltaz=deltaz.load()
-    except NameError:
-        t=t.load()
-        u=u.load()
-        v=v.load()
-        deltaz=deltaz.load()
+def section_bounds(out_u,out_v):
+    '''Bounding box (min_x,max_x,min_y,max_y) of the u and v points of a section'''
+    min_x=np.nanmin((min(out_u[:,0],default=np.nan),min(out_v[:,0],default=np.nan)))
+    max_x=np.nanmax((max(out_u[:,0],default=np.nan),max(out_v[:,0],default=np.nan)))
+    min_y=np.nanmin((min(out_u[:,1],default=np.nan),min(out_v[:,1],default=np.nan)))
+    max_y=np.nanmax((max(out_u[:,1],default=np.nan),max(out_v[:,1],default=np.nan)))
 
+    if min_x == -1:
+        min_x = 0
+        max_x = max_x + 1
+    return min_x,max_x,min_y,max_y
 
-    dzu3,dzv3 = func.calc_dz_faces(deltaz,grid,model,path_mesh)
-    trans = xa.Dataset({'tot_'+product+'_flux':(('time'),np.array(np.zeros(t.time.size)))},coords=dict(time=t.time))
+
+def calc_sign_v(indices):
+    '''Sign of the v points along the section, depending on the direction the line is running'''
     sign_v=[]
     indi=indices.indices[:,2][indices.indices[:,3]!=0]
     for ind in range(len(indi)-1):
@@ -223,99 +435,53 @@ def transports(product,strait,model,time_start,time_end,file_u,file_v,file_t,fil
         sign_v=np.append(sign_v,sign_v[-1])
     except IndexError:
         pass
+    return sign_v
 
 
-    print(' ...calculating transport')
-    trans_arr = []
-    udata = u.uo
-    vdata = v.vo
-    Tdata = t
-
-    if product == 'salt':
-        Sdata = xa.open_mfdataset(file_s, preprocess=partial_func,chunks={'time':1}).sel(time=slice(str(time_start),str(time_end)))
-
-
-    if product in ['volume','heat','salt']:
-        udata,vdata2,dzu3,dzv3,mu2,mv2 = func.transform_Arakawa(grid,mu,mv,deltaz,dzu3,dzv3,udata,vdata)
-
-
-    if product == 'volume':
-        print('calc u')
-        udata=udata*mu2.dyu.values*dzu3.values
-        print('calc v')
-        vdata=vdata*mv2.dxv.values*dzv3.values
-
-
-    if product == 'heat':
-        print('rolling T')
-        Tudata = func.interp_TS(Tdata.thetao,'x')
-        Tvdata = func.interp_TS(Tdata.thetao,'y')
-        print('calc u')
-        udata=udata*mu2.dyu.values*dzu3.values*(Tudata.values-Tref)
-        print('calc v')
-        vdata=vdata*mv2.dxv.values*dzv3.values*(Tvdata.values-Tref)
-
-
-
-    if product == 'salt':
-        print('rolling S')
-        Sudata = func.interp_TS(Sdata.so,'x')
-        Svdata = func.interp_TS(Sdata.so,'y')
-        print('calc u')
-        udata=udata*mu2.dyu.values*dzu3.values*Sudata.values
-        print('calc v')
-        vdata=vdata*mv2.dxv.values*dzv3.values*Svdata.values
-
-    if product == 'ice':
-        print('calc u')
-        udata=udata*mu.dyu.values*sit.sithick.values*sic.siconc.values
-        print('calc v')
-        vdata=vdata*mv.dxv.values*sit.sithick.values*sic.siconc.values
-
-    udata = udata.fillna(0.)
-    vdata = vdata.fillna(0.)
-    print('calc line')
-    if product in ['volume','heat','salt']:
-        udata = udata.sum(dim='lev')
-        vdata = vdata.sum(dim='lev')
-    datau = xa.Dataset({'inte':(('time','y','x'),udata.data)},coords=({'time':('time',udata.time.data),'x':('x',udata.x.data),'y':('y',udata.y.data)}))
-    datav = xa.Dataset({'inte':(('time','y','x'),vdata.data)},coords=({'time':('time',vdata.time.data),'x':('x',vdata.x.data),'y':('y',vdata.y.data)}))
-    pointsu = np.zeros(datau.inte.shape)
-    data1u = datau.inte
-
-    for l in range(len(out_u)):
-        if out_u_vz[l][2] == -1:
-            pointsu[:,int(out_u_vz[l,1]-min_y+1),int(out_u_vz[l,0]-min_x+1)] = data1u[:,int(out_u_vz[l,1]-min_y+1),int(out_u_vz[l,0]-min_x+1)] * (-1)
-        else:
-            pointsu[:,int(out_u_vz[l,1]-min_y+1),int(out_u_vz[l,0]-min_x+1)] = data1u[:,int(out_u_vz[l,1]-min_y+1),int(out_u_vz[l,0]-min_x+1)]
-
-    pointsv = np.zeros(datav.inte.shape)
-    data1v = datav.inte
-
-    indi1=indices.indices[:,2][indices.indices[:,3]!=0]
-    indi2=indices.indices[:,3][indices.indices[:,3]!=0]
+def line_gather(indices,out_u,out_u_vz,sign_v,min_x,min_y):
+    '''
+    Precompute the sparse gather of the section points from the loaded subdomain.
 
-    for m in range(len(indi1)-1):
-        pointsv[:,int(indi2[m]-min_y+1),int(indi1[m]-min_x+1)] = data1v[:,int(indi2[m]-min_y+1),int(indi1[m]-min_x+1)] * sign_v[m]
-
-    vp = xa.Dataset({'v':(('time','y','x'),pointsv)},coords=datav.coords)
-    up = xa.Dataset({'u':(('time','y','x'),pointsu)},coords=datau.coords)
-    ges_l = datau.copy()
-    ges_l['inte'] = vp['v'] + up['u']
-    if product == 'heat':
-        ges_l['inte'] = ges_l['inte'] * rho * cp
-    elif product == 'salt':
-        ges_l['inte'] = ges_l['inte'] * rho
-    #ges_l.to_netcdf(model+'_'+strait+'_test.nc')
-    summ = ges_l.sum(dim=['x','y'])
-    summ = summ.inte
-    trans_arr = np.append(trans_arr,summ)
-
-    trans[model]= (['time'],trans_arr)
-    trans = trans.drop_vars('tot_'+product+'_flux')
-    trans.to_netcdf(path_save+strait+'_'+product+'_'+model+'_'+str(time_start)+'-'+str(time_end)+'.nc')
-
-    return trans
+    args:
+    indices, out_u, out_u_vz, sign_v: section points and signs (prepare_indices, calc_sign_v)
+    min_x, min_y: origin of the loaded subdomain
 
+    returns:
+    dict with the (y,x) positions and signs of the u and v points in the subdomain, points appearing twice are only counted once
+    '''
+    out_u_vz=np.asarray(out_u_vz)[:len(out_u)]
+    ju=(out_u_vz[:,1]-min_y+1).astype(int)
+    iu=(out_u_vz[:,0]-min_x+1).astype(int)
+    su=np.where(out_u_vz[:,2]==-1,-1.,1.)
 
+    indi1=indices.indices[:,2][indices.indices[:,3]!=0]
+    indi2=indices.indices[:,3][indices.indices[:,3]!=0]
+    n=max(len(indi1)-1,0)
+    jv=(indi2[:n]-min_y+1).astype(int)
+    iv=(indi1[:n]-min_x+1).astype(int)
+    sv=np.asarray(sign_v,dtype=float)[:n]
+
+    gather={}
+    for name,j,i,s in [('u',ju,iu,su),('v',jv,iv,sv)]:
+        #keep the last occurrence of each point, as the point-by-point assignment did
+        if len(j)>0:
+            _,last=np.unique(np.stack([j,i],axis=1)[::-1],axis=0,return_index=True)
+            keep=np.sort(len(j)-1-last)
+            j,i,s=j[keep],i[keep],s[keep]
+        gather[name]=(j,i,s)
+    return gather
+
+
+def line_integration(udata,vdata,gather,product='volume',rho=1026,cp=3996):
+    '''Sum the depth integrated u and v contributions at the section points given by line_gather, returns the time series as np.array'''
+    summ=np.zeros(udata.shape[0])
+    for data,name in [(udata,'u'),(vdata,'v')]:
+        j,i,s=gather[name]
+        inte=np.asarray(data.values[:,j,i],dtype=float)*s
+        if product == 'heat':
+            inte = inte * rho * cp
+        elif product == 'salt':
+            inte = inte * rho
+        summ=summ+inte.sum(axis=1)
+    return summ
 
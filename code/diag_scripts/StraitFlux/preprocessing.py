@@ -1,6 +1,9 @@
 import xarray as xa
 import numpy as np
-from tqdm import tqdm
+import hashlib
+import os
+import glob
+from scipy.spatial import cKDTree
 from xmip.preprocessing import rename_cmip6,promote_empty_dims, broadcast_lonlat, correct_coordinates
 
 def renaming_dict_exp():
@@ -124,7 +127,7 @@ def drop_cyclic_points(ds):
     ds=ds.sel(x=np.sort(ind))
     return ds
 
-def wrapper(ds):
+def normalize(ds):
     ds = ds.copy()
     ds = rename_time_lev(ds)
     ds = rename_cmip6(ds,rename_dict=renaming_dict_exp())
@@ -142,6 +145,150 @@ def wrapper(ds):
     ds = drop_northsouth_duplicate_points(ds)
     return ds
 
+_time_dims = ['time','time_counter']
+_plans = {}
+_sources = {}
+
+def plan_key(ds,sources=[]):
+    '''
+    This function provides the key of the normalization plan of a raw file: names, dims, shapes (without time) and dtypes of all variables
+    and the values of the coordinates without time; data variables (e.g. a time invariant thkcello) are never read, except those in sources
+    (see derive_plan)
+    '''
+    time=[d for d in ds.dims if d in _time_dims]
+    h=hashlib.sha1()
+    for name in sorted(ds.variables,key=str):
+        var=ds.variables[name]
+        h.update(str((name,var.dims,[None if d in time else n for d,n in zip(var.dims,var.shape)],str(var.dtype))).encode())
+        if (name in ds.coords or name in sources) and not any(d in time for d in var.dims):
+            values=np.asarray(var.values)
+            h.update(str(values.tolist()).encode() if values.dtype.kind=='O' else np.ascontiguousarray(values).tobytes())
+    return h.hexdigest()
+
+def index_or_slice(index,size):
+    '''
+    This function turns the positions kept along a dimension into the cheapest indexer: None if all are kept in order, a slice for a
+    contiguous (or reversed) range, otherwise the positions themselves
+    '''
+    n=len(index)
+    if n>1 and np.all(np.diff(index)==1):
+        return None if n==size and index[0]==0 else slice(index[0],index[-1]+1)
+    if n>1 and np.all(np.diff(index)==-1):
+        return slice(index[0],index[-1]-1 if index[-1]>0 else None,-1)
+    return index
+
+def derive_plan(ds):
+    '''
+    This function runs normalize once on the first time step of ds, with the positions along every dimension and the name of every
+    variable attached, and reads off what happened to them:
+        names: raw -> normalized names of the variables taken from the file (data variables and coordinates with time)
+        dims: raw -> normalized dimension names
+        positions: positions kept along the raw dimensions, in the order of the normalized dimensions
+        index: the same as indexers (index_or_slice)
+        order: dimension order of each normalized variable
+        coords: normalized names of the variables taken from the file that are coordinates
+        static: all other coordinates (lat, lon, x, y, lev, bounds, ...), the same for every file of the grid
+        sources: raw data variables static is read from (e.g. lat and lon that are not marked as coordinates in the file)
+    returns:
+        plan (dict), None if the steps of normalize can not be expressed as renaming and indexing (ds is then normalized directly)
+    '''
+    time=[d for d in ds.dims if d in _time_dims]
+    skel=ds.isel({d:[0] for d in time if ds.sizes[d]>0}).copy()
+    skel=skel.assign_coords({'_index_'+str(d):(d,np.arange(skel.sizes[d])) for d in skel.dims if d not in time})
+    for name in skel.variables:
+        skel.variables[name].attrs={**skel.variables[name].attrs,'_raw_name':name}
+    out=normalize(skel)
+
+    tracers=['_index_'+str(d) for d in skel.dims if d not in time]
+    if any(t not in out.variables or out[t].ndim!=1 for t in tracers):
+        return None
+    dims={d:'time' for d in time}
+    positions,index={},{}
+    for d in skel.dims:
+        if d not in time:
+            t=out['_index_'+str(d)]
+            dims[d]=t.dims[0]
+            positions[d]=t.values
+            i=index_or_slice(t.values,skel.sizes[d])
+            if i is not None:
+                index[d]=i
+    if time and 'time' not in out.dims:
+        return None
+
+    names,order,coords={},{},[]
+    for name in out.variables:
+        var=out.variables[name]
+        if name in tracers or not ('time' in var.dims or name in out.data_vars):
+            continue
+        raw=var.attrs.get('_raw_name')
+        if raw is None or sorted(dims[d] for d in ds.variables[raw].dims)!=sorted(var.dims):
+            return None
+        names[raw]=name
+        order[name]=var.dims
+        if name in out.coords:
+            coords.append(name)
+    static=out.drop_vars(tracers+list(order)).load()
+    sources=[]
+    for name in static.variables:
+        raw=static.variables[name].attrs.pop('_raw_name',None)
+        if raw in ds.data_vars and raw not in sources:
+            sources.append(raw)
+    return {'names':names,'dims':dims,'positions':positions,'index':index,'order':order,'coords':coords,'static':static,'sources':sources}
+
+def apply_plan(ds,plan,bounds=None):
+    '''
+    This function normalizes a raw file with a plan of derive_plan: selection, renaming and transposing only
+    args:
+        ds: raw xa.Dataset
+        plan: plan of derive_plan for the grid of ds
+        bounds: optional {dim: slice} of the normalized dimensions to keep, as for .sel on the normalized dataset; translated to
+                positions in the raw file, so only the cells inside are ever read
+    '''
+    index,static=plan['index'],plan['static']
+    if bounds is not None:
+        static=static.sel(bounds)
+        index=dict(index)
+        for d,n in plan['dims'].items():
+            if n in bounds and d in plan['positions']:
+                index[d]=plan['positions'][d][plan['static'].get_index(n).get_indexer(static.get_index(n))]
+                index[d]=index_or_slice(index[d],ds.sizes[d])
+                if index[d] is None:
+                    del index[d]
+    ds=ds.drop_vars([name for name in ds.variables if name not in plan['names']])
+    ds=ds.isel(index)
+    # via temporary names, as x and y may be swapped
+    dims={d:n for d,n in plan['dims'].items() if d in ds.dims and d!=n}
+    ds=ds.rename_dims({d:'_'+str(n) for d,n in dims.items()}).rename_dims({'_'+str(n):n for n in dims.values()})
+    ds=ds.rename_vars(plan['names'])
+    ds=ds.reset_coords([name for name in ds.coords if name not in plan['coords'] and name not in ds.dims])
+    ds=ds.set_coords([name for name in plan['coords'] if name not in ds.dims])
+    for name,order in plan['order'].items():
+        if ds[name].dims!=order:
+            ds[name]=ds[name].transpose(*order)
+    return ds.assign_coords(static.coords)
+
+def wrapper(ds,bounds=None):
+    '''
+    This function normalizes a raw file (normalize); the steps are derived once per grid (derive_plan) and applied to every file as
+    renaming and indexing only (apply_plan). The grid is recognised by plan_key, with the values of the data variables the static
+    coordinates are read from (usually none) added once they are known
+    args:
+        ds: raw xa.Dataset
+        bounds: optional {dim: slice} of the normalized x and y to keep (see apply_plan)
+    '''
+    key=plan_key(ds)
+    if key not in _sources:
+        plan=derive_plan(ds)
+        _sources[key]=[] if plan is None else plan['sources']
+        _plans[plan_key(ds,_sources[key])]=plan
+    key=plan_key(ds,_sources[key])
+    if key not in _plans:
+        _plans[key]=derive_plan(ds)
+    if _plans[key] is None:
+        ds=normalize(ds)
+        return ds if bounds is None else ds.sel(bounds)
+    return apply_plan(ds,_plans[key],bounds)
+
 def distance(lat1,lon1,lat2,lon2):
     '''
     This function calculates the distance between two lat/lon points
@@ -163,21 +310,70 @@ def distance(lat1,lon1,lat2,lon2):
     distance=a*2*np.arcsin(c/2) 
     return distance
 
-def calc_dxdy(model,u,v,path_mesh):
-
-    dy=xa.DataArray(data=np.zeros(u.lat.shape),coords=u.lat.coords,dims=u.lat.dims)
-    dx=xa.DataArray(data=np.zeros(v.lat.shape),coords=v.lat.coords,dims=v.lat.dims)
-    for i in tqdm(range(0,len(u.y)-1)):
-        #print(i)
-        dy[i+1,:]=distance(u.lat[i,:],u.lon[i,:],u.lat[i+1,:],u.lon[i+1,:])
-    for i in tqdm(range(0,len(v.x)-1)):
-        #print(i)
-        dx[:,i+1]=distance(v.lat[:,i],v.lon[:,i],v.lat[:,i+1],v.lon[:,i+1])
-            
-    mu=(dy*1000).to_dataset(name='dyu')
-    mv=(dx*1000).to_dataset(name='dxv')
-    mu.to_netcdf(path_mesh+'mesh_dyu_'+model+'.nc')
-    mv.to_netcdf(path_mesh+'mesh_dxv_'+model+'.nc')
+def save_atomic(obj,file):
+    '''
+    This function writes a file shared between processes (e.g. meshes, indices and weights of models on the same grid) via a temporary
+    file in the same directory and os.replace, so other processes never read a partly written file
+    args:
+        obj: str for a text file, otherwise anything with a to_netcdf method (xa.Dataset, SectionOperator, xe.Regridder)
+        file: path + filename
+    '''
+    tmp=os.path.join(os.path.dirname(file),'.'+str(os.getpid())+'_'+os.path.basename(file))
+    try:
+        if isinstance(obj,str):
+            with open(tmp,'w') as f:
+                f.write(obj)
+        else:
+            obj.to_netcdf(tmp)
+        os.replace(tmp,file)
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
+def mesh_files(fingerprint,path_mesh,bounds=None):
+    '''
+    This function provides the file names of the horizontal meshes of a grid, or of the subdomain bounds=(min_x,max_x,min_y,max_y) of it
+    '''
+    name=fingerprint
+    if bounds is not None:
+        name=name+'_x'+str(int(bounds[0]))+'-'+str(int(bounds[1]))+'_y'+str(int(bounds[2]))+'-'+str(int(bounds[3]))
+    return path_mesh+'mesh_dyu_'+name+'.nc',path_mesh+'mesh_dxv_'+name+'.nc'
+
+def calc_dxdy(fingerprint,u,v,path_mesh,bounds=None,dtype=None):
+    '''
+    This function calculates the horizontal meshes: dy between neighbouring u points along y and dx between neighbouring v points along x (0 in the first row/column)
+    args:
+        fingerprint: grid fingerprint, names the saved files (see mesh_files)
+        u, v: xa.Dataset on u and v grid with lat and lon (y,x)
+        path_mesh: path to save mesh data
+        bounds: optional subdomain (min_x,max_x,min_y,max_y) of a section; the meshes are then only calculated from min-1 to max+1 in x and y
+        dtype: optional dtype of the meshes, e.g. 'float32' for very large grids
+    returns:
+        mu, mv: xa.Dataset with dyu and dxv in m
+    '''
+    if bounds is not None:
+        min_x,max_x,min_y,max_y=[int(b) for b in bounds]
+        # one more row and column in front, as dy and dx need the previous point
+        u=u.sel(x=slice(min_x-2,max_x+1),y=slice(min_y-2,max_y+1))
+        v=v.sel(x=slice(min_x-2,max_x+1),y=slice(min_y-2,max_y+1))
+
+    lat,lon=u.lat.values,u.lon.values
+    dy=np.zeros(lat.shape)
+    dy[1:,:]=distance(lat[:-1,:],lon[:-1,:],lat[1:,:],lon[1:,:])
+    lat,lon=v.lat.values,v.lon.values
+    dx=np.zeros(lat.shape)
+    dx[:,1:]=distance(lat[:,:-1],lon[:,:-1],lat[:,1:],lon[:,1:])
+
+    mu=xa.DataArray(data=dy*1000,coords=u.lat.coords,dims=u.lat.dims).to_dataset(name='dyu')
+    mv=xa.DataArray(data=dx*1000,coords=v.lat.coords,dims=v.lat.dims).to_dataset(name='dxv')
+    if bounds is not None:
+        mu=mu.sel(x=slice(min_x-1,max_x+1),y=slice(min_y-1,max_y+1))
+        mv=mv.sel(x=slice(min_x-1,max_x+1),y=slice(min_y-1,max_y+1))
+    if dtype is not None:
+        mu,mv=mu.astype(dtype),mv.astype(dtype)
+    file_dyu,file_dxv=mesh_files(fingerprint,path_mesh,bounds)
+    save_atomic(mu,file_dyu)
+    save_atomic(mv,file_dxv)
     return mu,mv
 
 def unique_rows(a):
@@ -200,8 +396,7 @@ def _preprocess1(x):
 
 ## for actuall fields
 def _preprocess2(x, lon_bnds, lat_bnds):
-    x=wrapper(x)
-    return x.sel(x=slice(*lon_bnds), y=slice(*lat_bnds))
+    return wrapper(x,{'x':slice(*lon_bnds),'y':slice(*lat_bnds)})
 
 
 def kugel_2_kart(lat,lon):
@@ -216,6 +411,100 @@ def kugel_2_kart(lat,lon):
     z = radius * np.sin(np.radians(lat))
     return x,y,z
 
+def grid_fingerprint(lat,lon):
+    '''
+    This function provides a content hash of the grid, so models on the same grid (e.g. NEMO ORCA1) can share precomputed data
+    args:
+        lat and lon (arrays of the same shape, for model grids in (y,x) order)
+    returns:
+        fingerprint (str)
+    '''
+    lat=np.ascontiguousarray(lat,dtype=float)
+    lon=np.ascontiguousarray(lon,dtype=float)
+    h=hashlib.sha1(str(lat.shape).encode())
+    h.update(lat)
+    h.update(lon)
+    return h.hexdigest()[:16]
+
+_fingerprints = {}
+
+def file_fingerprint(file):
+    '''
+    This function provides the grid_fingerprint of the grid of file(s), kept for later calls on the same file(s); only lat and lon of the first file are read
+    args:
+        file: path + filename(s) as passed to xa.open_mfdataset
+    returns:
+        fingerprint (str), used instead of the model name for the mesh, indices and grid type files
+    '''
+    key=str(file)
+    if key not in _fingerprints:
+        files=sorted(glob.glob(file)) if isinstance(file,str) else list(file)
+        with xa.open_dataset(files[0]) as ds:
+            ds=wrapper(ds)
+            _fingerprints[key]=grid_fingerprint(ds.lat.transpose('y','x').values,ds.lon.transpose('y','x').values)
+    return _fingerprints[key]
+
+_probes = {}
+
+def probe_grid(file):
+    '''
+    This function reads the grid of file(s) for the indices and the grid check: coordinates and the uppermost level of the first time step
+    of the first file only, kept for later calls on the same grid (grid fingerprint) and variables
+    args:
+        file: path + filename(s) as passed to xa.open_mfdataset
+    returns:
+        loaded xa.Dataset as xa.open_mfdataset(file,preprocess=_preprocess1).isel(time=0)
+    '''
+    files=sorted(glob.glob(file)) if isinstance(file,str) else list(file)
+    with xa.open_dataset(files[0]) as ds:
+        key=(file_fingerprint(file),tuple(sorted(ds.data_vars)))
+        if key not in _probes:
+            if 'time' in ds.dims:
+                ds=ds.isel(time=[0])
+            probe=_preprocess1(ds)
+            if 'time' in probe.dims:
+                probe=probe.isel(time=0)
+            _probes[key]=probe.load()
+    return _probes[key]
+
+_trees = {}
+
+def grid_tree(lat,lon):
+    '''
+    This function provides a KD-tree of the points lat,lon in cartesian coordinates (kugel_2_kart), kept for later calls on the same grid.
+    The euclidean distance in the tree is the chord, which is monotonic in the distance on the sphere, so the nearest distance is the same
+    (points at the same distance are ordered differently, see nearest_points).
+    args:
+        lat and lon (arrays of any shape, points with NaN coordinates are left out)
+    returns:
+        tree: scipy.spatial.cKDTree
+        index: flat index into lat/lon of each point in the tree
+    '''
+    key=grid_fingerprint(lat,lon)
+    if key not in _trees:
+        x,y,z=kugel_2_kart(np.ravel(lat),np.ravel(lon))
+        index=np.flatnonzero(np.isfinite(x)&np.isfinite(y)&np.isfinite(z))
+        _trees[key]=(cKDTree(np.stack([x[index],y[index],z[index]],axis=1)),index)
+    return _trees[key]
+
+def nearest_points(lat,lon,lat_p,lon_p,k=8,tol=1e-3):
+    '''
+    This function finds the nearest grid points to the points lat_p,lon_p using grid_tree. Of grid points at the same distance (e.g. a point
+    exactly between two cell centres) the one with the lowest flat index is taken, as by a scan for the first minimum (np.argmin)
+    args:
+        lat and lon of the grid (arrays of any shape)
+        lat_p and lon_p of the points (scalars or arrays)
+        k: number of nearest grid points tested for the same distance
+        tol: distance in m up to which grid points count as equally near
+    returns:
+        flat index into lat/lon of the nearest grid point for each point
+    '''
+    tree,index=grid_tree(lat,lon)
+    x,y,z=kugel_2_kart(np.asarray(lat_p,dtype=float),np.asarray(lon_p,dtype=float))
+    dist,i=tree.query(np.stack([x,y,z],axis=-1),k=np.arange(1,min(k,len(index))+1))
+    candidates=np.where(dist<=dist[...,:1]+tol,index[i],len(np.ravel(lat)))
+    return candidates.min(axis=-1)
+
 def kart_2_kugel(x,y,z):
     '''
     This function transforms from kartesian to spherical coordinates
@@ -223,15 +512,7 @@ def kart_2_kugel(x,y,z):
         x,y,z
     '''
     lat = np.degrees(np.arcsin(z/(np.sqrt(x*x+y*y+z*z))))
-    lon2 = []
-    for i in range(len(x)):
-        if x[i] > 0:
-            lon = np.degrees(np.arctan(y[i]/x[i]))
-        elif y[i] > 0:
-            lon = np.degrees(np.arctan(y[i]/x[i])) + 180
-        else:
-            lon = np.degrees(np.arctan(y[i]/x[i])) - 180
-        lon2=np.append(lon2,lon)
+    lon2 = np.degrees(np.arctan(y/x)) + np.where(x>0,0,np.where(y>0,180,-180))
     return lat,lon2
 
 
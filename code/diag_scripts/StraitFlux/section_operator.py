@@ -0,0 +1,112 @@
+import xarray as xa
+import numpy as np
+
+
+class SectionOperator:
+    '''
+    Precompiled mapping from the velocities at the cell faces (Arakawa-C) of a subdomain to the transport through a section.
+
+    The operator holds the positions and signs of the u and v points of the section together with the cell widths (dyu, dxv)
+    and thicknesses (dzu, dzv) at these points, so any number of time chunks, products or ensemble members can be passed
+    through the same operator without rebuilding it. It can be saved to and read from netcdf (next to the *_indices.nc file).
+
+    args:
+    ju, iu, su: y and x positions (relative to the subdomain origin) and signs of the u points
+    jv, iv, sv: y and x positions and signs of the v points
+    dyu, dxv: cell widths at the u and v points
+    dzu, dzv: cell thicknesses at the u and v points, xa.DataArray with dims (lev, point) or (time, lev, point)
+    min_x, min_y: origin of the subdomain the positions refer to (as passed to line_gather)
+    '''
+
+    def __init__(self,ju,iu,su,jv,iv,sv,dyu,dxv,dzu,dzv,min_x,min_y):
+        self.ju,self.iu,self.su = np.asarray(ju,dtype=int),np.asarray(iu,dtype=int),np.asarray(su,dtype=float)
+        self.jv,self.iv,self.sv = np.asarray(jv,dtype=int),np.asarray(iv,dtype=int),np.asarray(sv,dtype=float)
+        self.dyu,self.dxv = np.asarray(dyu),np.asarray(dxv)
+        self.dzu,self.dzv = dzu,dzv
+        self.min_x,self.min_y = int(min_x),int(min_y)
+
+    @classmethod
+    def from_fields(cls,gather,mu,mv,dzu,dzv,min_x,min_y):
+        '''
+        Build the operator from the gather of a section (see masterscript_line.line_gather) and the meshes and
+        cell thicknesses on the loaded subdomain (Arakawa-C, i.e. mu2, mv2, dzu3 and dzv3 of transform_subdomain)
+        '''
+        ju,iu,su = gather['u']
+        jv,iv,sv = gather['v']
+        dyu,dxv = face_widths(gather,mu,mv)
+        return cls(ju,iu,su,jv,iv,sv,dyu,dxv,_at_points(dzu,ju,iu),_at_points(dzv,jv,iv),min_x,min_y)
+
+    @classmethod
+    def from_file(cls,file):
+        '''Read an operator written by to_netcdf'''
+        with xa.open_dataset(file) as ds:
+            ds = ds.load()
+        return cls(ds.ju.values,ds.iu.values,ds.su.values,ds.jv.values,ds.iv.values,ds.sv.values,ds.dyu.values,ds.dxv.values,
+                   ds.dzu.rename({'u_point':'point'}),ds.dzv.rename({'v_point':'point'}),ds.attrs['min_x'],ds.attrs['min_y'])
+
+    def to_netcdf(self,file):
+        '''Save the operator to netcdf'''
+        ds = xa.Dataset({'ju':('u_point',self.ju),'iu':('u_point',self.iu),'su':('u_point',self.su),
+                         'jv':('v_point',self.jv),'iv':('v_point',self.iv),'sv':('v_point',self.sv),
+                         'dyu':('u_point',self.dyu),'dxv':('v_point',self.dxv),
+                         'dzu':self.dzu.rename({'point':'u_point'}),'dzv':self.dzv.rename({'point':'v_point'})},
+                        attrs={'min_x':self.min_x,'min_y':self.min_y})
+        ds.to_netcdf(file)
+
+    def matches(self,gather,min_x,min_y):
+        '''True if the operator has the same points and signs as gather (see masterscript_line.line_gather) on a subdomain with origin min_x, min_y'''
+        dx,dy = self.min_x-int(min_x),self.min_y-int(min_y)
+        ju,iu,su = gather['u']
+        jv,iv,sv = gather['v']
+        return all(np.array_equal(a,b) for a,b in [(self.ju+dy,ju),(self.iu+dx,iu),(self.su,su),(self.jv+dy,jv),(self.iv+dx,iv),(self.sv,sv)])
+
+    def apply(self,u,v,tracer=None,min_x=None,min_y=None):
+        '''
+        Transport through the section
+
+        args:
+        u, v: xa.DataArray of the velocities at the cell faces (time, lev, y, x) on the subdomain, numpy or dask backed
+        tracer: optional xa.DataArray (time, lev, y, x) on the T points, e.g. T-Tref or S; interpolated to the faces as in functions.interp_TS
+        min_x, min_y: origin of the subdomain u, v and tracer were read with, if different from the one the operator was built with
+
+        returns:
+        xa.DataArray of the transport over time (without factors like rho and cp), lazy if u and v are dask backed
+        '''
+        dx = 0 if min_x is None else self.min_x-int(min_x)
+        dy = 0 if min_y is None else self.min_y-int(min_y)
+
+        summ = np.zeros(u.sizes['time'])
+        for data,j,i,s,dh,dz,face in [(u,self.ju+dy,self.iu+dx,self.su,self.dyu,self.dzu,'x'),(v,self.jv+dy,self.iv+dx,self.sv,self.dxv,self.dzv,'y')]:
+            if 'time' in dz.dims and not np.array_equal(dz.time.values,data.time.values):
+                dz = dz.sel(time=data.time)
+            inte = _gather(data,j,i)*dh*np.ascontiguousarray(dz.transpose(...,'lev','point').values)
+            if tracer is not None:
+                inte = inte*_interp_at_points(tracer,j,i,face)
+            inte = np.where(np.isnan(inte),0.,inte)
+            summ = summ+(inte.sum(axis=1)*s).sum(axis=1)
+        return xa.DataArray(summ,dims='time',coords={'time':u.time})
+
+
+def face_widths(gather,mu,mv):
+    '''Cell widths dyu and dxv at the u and v points of gather (see masterscript_line.line_gather) on the loaded subdomain'''
+    ju,iu,su = gather['u']
+    jv,iv,sv = gather['v']
+    return mu.dyu.transpose(...,'y','x').values[...,ju,iu],mv.dxv.transpose(...,'y','x').values[...,jv,iv]
+
+def _at_points(data,j,i):
+    '''Select the (y,x) points j,i of data into a new dimension point'''
+    return data.isel(y=xa.DataArray(j,dims='point'),x=xa.DataArray(i,dims='point')).drop_vars(['x','y','lon','lat'],errors='ignore')
+
+def _gather(data,j,i):
+    '''Values of data (time, lev, y, x) at the points j,i as array (time, lev, point), stays lazy for dask backed data'''
+    return data.transpose('time','lev','y','x').isel(y=xa.DataArray(j,dims='point'),x=xa.DataArray(i,dims='point')).data
+
+def _interp_at_points(data,j,i,d):
+    '''Mean of the two T points around the faces j,i in direction d (x or y), ignoring NaN as functions.interp_TS'''
+    if d == 'x':
+        prev = np.where(i>0,_gather(data,j,np.maximum(i-1,0)),np.nan)
+    else:
+        prev = np.where(j>0,_gather(data,np.maximum(j-1,0),i),np.nan)
+    pair = np.stack([prev,_gather(data,j,i)])
+    count = (~np.isnan(pair)).sum(axis=0)
+    return np.where(count>0,np.nansum(pair,axis=0)/np.maximum(count,1),np.nan)
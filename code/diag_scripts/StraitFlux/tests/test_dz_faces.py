@@ -0,0 +1,117 @@
+import os
+import sys
+import numpy as np
+import pytest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..'))
+from StraitFlux.functions import dz_faces_C, dz_faces_B
+
+
+# reference implementations: the loops of calc_dz_faces before vectorisation
+
+def loop_C(zv):
+    z0u=np.zeros(np.shape(zv))
+    z0v=np.zeros(np.shape(zv))
+    if zv.ndim == 4:
+        for i in range(zv.shape[-2]-1):
+            for j in range(zv.shape[-1]-1):
+                p=np.nansum(zv[:,:,i,j:j+2],axis=1).argmin(axis=1)
+                for k in range(len(p)):
+                    if p[k] == 0:
+                        z0u[k,:,i,j]=zv[k,:,i,j]
+                    if p[k] ==1:
+                        l=np.isnan(zv[k,:,i,j+1]).argmax(axis=0)-1
+                        z0u[k,:l,i,j]=zv[k,:l,i,j]
+                        z0u[k,l,i,j]=zv[k,l,i,j+1]
+                        if l >= 0:
+                            z0u[k,l+1:,i,j]=np.nan
+        for j in range(zv.shape[-1]-1):
+            for i in range(zv.shape[-2]-1):
+                p=np.nansum(zv[:,:,i:i+2,j],axis=1).argmin(axis=1)
+                for k in range(len(p)):
+                    if p[k] == 0:
+                        z0v[k,:,i,j]=zv[k,:,i,j]
+                    if p[k] ==1:
+                        l=np.isnan(zv[k,:,i+1,j]).argmax(axis=0)-1
+                        z0v[k,:l,i,j]=zv[k,:l,i,j]
+                        z0v[k,l,i,j]=zv[k,l,i+1,j]
+                        if l >= 0:
+                            z0v[k,l+1:,i,j]=np.nan
+    else:
+        for i in range(zv.shape[-2]-1):
+            for j in range(zv.shape[-1]-1):
+                p=np.nansum(zv[:,i,j:j+2],axis=0).argmin()
+                if p == 0:
+                    z0u[:,i,j]=zv[:,i,j]
+                if p ==1:
+                    z0u[:,i,j]=zv[:,i,j+1]
+        for j in range(zv.shape[-1]-1):
+            for i in range(zv.shape[-2]-1):
+                p=np.nansum(zv[:,i:i+2,j],axis=0).argmin()
+                if p == 0:
+                    z0v[:,i,j]=zv[:,i,j]
+                if p ==1:
+                    z0v[:,i,j]=zv[:,i+1,j]
+    for z0 in [z0u,z0v]:
+        z0[...,:,-1]=zv[...,:,-1]
+        z0[...,-1,:]=zv[...,-1,:]
+    return z0u,z0v
+
+def loop_B_3d(zv):
+    z0u=np.zeros(np.shape(zv))
+    for i in range(zv.shape[-2]-1):
+        for j in range(zv.shape[-1]-1):
+            p=np.argwhere(np.nansum(zv[:,i:i+2,j:j+2],axis=0) == np.min(np.nansum(zv[:,i:i+2,j:j+2],axis=0)))[0]
+            if p[0] == 0:
+                if p[1] == 0:
+                    z0u[:,i,j]=zv[:,i,j]
+                elif p[1] == 1:
+                    z0u[:,i,j]=zv[:,i,j+1]
+            elif p[0] == 1:
+                if  p[1] == 0:
+                    z0u[:,i,j]=zv[:,i+1,j]
+                elif p[1] == 1:
+                    z0u[:,i,j]=zv[:,i+1,j+1]
+    z0u[:,:,-1]=zv[:,:,-1]
+    z0u[:,-1,:]=zv[:,-1,:]
+    return z0u
+
+def loop_B(zv):
+    if zv.ndim == 4:
+        return np.stack([loop_B_3d(zv[k]) for k in range(zv.shape[0])])
+    return loop_B_3d(zv)
+
+
+def synthetic_dz(ntime=None,nlev=6,ny=7,nx=8,seed=0):
+    '''
+    Cell thicknesses with a random bathymetry (NaN below the bottom, land columns and ties between neighbours).
+    '''
+    rng=np.random.default_rng(seed)
+    shape=(nlev,ny,nx) if ntime is None else (ntime,nlev,ny,nx)
+    zv=rng.integers(1,4,size=shape).astype(float)*10.
+    nwet=rng.integers(0,nlev+1,size=shape[:-3]+(1,ny,nx))
+    lev=np.arange(nlev).reshape((-1,1,1))
+    zv[np.broadcast_to(lev>=nwet,shape)]=np.nan
+    # a few columns sharing the same depth to exercise the tie-breaking
+    zv[...,2,3]=zv[...,2,4]
+    zv[...,4,1]=zv[...,5,1]
+    return zv
+
+
+@pytest.mark.parametrize('ntime',[None,3])
+@pytest.mark.parametrize('seed',[0,1,2])
+def test_dz_faces_C(ntime,seed):
+    zv=synthetic_dz(ntime,seed=seed)
+    ref_u,ref_v=loop_C(zv)
+    z0u=dz_faces_C(zv,partial_cells=(ntime is not None))
+    z0v=np.swapaxes(dz_faces_C(np.swapaxes(zv,-1,-2),partial_cells=(ntime is not None)),-1,-2)
+    np.testing.assert_array_equal(z0u,ref_u)
+    np.testing.assert_array_equal(z0v,ref_v)
+
+
+@pytest.mark.parametrize('ntime',[None,3])
+@pytest.mark.parametrize('seed',[0,1,2])
+def test_dz_faces_B(ntime,seed):
+    # Arakawa-A and -B share the selection at the cell corners
+    zv=synthetic_dz(ntime,seed=seed)
+    np.testing.assert_array_equal(dz_faces_B(zv),loop_B(zv))
@@ -0,0 +1,82 @@
+import os
+import sys
+import json
+import numpy as np
+import xarray as xa
+import pytest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..'))
+import StraitFlux.preprocessing as prepro
+import StraitFlux.index_library as index_library
+from StraitFlux.indices import check_availability_indices
+
+
+@pytest.fixture
+def file_t(tmp_path):
+    '''Global 1 degree thetao file on a regular grid'''
+    lon=np.arange(-179.5,180,1.)
+    lat=np.arange(-89.5,90,1.)
+    ds=xa.Dataset({'thetao':(('time','lev','lat','lon'),np.ones((2,3,len(lat),len(lon)),dtype='float32'))},
+                  coords={'time':np.array(['2000-01-16','2000-02-15'],dtype='datetime64[ns]'),'lev':[5.,15.,25.],'lat':lat,'lon':lon})
+    file=str(tmp_path/'thetao_Omon_test_historical_r1i1p1f1_gn_200001-200002.nc')
+    ds.to_netcdf(file)
+    return file
+
+
+@pytest.fixture
+def library(tmp_path):
+    path=str(tmp_path/'library')
+    os.makedirs(path)
+    return path
+
+
+def test_lookup_built(file_t,library):
+    fingerprint=index_library.build(file_t,'test',['test-model'],straits=['Fram','Bering'],path=library)
+    assert fingerprint == prepro.file_fingerprint(file_t)
+    manifest=index_library.read_manifest(library)
+    assert manifest['grids'][fingerprint]['straits'] == ['Bering','Fram']
+    assert manifest['grids'][fingerprint]['models'] == ['test-model']
+    for strait in ['Fram','Bering']:
+        indices,line=check_availability_indices(prepro.probe_grid(file_t),strait,'test',0,0,0,False)
+        xa.testing.assert_equal(index_library.lookup(strait,fingerprint,path=library),indices)
+
+
+def test_lookup_missing(file_t,library):
+    fingerprint=index_library.build(file_t,'test',['test-model'],straits=['Fram'],path=library)
+    assert index_library.lookup('Bering',fingerprint,path=library) is None
+    assert index_library.lookup('Fram','0'*len(fingerprint),path=library) is None
+    assert index_library.lookup('Fram',fingerprint,path=str(os.path.dirname(library))) is None
+
+
+def test_build_skips_existing(file_t,library,monkeypatch):
+    fingerprint=index_library.build(file_t,'test',['test-model'],straits=['Fram'],path=library)
+    calculated=[]
+    def check(Tdataset,strait,*args):
+        calculated.append(strait)
+        return check_availability_indices(Tdataset,strait,*args)
+    monkeypatch.setattr(index_library,'check_availability_indices',check)
+    index_library.build(file_t,'test',['other-model'],straits=['Fram','Bering'],path=library)
+    assert calculated == ['Bering']
+    grid=index_library.read_manifest(library)['grids'][fingerprint]
+    assert grid['straits'] == ['Bering','Fram']
+    assert grid['models'] == ['other-model','test-model']
+    index_library.build(file_t,'test',['test-model'],straits=['Fram','Bering'],path=library)
+    assert calculated == ['Bering']
+    index_library.build(file_t,'test',['test-model'],straits=['Fram'],path=library,overwrite=True)
+    assert calculated == ['Bering','Fram']
+
+
+def test_version_mismatch(file_t,library):
+    fingerprint=index_library.build(file_t,'test',['test-model'],straits=['Fram'],path=library)
+    manifest=index_library.read_manifest(library)
+    manifest['version']=index_library.version+1
+    with open(os.path.join(library,'manifest.json'),'w') as f:
+        json.dump(manifest,f)
+    assert index_library.lookup('Fram',fingerprint,path=library) is None
+    # build replaces a library of another version
+    index_library.build(file_t,'test',['test-model'],straits=['Bering'],path=library)
+    manifest=index_library.read_manifest(library)
+    assert manifest['version'] == index_library.version
+    assert manifest['grids'][fingerprint]['straits'] == ['Bering']
+    assert index_library.lookup('Fram',fingerprint,path=library) is None
+    assert index_library.lookup('Bering',fingerprint,path=library) is not None
@@ -0,0 +1,52 @@
+import os
+import sys
+import numpy as np
+import xarray as xa
+import pytest
+
+sys.path.insert(0,os.path.join(os.path.dirname(os.path.abspath(__file__)),'..','..'))
+import StraitFlux.preprocessing as prepro
+from StraitFlux.indices import selection_window, distance, check_availability_indices
+
+
+def regular_grid(res=1.):
+    '''Global grid with cell centres at x.5 (for res=1), as normalized by preprocessing.wrapper'''
+    lon=np.arange(-180+res/2,180,res)
+    lat=np.arange(-90+res/2,90,res)
+    lon2d,lat2d=np.meshgrid(lon,lat)
+    return xa.Dataset({'thetao':(('y','x'),np.zeros(lon2d.shape))},
+                      coords={'lat':(('y','x'),lat2d),'lon':(('y','x'),lon2d),'x':np.arange(len(lon)),'y':np.arange(len(lat))})
+
+
+def first_minimum(lat,lon,lat_p,lon_p,tol=1e-6):
+    '''Reference: scan of all grid points for the first minimal distance (up to tol in km, the rounding of distance)'''
+    dist=distance(lat_p,lon_p,lat,lon)
+    return np.unravel_index(np.argmax(dist<=np.min(dist)+tol),np.shape(lat))
+
+
+@pytest.mark.parametrize('lat_p,lon_p',[(78.5,18.),(78.,18.),(78.,18.5),(-3.,118.),(0.,0.),(89.9,-179.9)])
+def test_nearest_points_ties(lat_p,lon_p):
+    # points exactly between cell centres take the one with the lowest flat index, as the first minimum
+    T=regular_grid()
+    lat,lon=T.lat.values,T.lon.values
+    yloc,xloc=first_minimum(lat,lon,lat_p,lon_p)
+    assert np.unravel_index(prepro.nearest_points(lat,lon,lat_p,lon_p),lat.shape)==(yloc,xloc)
+    assert selection_window(lat_p,lon_p,lat,lon,T)==(xloc,yloc)
+
+
+def test_nearest_points_random():
+    rng=np.random.default_rng(0)
+    T=regular_grid(2.)
+    lat,lon=T.lat.values,T.lon.values
+    lat_p,lon_p=rng.uniform(-89,89,50),rng.uniform(-180,180,50)
+    # half of the points on cell edges or corners
+    lat_p[::2],lon_p[::2]=np.round(lat_p[::2]),np.round(lon_p[::2])
+    nearest=prepro.nearest_points(lat,lon,lat_p,lon_p)
+    for n,la,lo in zip(nearest,lat_p,lon_p):
+        assert np.unravel_index(n,lat.shape)==first_minimum(lat,lon,la,lo)
+
+
+def test_makassar_start():
+    # the first point of Makassar lies between two cell centres of the 1 degree grid
+    indices=check_availability_indices(regular_grid(),'Makassar','M',0,0,0,False)[0].indices.values
+    assert tuple(indices[0,2:4])==(295,87)
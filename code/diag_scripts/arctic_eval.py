@@ -1,6 +1,9 @@
+import os
 import matplotlib.pyplot as plt
 import logging
 import pickle
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
 
 logger = logging.getLogger(__name__)
 
@@ -8,11 +11,13 @@ from esmvaltool.diag_scripts.shared import run_diagnostic
 
 from arctic_seaice.plotting import SeasonalCycle, GeoMap, Timeseries, StraitFluxPlotter, RegionPlotter
 
-from arctic_seaice.utils import save_object, get_format_properties
+from arctic_seaice.utils import save_object, get_format_properties, set_region_cache_dir, select_input_data_entry
 from arctic_seaice.utils import ProvenanceRecord 
 
 from StraitFlux import masterscript_line as sf_line
 from StraitFlux import masterscript_cross as sf_cross
+from StraitFlux import index_library
+from StraitFlux.indices import predefined_straits
 
 
 def dummy_plot():
@@ -20,6 +25,79 @@ def dummy_plot():
     plt.plot([1,2,3],[3,4,5])
     plt.savefig('dummy.png')
 
+def get_n_workers(cfg):
+    '''Number of worker processes for the strait x model jobs, from n_workers in the recipe or max_parallel_tasks (default 1, i.e. serial).'''
+    n_workers = cfg.get('n_workers', cfg.get('max_parallel_tasks'))
+    if n_workers is None:
+        n_workers = 1
+    return int(n_workers)
+
+def run_jobs(function, jobs, n_workers=1):
+    '''Run function(*job) for each job in jobs, in a process pool if n_workers > 1, and return the results in the order of jobs.'''
+    if n_workers <= 1 or len(jobs) <= 1:
+        return [function(*job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=min(n_workers, len(jobs)), mp_context=multiprocessing.get_context('spawn')) as executor:
+        futures = [executor.submit(function, *job) for job in jobs]
+        return [future.result() for future in futures]
+
+def run_strait_model_jobs(function, cfg, extra_args=()):
+    '''
+    Run function(input_data, strait, model, *extra_args) for every strait and model, and return a dict keyed by (strait, model).
+
+    The grid type, mesh and indices files are shared by all straits of a model and by models on the same grid. StraitFlux
+    writes them atomically, so parallel jobs never read a partly written file; the first strait of each model is computed
+    before the others so that the files of a model are calculated once rather than by every job.
+    '''
+    n_workers = get_n_workers(cfg)
+    first_jobs = [(cfg['input_data'], cfg['strait'][0], model) + tuple(extra_args) for model in cfg['model_datasets']]
+    other_jobs = [(cfg['input_data'], strait, model) + tuple(extra_args) for strait in cfg['strait'][1:] for model in cfg['model_datasets']]
+    results = run_jobs(function, first_jobs, n_workers) + run_jobs(function, other_jobs, n_workers)
+    return {(job[1], job[2]): result for job, result in zip(first_jobs + other_jobs, results)}
+
+def build_index_library(cfg):
+    '''
+    Add the pre-defined straits of the recipe to the StraitFlux index library for the grid of each model, from its thetao file.
+    Only straits missing for a grid are calculated, so later runs take all indices from the library instead of reading the global fields.
+    '''
+    straits = [strait for strait in cfg['strait'] if strait in predefined_straits]
+    for model in cfg['model_datasets']:
+        file_t = select_input_data_entry(cfg['input_data'], model, 'thetao')
+        if file_t is None:
+            continue
+        try:
+            index_library.build(file_t, model, [model], straits=straits)
+        except OSError as err:
+            print('Could not add %s to the index library: %s' % (model, err))
+
+def compute_strait_flux_transports(input_data, strait, model, time_chunk=None, scheduler=None):
+    '''Calculate volume, heat and salt transports for one strait and model. May run in a worker process, so only the transports are returned.'''
+    sf_loader = StraitFluxPlotter(input_data, model, 'thetao')
+    sf_params = sf_loader.make_params(strait=strait, model=model, time_chunk=time_chunk, scheduler=scheduler)
+    sf_loader.call_strait_flux_integrated_multi(sf_line.transports_multi, sf_params, products=['volume', 'heat', 'salt'])
+    return sf_loader.transports
+
+def compute_strait_flux_transports_batched(input_data, straits, model, time_chunk=None, scheduler=None):
+    '''Calculate volume, heat and salt transports for all straits of one model, sharing the data reads between straits.'''
+    sf_loader = StraitFluxPlotter(input_data, model, 'thetao')
+    sf_params = sf_loader.make_params(model=model, time_chunk=time_chunk, scheduler=scheduler)
+    return sf_loader.call_strait_flux_integrated_straits(sf_line.transports_straits, sf_params, straits, products=['volume', 'heat', 'salt'])
+
+def compute_strait_flux_crosssections(input_data, strait, model, time_start, time_end, scheduler=None):
+    '''Calculate T, S and uv crosssections for one strait and model. May run in a worker process, so only the crosssections are returned.'''
+    sf_loader = StraitFluxPlotter(input_data, model, 'thetao')
+    sf_params = sf_loader.make_params(strait=strait, model=model, time_start=time_start, time_end=time_end, scheduler=scheduler)
+
+    # Calculate temperature crosssection
+    sf_params['product'] = 'T'
+    sf_loader.call_strait_flux_cross_TS(sf_cross.TS_interp, sf_params)
+
+    sf_params['product'] = 'S'
+    sf_loader.call_strait_flux_cross_TS(sf_cross.TS_interp, sf_params)
+
+    sf_params['product'] = 'uv'
+    sf_loader.call_strait_flux_cross_uv(sf_cross.vel_projection, sf_params)
+    return sf_loader.crosssections
+
 def plot_ocean_strait_flux_timeseries(cfg):
     print('SF timeseries')
     input_data= cfg['input_data']
@@ -29,12 +107,26 @@ def plot_ocean_strait_flux_timeseries(cfg):
 
     formatting = get_format_properties()
 
+    # Strait indices are taken from the index library, which is filled on the first run on a grid
+    build_index_library(cfg)
+
     compiled_data = {}
     for model in cfg['model_datasets']:
         compiled_data[model] = {}
         for strait in cfg['strait']:
             compiled_data[model][strait] = []
 
+    # Calculate the transports for every strait and model, in parallel if n_workers (or max_parallel_tasks) > 1
+    # If requested, the transports for all straits of a model are calculated at once, sharing the data reads between straits
+    # and the time axis is processed in pieces of time_chunk time steps to bound the memory use
+    # If dask_scheduler is set, each calculation is built as a lazy dask graph and computed on that scheduler
+    if cfg.get('batch_straits', False):
+        jobs = [(input_data, cfg['strait'], model, cfg.get('time_chunk'), cfg.get('dask_scheduler')) for model in cfg['model_datasets']]
+        results = run_jobs(compute_strait_flux_transports_batched, jobs, get_n_workers(cfg))
+        all_transports = {(strait, model): result[strait] for model, result in zip(cfg['model_datasets'], results) for strait in cfg['strait']}
+    else:
+        all_transports = run_strait_model_jobs(compute_strait_flux_transports, cfg, extra_args=(cfg.get('time_chunk'), cfg.get('dask_scheduler')))
+
     for strait in cfg['strait']:
         # Loop over model datasets
         for model in cfg['model_datasets']:
@@ -55,17 +147,9 @@ def plot_ocean_strait_flux_timeseries(cfg):
             # Make provenance record
             provenance_record = ProvenanceRecord()
 
-            # Calculate transported heat 
+            # Add the transported volume, heat and salt calculated above
             #sf_params = sf_loader.make_params(product='ice', Arakawa='Arakawa-B')
-            sf_params = sf_loader.make_params(product='heat', strait=strait, model=model)
-            heat_transport = sf_loader.call_strait_flux_integrated(sf_line.transports, sf_params)
-            # Calculate transported salt
-            sf_params['product'] = 'salt'
-            salt_transport = sf_loader.call_strait_flux_integrated(sf_line.transports, sf_params)
-
-            # Calculate transported volume
-            sf_params['product'] = 'volume'
-            volume_transport = sf_loader.call_strait_flux_integrated(sf_line.transports, sf_params)
+            sf_loader.set_transports(all_transports[(strait, model)], products=['volume', 'heat', 'salt'])
             # Correct units
             sf_loader.correct_units(['volume','heat'])
 
@@ -123,6 +207,12 @@ def plot_ocean_strait_flux_crosssection(cfg):
         print(key)
         print(input_data[key])
 
+    # Strait indices are taken from the index library, which is filled on the first run on a grid
+    build_index_library(cfg)
+
+    # Calculate the crosssections for every strait and model, in parallel if n_workers (or max_parallel_tasks) > 1
+    all_crosssections = run_strait_model_jobs(compute_strait_flux_crosssections, cfg, extra_args=(cfg['time_start'], cfg['time_end'], cfg.get('dask_scheduler')))
+
     for strait in cfg['strait']:
         # Loop over model datasets
         for model in cfg['model_datasets']:
@@ -141,22 +231,12 @@ def plot_ocean_strait_flux_crosssection(cfg):
             # Make provenance record
             provenance_record = ProvenanceRecord()
 
-            # Calculate transported volume 
+            # Add the T, S and uv crosssections calculated above
             sf_params = sf_loader.make_params(strait=strait, model=model, time_start=cfg['time_start'], time_end=cfg['time_end'], depth=cfg['strait_depths'][strait])
-            
-
-            # Calculate temperature crosssection
-            sf_params['product'] = 'T'
-            T_cross = sf_loader.call_strait_flux_cross_TS(sf_cross.TS_interp, sf_params)
-
-            sf_params['product'] = 'S'
-            S_cross = sf_loader.call_strait_flux_cross_TS(sf_cross.TS_interp, sf_params)
+            sf_loader.crosssections.update(all_crosssections[(strait, model)])
             # Correct units
             # sf_loader.correct_units(['volume','heat'])
 
-            sf_params['product'] = 'uv'
-            uv_cross = sf_loader.call_strait_flux_cross_uv(sf_cross.vel_projection, sf_params)
-
             # Add ancestors to provenance record
             provenance_record.add_ancestors(sf_loader.provenance_list)
 
@@ -188,56 +268,60 @@ def plot_seasonal_cycles(cfg):
     if not regions:
         regions = ['Arctic']
 
-    # Loop over regions
-    for region in regions:
-        print('Plotting seasonal cycles for region: %s' % region)
+    # Loop over variables
+    for variable in cfg['variables_to_plot']:
+        print('Plotting seasonal cycles of %s for regions: %s' % (variable, regions))
+        # Create figure and provenance record for one variable in each region
+        figs, axes, provenance_records, captions = {}, {}, {}, {}
+        for region in regions:
+            figs[region] = plt.figure(dpi=300)
+            axes[region] = figs[region].add_subplot(111)
+            provenance_records[region] = ProvenanceRecord(region=region)
 
-        # Loop over variables
-        for variable in cfg['variables_to_plot']:
-            # Create figure for one variable
-            fig = plt.figure(dpi=300)
-            ax = fig.add_subplot(111)
-
-            # Create provenance record for one variable
-            provenance_record = ProvenanceRecord(region=region)
-
-            # Loop over model datasets
-            for dataset in cfg['model_datasets']:
-                # Get colour for dataset
-                colour = formatting['dataset'][dataset]['colour']
-                try:
-                    # Create seasonal cycle object for dataset and variable
-                    seasonal_cycle = SeasonalCycle(input_data, dataset, variable, aliases=[dataset+'Mean', dataset+'Min', dataset+'Max'], region=region)
-                    # Plot seasonal cycle to axes for that variable
-                    seasonal_cycle.plot(ax, line_parameters={'colour': colour})
+        # Loop over model datasets
+        for dataset in cfg['model_datasets']:
+            # Get colour for dataset
+            colour = formatting['dataset'][dataset]['colour']
+            try:
+                # Create seasonal cycle object for dataset and variable, reading the data once for all regions
+                seasonal_cycle = SeasonalCycle(input_data, dataset, variable, aliases=[dataset+'Mean', dataset+'Min', dataset+'Max'], regions=regions)
+                for region in regions:
+                    # Plot seasonal cycle to axes for that variable and region
+                    seasonal_cycle.select_region(region)
+                    seasonal_cycle.plot(axes[region], line_parameters={'colour': colour})
+                    captions[region] = seasonal_cycle.caption
                     # Add ancestors to provenance record
-                    provenance_record.add_ancestors(seasonal_cycle.provenance_list)
-                except:
-                    logger.warning('ERROR: Something went wrong while initialising SeasonalCycle for %s %s' % (variable, dataset))
+                    provenance_records[region].add_ancestors(seasonal_cycle.provenance_list)
+            except:
+                logger.warning('ERROR: Something went wrong while initialising SeasonalCycle for %s %s' % (variable, dataset))
 
-            if variable in cfg['variables_to_plot_obs']:
-                # If the variable has been specified to plot an observational dataset, we plot that here
-                obs_dataset = cfg['obs_datasets'][variable]
-                # Get colour for dataset
-                colour = formatting['dataset'][obs_dataset]['colour']
-                # If variable==sivol, we need to start working with thickness for piomas
-                if variable == 'sivol':
-                    obs_variable = 'sithick'
-                else:
-                    obs_variable = variable
-                # Try alias = 'OBS' first, if that fails try OBS_<dataset>
-                try:
-                    seasonal_cycle = SeasonalCycle(input_data, obs_dataset, obs_variable, aliases=['OBS'], region=region)
-                except:
-                    seasonal_cycle = SeasonalCycle(input_data, obs_dataset, obs_variable, aliases=['OBS_' + obs_dataset], region=region)
-                # Plot seasonal cycle to axes for that variable                 
-                seasonal_cycle.plot(ax, line_parameters={'colour': colour})
+        if variable in cfg['variables_to_plot_obs']:
+            # If the variable has been specified to plot an observational dataset, we plot that here
+            obs_dataset = cfg['obs_datasets'][variable]
+            # Get colour for dataset
+            colour = formatting['dataset'][obs_dataset]['colour']
+            # If variable==sivol, we need to start working with thickness for piomas
+            if variable == 'sivol':
+                obs_variable = 'sithick'
+            else:
+                obs_variable = variable
+            # Try alias = 'OBS' first, if that fails try OBS_<dataset>
+            try:
+                seasonal_cycle = SeasonalCycle(input_data, obs_dataset, obs_variable, aliases=['OBS'], regions=regions)
+            except:
+                seasonal_cycle = SeasonalCycle(input_data, obs_dataset, obs_variable, aliases=['OBS_' + obs_dataset], regions=regions)
+            for region in regions:
+                # Plot seasonal cycle to axes for that variable and region
+                seasonal_cycle.select_region(region)
+                seasonal_cycle.plot(axes[region], line_parameters={'colour': colour})
+                captions[region] = seasonal_cycle.caption
                 # Add ancestors to provenance record
-                provenance_record.add_ancestors(seasonal_cycle.provenance_list)
-            
-            provenance_record.record['caption'] = seasonal_cycle.caption
+                provenance_records[region].add_ancestors(seasonal_cycle.provenance_list)
+
+        for region in regions:
+            provenance_records[region].record['caption'] = captions[region]
             # Save figure to output dir and add it to provenance record
-            save_object(fig, variable + '_' + region + '_seasonal_cycle.png', cfg, provenance_record.record)
+            save_object(figs[region], variable + '_' + region + '_seasonal_cycle.png', cfg, provenance_records[region].record)
 
 def plot_geographical_maps(cfg):
     '''Plot geographical map for a list of variables and datasets given in config dictionary from esmvaltool recipe.'''
@@ -285,10 +369,11 @@ def plot_geographical_maps(cfg):
             irow = 0
             for dataset in cfg['model_datasets']:
 
+                # Load the data once, the monthly slices are taken from the same GeoMap
+                geo_map = GeoMap(input_data, dataset, variable, aliases=[dataset+'Mean'], region=region)
+
                 # Loop over desired time slices
                 for igs, time_slice in enumerate(cfg['months']):
-                
-                    geo_map = GeoMap(input_data, dataset, variable, aliases=[dataset+'Mean'], region=region)
 
                     # Make a new data variable in geo_map.data. In this case we take a monthly slice
                     subset = geo_map.get_month_slice(time_slice, statistics='time_mean')
@@ -315,16 +400,16 @@ def plot_geographical_maps(cfg):
                 # # Add gridspec for the figure
                 # gs = fig.add_gridspec(nrows=1, ncols=len(cfg['months']))
 
+                # We try passing two aliases here to make things more general
+                # If there is only one OBS dataset, it gets passed as 'OBS' by valtool, but if there are more they get passed as OBS_<dataset>
+                try:
+                    geo_map = GeoMap(input_data, obs_dataset, variable, aliases=['OBS'], region=region)
+                except:
+                    print('Trying with alias OBS_' + obs_dataset)
+                    geo_map = GeoMap(input_data, obs_dataset, variable, aliases=['OBS_' + obs_dataset], region=region)
+
                 # Loop over desired time slices
                 for igs, time_slice in enumerate(cfg['months']):
-                    
-                    # We try passing two aliases here to make things more general
-                    # If there is only one OBS dataset, it gets passed as 'OBS' by valtool, but if there are more they get passed as OBS_<dataset>
-                    try:
-                        geo_map = GeoMap(input_data, obs_dataset, variable, aliases=['OBS'], region=region)
-                    except:
-                        print('Trying with alias OBS_' + obs_dataset)
-                        geo_map = GeoMap(input_data, obs_dataset, variable, aliases=['OBS_' + obs_dataset], region=region)
 
                     # Make a new data variable in geo_map.data. In this case we take a monthly slice
                     subset = geo_map.get_month_slice(time_slice, statistics='time_mean')
@@ -386,68 +471,57 @@ def plot_timeseries(cfg):
     # Get regions to plot
     regions = cfg['regions']
     if not regions:
-        region = ['Arctic']
-    
-    # Loop over regions
-    for region in regions:
-        print('Plotting seasonal cycles for region: %s' % region)
-
-        # Loop over variables
-        for variable in cfg['variables_to_plot']:
-            # Create figure for one variable
-            fig = plt.figure(dpi=300)
-            ax = fig.add_subplot(111)
+        regions = ['Arctic']
 
-            # Create provenance record for one variable
-            provenance_record = ProvenanceRecord()
+    # Loop over variables
+    for variable in cfg['variables_to_plot']:
+        print('Plotting timeseries of %s for regions: %s' % (variable, regions))
+        # Create figure and provenance record for one variable in each region
+        figs, axes, provenance_records, captions = {}, {}, {}, {}
+        for region in regions:
+            figs[region] = plt.figure(dpi=300)
+            axes[region] = figs[region].add_subplot(111)
+            provenance_records[region] = ProvenanceRecord()
 
-            # Loop over model datasets
-            for dataset in cfg['model_datasets']:
-                # Get colour for dataset
-                colour = formatting['dataset'][dataset]['colour']
-                try:
-                    # Create timeseries object for dataset and variable
-                    timeseries = Timeseries(input_data, dataset, variable, aliases=[dataset+'Mean'], region=region)
-                    # Plot timeseries to axes for that variable
-                    timeseries.plot(ax, line_parameters={'colour': colour}, running_mean_window=cfg['running_mean_window'])
+        # Loop over model datasets
+        for dataset in cfg['model_datasets']:
+            # Get colour for dataset
+            colour = formatting['dataset'][dataset]['colour']
+            try:
+                # Create timeseries object for dataset and variable, reading the data once for all regions
+                timeseries = Timeseries(input_data, dataset, variable, aliases=[dataset+'Mean'], regions=regions)
+                for region in regions:
+                    # Plot timeseries to axes for that variable and region
+                    timeseries.select_region(region)
+                    timeseries.plot(axes[region], line_parameters={'colour': colour}, running_mean_window=cfg['running_mean_window'])
+                    captions[region] = timeseries.caption
                     # Add ancestors to provenance record
-                    provenance_record.add_ancestors(timeseries.provenance_list)
-                except:
-                    logger.warning('No data found for %s %s' % (variable, dataset))
+                    provenance_records[region].add_ancestors(timeseries.provenance_list)
+            except:
+                logger.warning('No data found for %s %s' % (variable, dataset))
 
-            if variable in cfg['variables_to_plot_obs']:
-                # If the variable has been specified to plot an observational dataset, we plot that here
-                obs_dataset = cfg['obs_datasets'][variable]
-                # Get colour for dataset
-                colour = formatting['dataset'][obs_dataset]['colour']
-                # Try alias = 'OBS' first, if that fails try OBS_<dataset>
-                try:
-                    timeseries = Timeseries(input_data, obs_dataset, variable, aliases=['OBS'], region=region)
-                except:
-                    timeseries = Timeseries(input_data, obs_dataset, variable, aliases=['OBS_' + obs_dataset], region=region)
-                # Plot timeseries to axes for that variable                 
-                timeseries.plot(ax, line_parameters={'colour': colour}, running_mean_window=cfg['running_mean_window'])
+        if variable in cfg['variables_to_plot_obs']:
+            # If the variable has been specified to plot an observational dataset, we plot that here
+            obs_dataset = cfg['obs_datasets'][variable]
+            # Get colour for dataset
+            colour = formatting['dataset'][obs_dataset]['colour']
+            # Try alias = 'OBS' first, if that fails try OBS_<dataset>
+            try:
+                timeseries = Timeseries(input_data, obs_dataset, variable, aliases=['OBS'], regions=regions)
+            except:
+                timeseries = Timeseries(input_data, obs_dataset, variable, aliases=['OBS_' + obs_dataset], regions=regions)
+            for region in regions:
+                # Plot timeseries to axes for that variable and region
+                timeseries.select_region(region)
+                timeseries.plot(axes[region], line_parameters={'colour': colour}, running_mean_window=cfg['running_mean_window'])
+                captions[region] = timeseries.caption
                 # Add ancestors to provenance record
-                provenance_record.add_ancestors(timeseries.provenance_list)
-
-            # # Loop over observational datasets
-            # if cfg['obs_datasets']:
-            #     for dataset in cfg['obs_datasets']:
-            #         # Get colour for dataset
-            #         colour = formatting['dataset'][dataset]['colour']
-            #         try:
-            #             # Create timeseries object for observational dataset and variable
-            #             timeseries = Timeseries(input_data, dataset, variable, aliases=['OBS'], region=region)
-            #             # Plot timeseries to axes for that variable                 
-            #             timeseries.plot(ax, line_parameters={'colour': colour})
-            #             # Add ancestors to provenance record
-            #             provenance_record.add_ancestors(timeseries.provenance_list)
-            #         except:
-            #             logger.warning('No data found for %s %s' % (variable, dataset))
-            
-            provenance_record.record['caption'] = timeseries.caption
+                provenance_records[region].add_ancestors(timeseries.provenance_list)
+
+        for region in regions:
+            provenance_records[region].record['caption'] = captions[region]
             # Save figure to output dir and add it to provenance record
-            save_object(fig, variable + '_' + region + '_timeseries.png', cfg, provenance_record.record)
+            save_object(figs[region], variable + '_' + region + '_timeseries.png', cfg, provenance_records[region].record)
 
 def plot_regions(cfg):
     # For each model, plot one axes with all regions
@@ -494,6 +568,9 @@ def plot_regions(cfg):
 def main(cfg):
     ''' Execute the diagnostoc for a given configuration dictionary from esmvaltool recipe.'''
 
+    # Region masks and weights are cached per grid, in region_cache_dir if given in the recipe (to share them between runs)
+    set_region_cache_dir(os.path.expanduser(cfg.get('region_cache_dir', os.path.join(cfg['work_dir'], 'region_cache'))))
+
     if cfg['script'] == 'seasonal_cycle':
         plot_seasonal_cycles(cfg)
 
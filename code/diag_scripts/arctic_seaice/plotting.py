@@ -25,12 +25,13 @@ class SeasonalCycle(Loader):
     variable (str) -- variable name (short CMOR name)
     aliases (list) -- list of aliases for the various dataset entries (i.e. ['Mean', 'Min', 'Max']) (default [None])
     region (str) -- region to plot the seasonal cycle for (default None)
+    regions (list) -- regions to derive from one read of the data, picked for plotting with select_region (default None)
     '''
-    def __init__(self, input_data, dataset, variable, aliases=[None], region=None):
+    def __init__(self, input_data, dataset, variable, aliases=[None], region=None, regions=None):
         ''' Initialise the SeasonalCycle object. '''
 
         # Initialise from Loader, which assigns attributes and loads the data
-        super().__init__(input_data, dataset, variable, aliases, region=region)
+        super().__init__(input_data, dataset, variable, aliases, region=region, regions=regions)
 
         print('SeasonalCycle: __init__: ')
         print('For dataset %s and variable %s' % (self.dataset, self.variable))
@@ -45,26 +46,39 @@ class SeasonalCycle(Loader):
         # Add variable specific attributes and perform variable specific procesing steps
         # The data passed by the loader should be gridded, 2D, and have been preprocessed into monthly means for each gridcell (so month_number x latitude x longitide)
         # ----- siconc
+        # With several regions, the area statistics of all regions are calculated at once (see Loader.sum_over_regions)
         if self.variable == 'siconc':
-            self.multiply_by_area()
-            self.sum_over_area()
-            self.update_units(10**-14) # units after integrating are 10**-2 m2 in the input data. Multiply these by 10**-14 to get Mkm2
+            if self.regions is None:
+                self.integrate_over_area(10**-14) # units after integrating are 10**-2 m2 in the input data. Multiply these by 10**-14 to get Mkm2
+            else:
+                self.sum_over_regions(10**-14)
             self.yvar_description = 'sum of sea ice area [Mkm^2]'
         # ----- sivol (note, for sivol the obs are piomas which take thickness. There is a separate entry for that)
         elif (self.variable == 'sivol') or (self.variable == 'sithick'):
             if (not self.dataset == 'PIOMAS') and (self.variable == 'sithick'):
                 print('Warning: sithick should only be used for PIOMAS dataset. Using it for %s' % self.dataset)
                 print('If a seasonal cycle of thickness (i.e. the mean thickness) is needed, new functionality needs to be added.')
-            self.multiply_by_area()
-            self.sum_over_area()
-            self.update_units(10**-12) # units are m3, so we multiply by 10**-12 to get 1000.km3
+            if self.regions is None:
+                self.integrate_over_area(10**-12) # units are m3, so we multiply by 10**-12 to get 1000.km3
+            else:
+                self.sum_over_regions(10**-12)
             self.yvar_description = 'sum of sea ice volume [1000.km^3]'
         elif self.variable == 'sisnthick':
-            self.cell_area_weighted_mean()
+            if self.regions is None:
+                self.cell_area_weighted_mean()
+            else:
+                self.cell_area_weighted_mean_over_regions()
             self.yvar_description = 'sea ice thickness [m]'
         # <<<<<<<<<<<<<<<<<<<<
 
         # Make caption for the figure
+        if self.regions is None:
+            self.caption = utils.make_figure_caption(self.plot_description, self.yvar_description, self.region, self.timerange)
+            print(self.caption)
+
+    def select_region(self, region):
+        ''' Pick one of the regions for plotting and update the caption. '''
+        super().select_region(region)
         self.caption = utils.make_figure_caption(self.plot_description, self.yvar_description, self.region, self.timerange)
         print(self.caption)
 
@@ -93,7 +107,7 @@ class SeasonalCycle(Loader):
         else:
             print('Use case for more than three files in seasonal cycle not defined')
 
-        plt.legend()
+        ax.legend()
         
         if add_labels:
             ax.set_xlabel('Month')
@@ -187,10 +201,12 @@ class Timeseries(Loader):
     dataset (str) -- dataset name (dataset name from ESGF)
     variable (str) -- variable name (short CMOR name)
     aliases (list) -- list of aliases for the various dataset entries (i.e. ['Mean', 'Min', 'Max']) (default [None])
+    region (str) -- region to plot the timeseries for (default None)
+    regions (list) -- regions to derive from one read of the data, picked for plotting with select_region (default None)
     '''
-    def __init__(self, input_data, dataset, variable, aliases=[None], region=None):
+    def __init__(self, input_data, dataset, variable, aliases=[None], region=None, regions=None):
         ''' Initialise the Timeseries object. '''
-        super().__init__(input_data, dataset, variable, aliases, region=region)
+        super().__init__(input_data, dataset, variable, aliases, region=region, regions=regions)
         # TODO: make the following timeseries specific
         # TODO: eventually move the plot class initialisation code to utils as its largely shared accross plots
         print('Timeseries: __init__: ')
@@ -205,23 +221,30 @@ class Timeseries(Loader):
         # Add variable specific attributes and perform variable specific procesing steps
         # The data passed by loader should be gridded, 2D, and have a monthly time dimension
         # ----- siconc
+        # With several regions, the area statistics of all regions are calculated at once (see Loader.sum_over_regions)
         if self.variable == 'siconc':
-            self.multiply_by_area()
-            self.sum_over_area()
-            self.update_units(10**-14) # units after integrating are 10**-2 m2 in the input data. Multiply these by 10**-14 to get Mkm2
+            if self.regions is None:
+                self.integrate_over_area(10**-14) # units after integrating are 10**-2 m2 in the input data. Multiply these by 10**-14 to get Mkm2
+            else:
+                self.sum_over_regions(10**-14)
             self.yvar_description = 'sum of sea ice area [Mkm^2]'
         elif self.variable == 'sithick':
-            self.multiply_by_area()
-            self.sum_over_area()
-            self.update_units(10**-12) # units are m3, so we multiply by 10**-12 to get 1000.km3
+            if self.regions is None:
+                self.integrate_over_area(10**-12) # units are m3, so we multiply by 10**-12 to get 1000.km3
+            else:
+                self.sum_over_regions(10**-12)
             self.yvar_description = 'sum of sea ice volume [1000.km^3]'
         elif self.variable == 'sisnthick':
-            self.cell_area_weighted_mean()
+            if self.regions is None:
+                self.cell_area_weighted_mean()
+            else:
+                self.cell_area_weighted_mean_over_regions()
             self.yvar_description = 'sea ice thickness [m]'
 
         # Make caption for the figure
-        self.caption = utils.make_figure_caption(self.plot_description, self.yvar_description, self.region, self.timerange)
-        print(self.caption)
+        if self.regions is None:
+            self.caption = utils.make_figure_caption(self.plot_description, self.yvar_description, self.region, self.timerange)
+            print(self.caption)
 
         print(self.data['main'].coord('time').points)
         print(type(self.data['main'].coord('time').points))
@@ -229,6 +252,12 @@ class Timeseries(Loader):
         # Make time axis
         self.make_timeseries_xaxis()
 
+    def select_region(self, region):
+        ''' Pick one of the regions for plotting and update the caption. '''
+        super().select_region(region)
+        self.caption = utils.make_figure_caption(self.plot_description, self.yvar_description, self.region, self.timerange)
+        print(self.caption)
+
     def plot(self, ax, line_parameters=None, add_labels=True, running_mean_window=None):
         ''' Plot the timeseries data.
         
@@ -269,7 +298,7 @@ class Timeseries(Loader):
             running_mean = da_monthly.rolling(time=running_mean_window, center=True).mean()
             running_mean.plot.line(ax=ax, color=colour) #, label='Running mean (%d months)' % running_mean_window)
 
-        plt.legend()
+        ax.legend()
         
         if add_labels:
             ax.set_xlabel('Time')
@@ -363,6 +392,58 @@ class StraitFluxPlotter(Loader):
         self.transports[parameters['product']] = transport[parameters['model']]
         return self.transports[parameters['product']]
     
+    def call_strait_flux_integrated_multi(self, master_function, parameters, products=['volume', 'heat', 'salt']):
+        # Calculate several ocean transports from a single read of the strait subdomain (i.e. sf_line.transports_multi)
+        if 'salt' in products:
+            file_s = self.strait_flux_inputs['s']
+        else:
+            file_s = ''
+        transport = master_function(products=products,
+                                    strait=parameters['strait'],
+                                    model=parameters['model'],
+                                    file_u=self.strait_flux_inputs['uo'],
+                                    file_v=self.strait_flux_inputs['vo'],
+                                    file_t=self.strait_flux_inputs['t'],
+                                    file_z=self.strait_flux_inputs['z'],
+                                    file_s=file_s,
+                                    time_start=parameters['time_start'],
+                                    time_end=parameters['time_end'],
+                                    Arakawa=parameters['Arakawa'],
+                                    time_chunk=parameters['time_chunk'],
+                                    scheduler=parameters['scheduler'])
+
+        # The data are stored in an xarray DS with one variable per product, we make a DA for each transport
+        for product in products:
+            self.transports[product] = transport[product]
+        return transport
+
+    def call_strait_flux_integrated_straits(self, master_function, parameters, straits, products=['volume', 'heat', 'salt']):
+        # Calculate ocean transports for several straits, sharing the data reads between straits (i.e. sf_line.transports_straits)
+        if 'salt' in products:
+            file_s = self.strait_flux_inputs['s']
+        else:
+            file_s = ''
+        transports = master_function(products=products,
+                                    straits=straits,
+                                    model=parameters['model'],
+                                    file_u=self.strait_flux_inputs['uo'],
+                                    file_v=self.strait_flux_inputs['vo'],
+                                    file_t=self.strait_flux_inputs['t'],
+                                    file_z=self.strait_flux_inputs['z'],
+                                    file_s=file_s,
+                                    time_start=parameters['time_start'],
+                                    time_end=parameters['time_end'],
+                                    Arakawa=parameters['Arakawa'],
+                                    time_chunk=parameters['time_chunk'],
+                                    scheduler=parameters['scheduler'])
+        # Returns a dict with one DS per strait, to be passed to set_transports
+        return transports
+
+    def set_transports(self, transport, products=['volume', 'heat', 'salt']):
+        # Store transports that were calculated elsewhere (i.e. by call_strait_flux_integrated_straits)
+        for product in products:
+            self.transports[product] = transport[product]
+
     def call_strait_flux_cross_uv(self, master_function, parameters):
         uv = master_function(strait=parameters['strait'],
                                     model=parameters['model'],
@@ -372,7 +453,8 @@ class StraitFluxPlotter(Loader):
                                     file_z=self.strait_flux_inputs['z'],
                                     time_start=parameters['time_start'],
                                     time_end=parameters['time_end'],
-                                    Arakawa=parameters['Arakawa'])
+                                    Arakawa=parameters['Arakawa'],
+                                    scheduler=parameters['scheduler'])
         self.crosssections[parameters['product']] = uv[parameters['product']]
         return self.crosssections[parameters['product']]
     
@@ -398,14 +480,16 @@ class StraitFluxPlotter(Loader):
         self.crosssections[parameters['product']] = T_or_S[parameters['product']]
         return self.crosssections[parameters['product']]
     
-    def make_params(self, product='heat', strait='Fram', model='HadGEM3-GC31-LL', time_start='1979-01', time_end='1981-12', Arakawa='Arakawa-C', depth=4000):
+    def make_params(self, product='heat', strait='Fram', model='HadGEM3-GC31-LL', time_start='1979-01', time_end='1981-12', Arakawa='Arakawa-C', depth=4000, time_chunk=None, scheduler=None):
         return {'product': product,
                 'strait': strait,
                 'model': model,
                 'time_start': time_start,
                 'time_end': time_end,
                 'Arakawa': Arakawa,
-                'depth': depth}
+                'depth': depth,
+                'time_chunk': time_chunk,
+                'scheduler': scheduler}
     
     def correct_units(self, transports):
         self.units = {'heat': 'W', 'volume': 'm^3', 'salt': 'g/s'}
@@ -1,14 +1,55 @@
 import os
 import yaml
 import datetime
+import hashlib
+import inspect
+from collections import OrderedDict
 
 import numpy as np
+import scipy.sparse
+import dask.array as da
 #import xarray as xr
 import iris
 
 from esmvaltool.diag_scripts.shared import ProvenanceLogger
 from esmvalcore.preprocessor import area_statistics
 
+# Process-wide cache of the cubes read by load_cube, keyed by (path, modification time)
+# The cache holds at most cube_cache_entries cubes, and their realised data at most cube_cache_size bytes
+cube_cache_size = 4 * 1024**3
+cube_cache_entries = 64
+_cube_cache = OrderedDict()
+
+def load_cube(path, realise=False):
+    '''Load a cube from a file, reading the metadata of each file only once per process.
+
+    Without realise the cached cube stays lazy. With realise=True the data are read once and kept, if they fit in cube_cache_size,
+    so the loaders of one dataset (e.g. SeasonalCycle, Timeseries and GeoMap) and small fields used by many loaders such as
+    areacello read each file only once; larger files stay lazy and are streamed by every loader. The least recently used cubes
+    are dropped when there are more than cube_cache_entries or their realised data exceed cube_cache_size.
+    Every call returns a copy of the cached cube that shares its data array, so callers may change metadata, coordinates and
+    replace .data freely, but must not modify the data in place.
+
+    Args:
+        path (str): Path to the netcdf file.
+        realise (bool): Realise and keep the data of the cube.
+
+    Returns:
+        iris.cube.Cube: Copy of the cached cube.
+    '''
+    key = (os.path.abspath(path), os.path.getmtime(path))
+    if key in _cube_cache:
+        _cube_cache.move_to_end(key)
+    else:
+        _cube_cache[key] = (iris.load_cube(path), 0)
+    cube, _ = _cube_cache[key]
+    if realise and cube.has_lazy_data() and cube.core_data().nbytes <= cube_cache_size:
+        cube.data  # realise the data once
+        _cube_cache[key] = (cube, cube.core_data().nbytes)
+    while len(_cube_cache) > cube_cache_entries or sum(size for _, size in _cube_cache.values()) > cube_cache_size:
+        _cube_cache.popitem(last=False)
+    return cube.copy(data=cube.core_data())
+
 
 class Loader():
     '''
@@ -19,6 +60,8 @@ class Loader():
     Data are loaded, and subset to a region if specified. Areacello data are also loaded and subset if passed by the recipe.
 
     Further processing (i.e. multiplying by area) is done in the inheriting class.
+    The data are read once per file and shared by the loaders of a dataset if they fit in cube_cache_size (see load_cube); the
+    processing works on cube.lazy_data(), so larger fields are streamed through dask and only the reduced series are realised.
 
     Args:
         input_data (dict): Dictionary containing the input data.
@@ -27,9 +70,12 @@ class Loader():
         aliases (list): List of aliases for the various dataset entries (i.e. ['Mean', 'Min', 'Max']) (default [None]).
         called_by (str): Name of the class that called the loader (default 'SeasonalCycle').
         region (str): Region to subset the data to (default None). If None, we subset to the whole Arctic.
+        regions (list): Regions to derive from the same data (default None). If given, the data are not subset; instead the
+                        area statistics of all regions are calculated at once (sum_over_regions, cell_area_weighted_mean_over_regions)
+                        and one region is picked for plotting with select_region.
 
     '''
-    def __init__(self, input_data, dataset, variable, aliases=[None], called_by='SeasonalCycle', region=None):
+    def __init__(self, input_data, dataset, variable, aliases=[None], called_by='SeasonalCycle', region=None, regions=None):
         print('Initialising loader')
         # Read arguments into self
         self.input_data = input_data
@@ -58,6 +104,11 @@ class Loader():
         self.region = region
         self._make_region_mask()
 
+        # Make stacked region weights if several regions are derived from the same data
+        self.regions = regions
+        if self.regions is not None:
+            self._make_region_weights()
+
         # Subset data to region if needed
         if self.region is not None:
             self._subset_data()
@@ -79,6 +130,8 @@ class Loader():
             print('No areacello data found.')
         if self.region is not None:
             print('Region: %s' % self.region)
+        elif self.regions is not None:
+            print('Regions: %s' % self.regions)
         else:
             print('No region specified.')
         
@@ -161,7 +214,7 @@ class Loader():
             print('No areacello data found for %s' % self.dataset)
             return None
         else:
-            return iris.load_cube(area_file)
+            return load_cube(area_file, realise=True)
         
     def _load_data(self):
         ''' Load data from input files into self.data.
@@ -170,14 +223,14 @@ class Loader():
             print('No data found for %s %s' % (self.dataset, self.variable))
             self.plot_type = 'no_data'
         elif len(self.input_files) == 1:
-            self.data = {'main': iris.load_cube(self.input_files['main']['file'])}
+            self.data = {'main': load_cube(self.input_files['main']['file'], realise=True)}
             print('1234567')
             print(self.data['main'])
             self.plot_type = 'single'
         elif len(self.input_files) == 3:
-            self.data = {'main': iris.load_cube(self.input_files['main']['file']),
-                         'min': iris.load_cube(self.input_files['min']['file']),
-                         'max': iris.load_cube(self.input_files['max']['file'])}
+            self.data = {'main': load_cube(self.input_files['main']['file'], realise=True),
+                         'min': load_cube(self.input_files['min']['file'], realise=True),
+                         'max': load_cube(self.input_files['max']['file'], realise=True)}
             self.plot_type = 'range'
             print(self.data['main'])
         else:
@@ -201,7 +254,7 @@ class Loader():
             # PIOMAS contains thickness data, so multiply by area to get volume
             if self.variable == 'sivol':
                 piomas_area_file = select_input_data_entry(self.input_data, 'PIOMAS', 'areacello', 'OBS')
-                self.data['area'] = iris.load_cube(piomas_area_file)['areacello']
+                self.data['area'] = load_cube(piomas_area_file)['areacello']
                 self.data['main'] = self.data['main'] * self.data['area']
                
     def _rename_variable(self):
@@ -226,17 +279,30 @@ class Loader():
         # This work is done by a function external to the loader
         region_mask, self.lon2d, self.lat2d = make_region_mask(self.region, self.data['main'].coord('longitude').points, self.data['main'].coord('latitude').points)
 
-        # Broadcast the region mask to the shape of the data
-        region_mask_b = np.broadcast_to(region_mask, self.data['main'].data.shape)
+        # Broadcast the region mask to the shape of the data (a view, and the data are not realised for their shape)
+        region_mask_b = np.broadcast_to(region_mask, self.data['main'].shape)
 
         self.region_mask, self.region_mask_b = region_mask, region_mask_b
 
+    def _make_region_weights(self):
+        '''
+        Stack the region masks of self.regions into a (region, y, x) boolean array, and, if areacello exists, make the sparse
+        (region, point) matrix of the masks multiplied by areacello. Both are cached on disk per grid (see make_region_mask and region_weights).
+        '''
+        masks = [make_region_mask(region, self.lon2d, self.lat2d)[0] for region in self.regions]
+        self.region_masks = np.stack(masks)
+        if self.data['areacello'] is not None:
+            self.region_weights = region_weights(self.regions, self.lon2d, self.lat2d, self.data['areacello'].data)
+        else:
+            self.region_weights = None
+        self.region_data = {}
+
     def _subset_data(self):    
-        ''' Subset data to the specified region using the region mask.'''
+        ''' Subset data to the specified region using the region mask. The data stay lazy.'''
         for ds in ['main', 'min', 'max']:
 
             try:
-                self.data[ds].data = np.ma.masked_where(~self.region_mask_b, self.data[ds].data)
+                self.data[ds].data = mask_lazy(self.data[ds].lazy_data(), self.region_mask)
             except:
                 print('No %s data found for %s so no mask applied' % (ds, self.dataset))
 
@@ -256,7 +322,7 @@ class Loader():
 
         In the case of HadISST siconc data, we don't do this step here as areacello doesn't exist. Instead we ultiply and sum together in _sum_over_area.
 
-        self.data are updated directly, resulting in units of 0.01 m2
+        self.data are updated directly (lazily), resulting in units of 0.01 m2
         '''
         print('Multiplying %s by areacello.' % self.variable)
         # self.data['main'] = self.data['main'] * self.data['areacello']
@@ -264,10 +330,11 @@ class Loader():
             print('Loader, _multiply_by_area: passing as %s does not have areacello' % self.dataset)
             self.multiplied_by_area = False
         else:
-            self.data['main'].data = self.data['main'].data * self.data['areacello'].data
+            area = self.data['areacello'].lazy_data()
+            self.data['main'].data = self.data['main'].lazy_data() * area
             if 'min' in self.data:
-                self.data['min'].data = self.data['min'].data * self.data['areacello'].data
-                self.data['max'].data = self.data['max'].data * self.data['areacello'].data
+                self.data['min'].data = self.data['min'].lazy_data() * area
+                self.data['max'].data = self.data['max'].lazy_data() * area
             self.multiplied_by_area = True
 
     def sum_over_area(self):
@@ -299,21 +366,118 @@ class Loader():
         '''
         print('Calculating cell area weighted mean of %s.' % self.variable)
 
-        # Broadcast areacello if necessary to get weights of the right shape
-        if self.data['areacello'].shape != self.data['main'].shape:
-            weights = np.broadcast_to(self.data['areacello'].data, self.data['main'].data.shape)
+        # Broadcast areacello if necessary to get weights of the right shape, lazily (an unweighted mean if there is no areacello)
+        weights = None if self.data['areacello'] is None else self.data['areacello'].lazy_data()
+        if weights is not None and self.data['areacello'].shape != self.data['main'].shape:
+            chunks = self.data['main'].lazy_data().chunks
+            weights = da.broadcast_to(weights.rechunk(chunks[-2:]), self.data['main'].shape, chunks=chunks)
 
         self.data['main'] = self.data['main'].collapsed(['latitude', 'longitude'], iris.analysis.MEAN, weights=weights)
         if 'min' in self.data:
             self.data['min'] = self.data['min'].collapsed(['latitude', 'longitude'], iris.analysis.MEAN, weights=weights)
             self.data['max'] = self.data['max'].collapsed(['latitude', 'longitude'], iris.analysis.MEAN, weights=weights)
 
+    def sum_over_regions(self, factor=1):
+        '''
+        Sum the variable multiplied by areacello over each of self.regions, and multiply by factor to update the units.
+
+        This is multiply_by_area, sum_over_area and update_units for all regions at once: the data are contracted with the sparse
+        region weights (areacello within each region) in one pass, see integrate_fused. If min and max exist, perform the same processing for those.
+
+        In the case of HadISST siconc data, which has no areacello, area_statistics is used for each region in turn.
+
+        Results are stored in self.region_data[region], to be picked with select_region.
+        '''
+        print('Summing %s over regions %s.' % (self.variable, self.regions))
+        if self.dataset == 'HadISST':
+            print('Loader, sum_over_regions: summing and multiplying by area simultaneously as %s has no areacello' % self.dataset)
+            for region, mask in zip(self.regions, self.region_masks):
+                cube = self.data['main'].copy(data=mask_lazy(self.data['main'].lazy_data(), mask))
+                cube = area_statistics(cube, operator='sum')
+                cube.data = cube.data * factor
+                self.region_data[region] = {'main': cube}
+            return
+
+        fields = {ds: da.ma.filled(self.data[ds].lazy_data(), 0) for ds in ['main', 'min', 'max'] if ds in self.data}
+        sums = integrate_fused(self._weights_over_regions(factor), fields)
+        for ds in fields:
+            self._store_region_series(ds, sums[ds])
+
+    def cell_area_weighted_mean_over_regions(self):
+        '''
+        Calculate the cell area weighted mean of the variable over each of self.regions.
+
+        This is cell_area_weighted_mean for all regions at once: sums of the weighted data and of the weights of the valid points are
+        both taken with the sparse region weights in one pass, see integrate_fused. If min and max exist, perform the same processing for those.
+
+        Results are stored in self.region_data[region], to be picked with select_region.
+        '''
+        print('Calculating cell area weighted mean of %s over regions %s.' % (self.variable, self.regions))
+        fields = {}
+        for ds in ['main', 'min', 'max']:
+            if ds in self.data:
+                fields[ds] = da.ma.filled(self.data[ds].lazy_data(), 0)
+                fields[ds + '_valid'] = (~da.ma.getmaskarray(self.data[ds].lazy_data())).astype(float)
+        sums = integrate_fused(self._weights_over_regions(), fields)
+        for ds in ['main', 'min', 'max']:
+            if ds in self.data:
+                self._store_region_series(ds, sums[ds] / sums[ds + '_valid'])
+
+    def integrate_over_area(self, factor):
+        '''
+        Sum the variable multiplied by areacello over the area defined by the region mask, and multiply by factor to update the units.
+
+        This is multiply_by_area, sum_over_area and update_units fused into a single pass over the data for main, min and max at once,
+        see integrate_fused. The masked areacello times factor are the weights, so no full-size intermediate arrays are made.
+
+        In the case of HadISST siconc, or other data without areacello, sum_over_area and update_units are used.
+
+        self.data are updated directly, with the collapsed series.
+        '''
+        print('Integrating %s over area.' % self.variable)
+        if self.dataset == 'HadISST' or self.data['areacello'] is None:
+            self.sum_over_area()
+            self.update_units(factor)
+            return
+
+        weights = scipy.sparse.csr_matrix(np.ma.filled(self.data['areacello'].data, 0).astype(float).reshape(1, -1) * factor)
+        fields = {ds: da.ma.filled(self.data[ds].lazy_data(), 0) for ds in ['main', 'min', 'max'] if ds in self.data}
+        sums = integrate_fused(weights, fields)
+        for ds in fields:
+            self.data[ds] = self._series_cube(ds, sums[ds][..., 0])
+        self.multiplied_by_area = True
+
+    def _weights_over_regions(self, factor=1):
+        '''Sparse region weights times factor, or the region masks if there is no areacello (i.e. a plain sum as in sum_over_area).'''
+        if self.region_weights is None:
+            print('No areacello for %s, using the region masks without cell areas' % self.dataset)
+            return scipy.sparse.csr_matrix(self.region_masks.reshape(len(self.regions), -1).astype(float) * factor)
+        return self.region_weights * factor
+
+    def _series_cube(self, ds, series):
+        '''Cube of a series collapsed over the horizontal, with the non-horizontal metadata of self.data[ds].'''
+        template = self.data[ds][..., 0, 0]
+        for coord in ['latitude', 'longitude']:
+            if template.coords(coord):
+                template.remove_coord(coord)
+        return template.copy(data=series)
+
+    def _store_region_series(self, ds, series):
+        '''Store the columns of series (time, region) as cubes in self.region_data, with the non-horizontal metadata of self.data[ds].'''
+        for i, region in enumerate(self.regions):
+            self.region_data.setdefault(region, {})[ds] = self._series_cube(ds, series[..., i])
+
+    def select_region(self, region):
+        '''Pick the area statistics of one of self.regions as self.data['main'] (and min and max), e.g. for plotting.'''
+        self.data.update(self.region_data[region])
+        self.region = region
+
     def update_units(self, factor):
-        ''' Update the units of the main variable and, if they exist, min and max variables. '''
-        self.data['main'].data = self.data['main'].data * factor
+        ''' Update the units of the main variable and, if they exist, min and max variables. The data stay lazy.'''
+        self.data['main'].data = self.data['main'].lazy_data() * factor
         if 'min' in self.data:
-            self.data['min'].data = self.data['min'].data * factor
-            self.data['max'].data = self.data['max'].data * factor
+            self.data['min'].data = self.data['min'].lazy_data() * factor
+            self.data['max'].data = self.data['max'].lazy_data() * factor
 
     def make_timeseries_xaxis(self):
             ''' Make the time variable for plotting.'''
@@ -516,6 +680,77 @@ def get_region_indicies(region, lon2d, lat2d):
 
     return indexesi, indexesj
 
+def mask_lazy(data, mask):
+    '''Mask the lazy array data (..., y, x) outside the 2d boolean mask, without materialising the broadcast mask.'''
+    condition = da.from_array(~mask, chunks=data.chunks[-2:])
+    return da.ma.masked_where(da.broadcast_to(condition, data.shape, chunks=data.chunks), data)
+
+def integrate_fused(weights, fields):
+    '''Fused area integration of several lazy fields in a single streaming pass.
+
+    Each field is contracted with the sparse weights (i.e. areacello x region mask x unit factor) as one sparse mat-vec per time step,
+    and all fields are computed together, so the data are read once in chunks along time and no full-size intermediate arrays are made.
+
+    Args:
+        weights (scipy.sparse matrix): (n, point) weights, where point is the flat index into the (y, x) grid.
+        fields (dict): Lazy arrays (..., y, x) with masked points filled, e.g. {'main': ..., 'min': ..., 'max': ...}.
+
+    Returns:
+        dict: Realised (..., n) sums for each field.
+    '''
+    n = weights.shape[0]
+    sums = {}
+    for name, field in fields.items():
+        field = field.rechunk(field.chunks[:-2] + (-1, -1))
+        flat = field.reshape(-1, field.shape[-2] * field.shape[-1])
+        sums[name] = flat.map_blocks(lambda block: (weights @ block.T).T, chunks=(flat.chunks[0], (n,)), dtype=float)
+    computed = da.compute(*sums.values())
+    return {name: values.reshape(fields[name].shape[:-2] + (n,)) for name, values in zip(sums, computed)}
+
+# Directory of the on-disk cache of region masks and weights, None switches the cache off (set from the recipe by set_region_cache_dir)
+region_cache_dir = None
+
+# Hash of the region definitions, part of the cache path so cached masks and weights are recomputed when a region changes
+region_definition = hashlib.sha1(inspect.getsource(get_region_indicies).encode()).hexdigest()[:16]
+
+def set_region_cache_dir(path):
+    '''Set the directory of the region cache, or switch the cache off with None.'''
+    global region_cache_dir
+    region_cache_dir = path
+
+def grid_fingerprint(lon2d, lat2d):
+    '''Content hash of a grid, so region masks and weights are shared by all datasets on the same grid.'''
+    h = hashlib.sha1(str(np.shape(lon2d)).encode())
+    h.update(np.ascontiguousarray(lon2d, dtype=float))
+    h.update(np.ascontiguousarray(lat2d, dtype=float))
+    return h.hexdigest()[:16]
+
+def _region_cache_file(lon2d, lat2d, name):
+    '''Path of a file in the region cache for the grid lon2d, lat2d, or None if the cache is switched off.'''
+    if region_cache_dir is None:
+        return None
+    return os.path.join(region_cache_dir, region_definition, grid_fingerprint(lon2d, lat2d), name)
+
+def _save_region_cache(path, **arrays):
+    '''
+    Save arrays to the region cache, carrying on without the cache if the directory is not writable.
+
+    The arrays are written to a temporary file in the same directory and moved into place with os.replace, so other
+    processes sharing the cache never read a partly written file.
+    '''
+    if path is None:
+        return
+    tmp = os.path.join(os.path.dirname(path), '.%d_%s' % (os.getpid(), os.path.basename(path)))
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        np.savez(tmp, **arrays)
+        os.replace(tmp, path)
+    except OSError as err:
+        print('Could not write region cache file %s: %s' % (path, err))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
+
 def make_region_mask(region, lons, lats):
     print('Making region mask for region: %s' % region)
 
@@ -529,11 +764,50 @@ def make_region_mask(region, lons, lats):
     else:
         raise ValueError('lons and lats must be 1D or 2D arrays')
 
+    # Masks are cached on disk as the flat indices of the points in the region
+    cache_file = _region_cache_file(lon2d, lat2d, '%s_mask.npz' % region)
+    if cache_file is not None and os.path.exists(cache_file):
+        mask = np.zeros(lon2d.size, dtype=bool)
+        mask[np.load(cache_file)['index']] = True
+        return mask.reshape(lon2d.shape), lon2d, lat2d
+
     indexesi, indexesj = get_region_indicies(region, lon2d, lat2d)
     mask = np.zeros_like(lon2d, dtype=bool)
     mask[indexesi, indexesj] = True
+    _save_region_cache(cache_file, index=np.flatnonzero(mask))
     return mask, lon2d, lat2d
 
+def region_weights(regions, lon2d, lat2d, area):
+    '''Sparse matrix of the region masks multiplied by the cell areas.
+
+    Each region is cached on disk, next to its mask, as a sparse vector (flat indices and areas of the points in the region) for this area.
+
+    Args:
+        regions (list): Region names as for get_region_indicies.
+        lon2d, lat2d (2d numpy arrays): Grid of the data.
+        area (2d numpy array): Cell areas on the grid (i.e. areacello), masked points count as 0.
+
+    Returns:
+        scipy.sparse.csr_matrix: (region, point) weights, where point is the flat index into lon2d.
+    '''
+    area = np.ma.filled(area, 0).astype(float).ravel()
+    area_hash = hashlib.sha1(area).hexdigest()[:16]
+    rows, cols, weights = [], [], []
+    for i, region in enumerate(regions):
+        cache_file = _region_cache_file(lon2d, lat2d, '%s_weights_%s.npz' % (region, area_hash))
+        if cache_file is not None and os.path.exists(cache_file):
+            cached = np.load(cache_file)
+            index, weight = cached['index'], cached['weight']
+        else:
+            mask = make_region_mask(region, lon2d, lat2d)[0].ravel()
+            index = np.flatnonzero(mask & (area != 0))
+            weight = area[index]
+            _save_region_cache(cache_file, index=index, weight=weight)
+        rows.append(np.full(len(index), i))
+        cols.append(index)
+        weights.append(weight)
+    return scipy.sparse.csr_matrix((np.concatenate(weights), (np.concatenate(rows), np.concatenate(cols))), shape=(len(regions), area.size))
+
 def get_timerange_from_input_data(input_data, key_index=0):
     key = list(input_data.keys())[key_index]
     timerange = input_data[key]['timerange']